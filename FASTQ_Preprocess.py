@@ -44,6 +44,11 @@ def main(command_line_args=None):
     options_parser.set_defaults(HaloPLEX=False)
     options_parser.set_defaults(ThruPLEX=False)
     options_parser.set_defaults(FASTQ_PreProcess=True)
+    options_parser.set_defaults(DecompressThreads=int(getattr(args, "DecompressThreads", 0) or 0))
+    options_parser.set_defaults(CompressionLevel=int(getattr(args, "CompressionLevel", 6) or 6))
+    options_parser.set_defaults(CompressionThreads=int(getattr(args, "CompressionThreads", 0) or 1))
+    options_parser.set_defaults(BGZF=bool(strtobool(getattr(args, "BGZF", "False") or "False")))
+    options_parser.set_defaults(FastqIndex=bool(strtobool(getattr(args, "FastqIndex", "False") or "False")))
     args = options_parser.parse_args()
 
     # Check options file for errors.
@@ -55,10 +60,10 @@ def main(command_line_args=None):
     module_name = ""
 
     # Initialize generator to read each FASTQ file
-    fastq1 = FASTQ_Tools.FASTQ_Reader(args.FASTQ1, log)
-    fastq2 = FASTQ_Tools.FASTQ_Reader(args.FASTQ2, log)
-    index1 = FASTQ_Tools.FASTQ_Reader(args.Index1, log)
-    index2 = FASTQ_Tools.FASTQ_Reader(args.Index2, log)
+    fastq1 = FASTQ_Tools.FASTQ_Reader(args.FASTQ1, log, threads=args.DecompressThreads)
+    fastq2 = FASTQ_Tools.FASTQ_Reader(args.FASTQ2, log, threads=args.DecompressThreads)
+    index1 = FASTQ_Tools.FASTQ_Reader(args.Index1, log, threads=args.DecompressThreads)
+    index2 = FASTQ_Tools.FASTQ_Reader(args.Index2, log, threads=args.DecompressThreads)
 
     splitter_data = FASTQ_Tools.FastqSplitter(args, log, fastq1, fastq2, index1, index2, paired_end=True)
     new_fastq1, new_fastq2 = splitter_data.file_writer()
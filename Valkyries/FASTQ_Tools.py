@@ -7,11 +7,19 @@ Some helpers to make it easier to manipulate FASTQ files.
 """
 import pathlib
 import gzip
+import io
 import ntpath
+import os
 import itertools
+import mmap
 from operator import add
 import collections
+import queue
+import struct
+import threading
 import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 import natsort
 import pathos
 import Levenshtein
@@ -19,7 +27,7 @@ import magic
 import Valkyries.Tool_Box as Tool_Box
 
 __author__ = 'Dennis A. Simpson'
-__version__ = "0.17.7"
+__version__ = "0.17.8"
 
 
 class FastqFile:
@@ -78,6 +86,15 @@ class FastqSplitter:
         self.paired_end = paired_end
         self.read_count = None
 
+    def paired_reads(self):
+        """
+        Generator returning tuples of (read 1, read 2[, index 1][, index 2]) read in lockstep.
+        """
+        paired_reader = PairedFastqReader(self.log, self.fastq1_file, self.fastq2_file, self.index1_file,
+                                          self.index2_file)
+        for read_batch in paired_reader:
+            yield from read_batch
+
     def new_file_size(self, line_count):
         """
 
@@ -104,19 +121,15 @@ class FastqSplitter:
         :return:
         """
 
-        infile = FASTQ_Reader(self.args.FASTQ1, self.log)
         start_time = time.time()
         self.log.info("Begin counting lines in {}.".format(self.args.FASTQ1))
 
-        bufgen = \
-            itertools.takewhile(lambda x: x, (infile.fq_file.read(1024 * 1024) for _ in itertools.repeat(None)))
-
-        line_count = sum(buf.count('\n') for buf in bufgen)
+        # A current .fqi index next to the FASTQ file saves the scan.
+        line_count = fastq_index(self.args.FASTQ1, self.log, write=self.args.FastqIndex).line_count
 
         self.log.info("Found {0} reads in {1}. Count took {2} seconds"
-                      .format(line_count/4, infile.file_name, int(time.time() - start_time)))
+                      .format(line_count/4, ntpath.basename(self.args.FASTQ1), int(time.time() - start_time)))
 
-        infile.fq_file.close()
         return line_count
 
     def temp_file_writer(self, limit):
@@ -133,17 +146,13 @@ class FastqSplitter:
         bam_file_list = []
         read_count = 0
         limit_counter = 0
+        fastq3_read = None
 
-        while read_count <= self.read_count:
-            try:
-                # This generator is returning actual reads not lines.
-                fastq1_read = next(self.fastq1_file.seq_read())
-                fastq2_read = next(self.fastq2_file.seq_read())
-                if self.index1_file is not None:
-                    fastq3_read = next(self.index1_file.seq_read())
-            except StopIteration:
-                read_count += 1
-                continue
+        for fastq1_read, fastq2_read, *index_reads in self.paired_reads():
+            if read_count > self.read_count:
+                break
+            if self.index1_file is not None:
+                fastq3_read = index_reads[0]
 
             read_count += 1
 
@@ -210,8 +219,8 @@ class FastqSplitter:
             fastq1_read.name = header1
             fastq2_read.name = header2
 
-            temp_file1.write(self.fastq1_file)
-            temp_file2.write(self.fastq2_file)
+            temp_file1.write([[fastq1_read.name, fastq1_read.seq, fastq1_read.qual]])
+            temp_file2.write([[fastq2_read.name, fastq2_read.seq, fastq2_read.qual]])
 
         if temp_file1:
             temp_file1.close()
@@ -237,21 +246,14 @@ class FastqSplitter:
         self.log.info("Writing {0} and {1}".format(file1, file2))
         fastq1_list = []
         fastq2_list = []
-        eof = False
-        Read = collections.namedtuple('Read', 'name, seq, index, qual')
+        index1_read = None
+        index2_read = None
 
-        # This generator returns objects not lines.
-        while not eof:
-            try:
-                fastq1_read = next(self.fastq1_file.seq_read())
-                fastq2_read = next(self.fastq2_file.seq_read())
-                if self.index1_file is not None:
-                    index1_read = next(self.index1_file.seq_read())
-                if self.index2_file is not None:
-                    index2_read = next(self.index2_file.seq_read())
-            except StopIteration:
-                eof = True
-                continue
+        for fastq1_read, fastq2_read, *index_reads in self.paired_reads():
+            if self.index1_file is not None:
+                index1_read = index_reads[0]
+            if self.index2_file is not None:
+                index2_read = index_reads[-1]
 
             current_read_count += 1
 
@@ -304,8 +306,8 @@ class FastqSplitter:
             fastq1_read.name = header1
             fastq2_read.name = header2
 
-            fastq1_list.append(Read(fastq1_read.name, fastq1_read.seq, fastq1_read.index, fastq1_read.qual))
-            fastq2_list.append(Read(fastq2_read.name, fastq2_read.seq, fastq2_read.index, fastq2_read.qual))
+            fastq1_list.append([fastq1_read.name, fastq1_read.seq, fastq1_read.qual])
+            fastq2_list.append([fastq2_read.name, fastq2_read.seq, fastq2_read.qual])
 
             # empirically determined for UNC Longleaf cluster.  May need to expose this to user.  Writes blocks of data
             # to disk speeding up entire process.
@@ -329,8 +331,8 @@ class FastqSplitter:
 
         self.log.info("Modified FASTQ file(s) written")
         if self.args.FASTQ_PreProcess:
-            Tool_Box.compress_files(file1, self.log)
-            Tool_Box.compress_files(file2, self.log)
+            Tool_Box.compress_files([file1, file2], self.log, getattr(self.args, "CompressionLevel", 6),
+                                    getattr(self.args, "CompressionThreads", 1), getattr(self.args, "BGZF", False))
         return file1, file2
 
 
@@ -495,17 +497,28 @@ class FastqQuality:
 
 class Writer:
     """
-    Write new FASTQ file.
+    Write new FASTQ file.  Given a Tool_Box.Compressor the reads are buffered and written as gzip blocks each time the
+    buffer fills, so the file is never written uncompressed and memory use stays flat.
     """
-    __slots__ = ['log', 'file']
+    __slots__ = ['log', 'file', 'compressor', 'buffer', 'buffer_length', 'buffer_size', 'pending']
 
-    def __init__(self, log, out_file_string):
+    def __init__(self, log, out_file_string, compressor=None, buffer_size=1048576):
         """
         :param log:
         :param out_file_string:
+        :param compressor:
+        :param buffer_size: Bytes of FASTQ text collected before a block is compressed.
         """
-        self.file = open(out_file_string, "w")
-        # self.file = gzip.open(out_file_string, "rb")
+        self.compressor = compressor
+        self.buffer = []
+        self.buffer_length = 0
+        self.buffer_size = buffer_size
+        self.pending = collections.deque()
+
+        if compressor:
+            self.file = open(out_file_string, "wb")
+        else:
+            self.file = open(out_file_string, "w")
         self.log = log
 
     def lethal_write(self, read):
@@ -535,7 +548,7 @@ class Writer:
         :param read_list:
         :return:
         """
-        outstring = ""
+        out_list = []
         for read in read_list:
             try:
                 assert len(read[1]) == len(read[2])
@@ -543,34 +556,794 @@ class Writer:
                 self.log.error("Sequence and quality scores of different lengths! Read Name {0}; Seq Length {1}; Qual "
                                "Length {2}".format(read[0], len(read[1]), len(read[2])))
                 raise SystemExit(1)
-            outstring += "@{}\n{}\n+\n{}\n".format(read[0], read[1], read[2])
+            out_list.append("@{}\n{}\n+\n{}\n".format(read[0], read[1], read[2]))
+
+        outstring = "".join(out_list)
+        if self.compressor:
+            data = outstring.encode()
+            self.buffer.append(data)
+            self.buffer_length += len(data)
+            if self.buffer_length >= self.buffer_size:
+                self.flush()
+        else:
+            self.file.write(outstring)
 
-        self.file.write(outstring)
         read_list.clear()
 
         return True
 
+    def flush(self, wait=False):
+        """
+        Send the buffer to the compressor and write any finished blocks in order.  Only waits on the compressor when
+        more than a couple of blocks are outstanding or when wait is set.
+        :param wait:
+        """
+        if self.buffer:
+            self.pending.append(self.compressor.submit(b"".join(self.buffer)))
+            self.buffer = []
+            self.buffer_length = 0
+
+        while self.pending and (wait or len(self.pending) > 2 or self.pending[0].done()):
+            self.file.write(self.pending.popleft().result())
+
     def close(self):
         """
         Closes FASTQ file
         :return:
         """
+        if self.compressor:
+            self.flush(wait=True)
+
+            # An empty file still needs to be a valid gzip file.
+            if self.file.tell() == 0 and not self.compressor.bgzf:
+                self.file.write(self.compressor.compress(b""))
+            if self.compressor.bgzf:
+                self.file.write(Tool_Box.BGZF_EOF)
+
         self.file.close()
         return True
 
+    def append_file(self, file_name):
+        """
+        Copy an already compressed FASTQ file onto the end of this one.  gzip members simply concatenate; a trailing
+        BGZF end-of-file block is dropped so it only appears once, when this file is closed.
+        :param file_name:
+        """
+        if self.compressor:
+            self.flush(wait=True)
+
+        size = os.path.getsize(file_name)
+        with open(file_name, 'rb') as f:
+            if self.compressor and self.compressor.bgzf and size >= len(Tool_Box.BGZF_EOF):
+                f.seek(size - len(Tool_Box.BGZF_EOF))
+                if f.read() == Tool_Box.BGZF_EOF:
+                    size -= len(Tool_Box.BGZF_EOF)
+                f.seek(0)
+
+            while size > 0:
+                data = f.read(min(size, 1048576))
+                if not data:
+                    break
+                self.file.write(data)
+                size -= len(data)
+
+
+class ThreadedGzipReader(io.RawIOBase):
+    """
+    Binary reader that decompresses a gzip file on background threads.  Block gzip (BGZF) files are split into their
+    independent blocks and inflated in parallel.  Ordinary gzip files are inflated on a single background thread so
+    decompression still overlaps with parsing and index matching.  Wrap in io.BufferedReader/io.TextIOWrapper for text.
+    """
+
+    def __init__(self, input_file, threads=2, queue_depth=64):
+        """
+        :param input_file:
+        :param threads: Number of inflate threads used for BGZF input.
+        :param queue_depth: Number of decompressed blocks allowed to wait for the consumer.
+        """
+        super().__init__()
+        self.input_file = input_file
+        self.threads = max(int(threads), 1)
+        self.bgzf = self.bgzf_check(input_file)
+        self._raw = open(input_file, 'rb')
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._stop = threading.Event()
+        self._chunk = memoryview(b"")
+        self._eof = False
+        self._pool = None
+
+        if self.bgzf:
+            self._pool = ThreadPoolExecutor(max_workers=self.threads)
+            target = self.__bgzf_producer
+        else:
+            target = self.__gzip_producer
+
+        self._thread = threading.Thread(target=target, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def bgzf_check(input_file):
+        """
+        Returns True if the first gzip member carries the BGZF "BC" extra subfield.
+        :param input_file:
+        :return:
+        """
+        with open(input_file, 'rb') as f:
+            header = f.read(12)
+            if len(header) < 12 or header[:3] != b"\x1f\x8b\x08" or not header[3] & 4:
+                return False
+            xlen = struct.unpack("<H", header[10:12])[0]
+            extra = f.read(xlen)
+
+        return ThreadedGzipReader.bsize(extra) is not None
+
+    @staticmethod
+    def bsize(extra):
+        """
+        Pull the BGZF block size out of the gzip extra field.  Returns None if the subfield is missing.
+        :param extra:
+        :return:
+        """
+        position = 0
+        while position + 4 <= len(extra):
+            slen = struct.unpack("<H", extra[position+2:position+4])[0]
+            if extra[position:position+2] == b"BC" and slen == 2:
+                return struct.unpack("<H", extra[position+4:position+6])[0]
+            position += 4 + slen
+
+        return None
+
+    @staticmethod
+    def inflate_block(cdata, trailer):
+        """
+        Inflate a single BGZF block and check its CRC.  Runs on the thread pool; zlib releases the GIL.
+        :param cdata:
+        :param trailer:
+        :return:
+        """
+        data = zlib.decompress(cdata, -15)
+        crc, isize = struct.unpack("<II", trailer)
+        if zlib.crc32(data) != crc or len(data) != isize:
+            raise IOError("BGZF block failed CRC check.")
+
+        return data
+
+    def __put(self, item):
+        """
+        Queue an item for the consumer, giving up if the reader has been closed.
+        :param item:
+        :return:
+        """
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def __bgzf_producer(self):
+        """
+        Read raw BGZF blocks and hand them to the thread pool.  Futures are queued in file order.
+        """
+        try:
+            while not self._stop.is_set():
+                header = self._raw.read(12)
+                if not header:
+                    break
+                if len(header) < 12 or header[:2] != b"\x1f\x8b":
+                    raise IOError("{} is not a valid BGZF file.".format(self.input_file))
+
+                xlen = struct.unpack("<H", header[10:12])[0]
+                extra = self._raw.read(xlen)
+                block_size = self.bsize(extra)
+                if block_size is None:
+                    raise IOError("{} has a gzip member without a BGZF block size.".format(self.input_file))
+
+                body = self._raw.read(block_size + 1 - 12 - xlen)
+                if not self.__put(self._pool.submit(self.inflate_block, body[:-8], body[-8:])):
+                    break
+        except Exception as err:
+            self.__put(err)
+        finally:
+            self.__put(None)
+
+    def __gzip_producer(self):
+        """
+        Inflate an ordinary gzip file, including multi-member files, on this background thread.
+        """
+        try:
+            decompressor = zlib.decompressobj(31)
+            member_open = False
+            while not self._stop.is_set():
+                raw_data = self._raw.read(262144)
+                if not raw_data:
+                    if member_open:
+                        raise EOFError("{} ended before the end-of-stream marker was reached."
+                                       .format(self.input_file))
+                    break
+
+                while raw_data:
+                    member_open = True
+                    data = decompressor.decompress(raw_data)
+                    if data and not self.__put(data):
+                        return
+                    raw_data = b""
+
+                    # A new gzip member starts in the unused data.
+                    if decompressor.eof:
+                        raw_data = decompressor.unused_data
+                        decompressor = zlib.decompressobj(31)
+                        member_open = False
+        except Exception as err:
+            self.__put(err)
+        finally:
+            self.__put(None)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        """
+        Copy decompressed data into the buffer provided by io.BufferedReader.
+        :param buffer:
+        :return:
+        """
+        while not self._chunk and not self._eof:
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                if not isinstance(item, bytes):
+                    item = item.result()
+                self._chunk = memoryview(item)
+
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+
+        return size
+
+    def close(self):
+        """
+        Stop the background threads and close the file.
+        """
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            if self._pool:
+                self._pool.shutdown(wait=True)
+            self._raw.close()
+        super().close()
+
+
+class PlainRangeReader(io.RawIOBase):
+    """
+    Binary reader limited to the bytes from start up to, but not including, end of an uncompressed file.
+    """
+
+    def __init__(self, input_file, start, end=None):
+        """
+        :param input_file:
+        :param start: Byte offset of the first record.
+        :param end: Byte offset of the first record not returned.  None reads to the end of the file.
+        """
+        super().__init__()
+        self._raw = open(input_file, 'rb')
+        self._raw.seek(start)
+        self._remaining = -1 if end is None else end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = len(buffer) if self._remaining < 0 else min(len(buffer), self._remaining)
+        if size == 0:
+            return 0
+
+        data = self._raw.read(size)
+        buffer[:len(data)] = data
+        if self._remaining > 0:
+            self._remaining -= len(data)
+
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+        super().close()
+
+
+class BgzfRangeReader(io.RawIOBase):
+    """
+    Binary reader returning the decompressed bytes of a BGZF file between two virtual offsets.  A virtual offset is a
+    (block offset, offset within the decompressed block) tuple.
+    """
+
+    def __init__(self, input_file, start, end=None):
+        """
+        :param input_file:
+        :param start: Virtual offset of the first record.
+        :param end: Virtual offset of the first record not returned.  None reads to the end of the file.
+        """
+        super().__init__()
+        self.input_file = input_file
+        self._raw = open(input_file, 'rb')
+        self._raw.seek(start[0])
+        self._skip = start[1]
+        self._end = end
+        self._chunk = memoryview(b"")
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def __next_block(self):
+        """
+        Inflate the next block, trimming it to the requested range.
+        """
+        block_offset = self._raw.tell()
+        if self._end is not None and block_offset > self._end[0]:
+            self._eof = True
+            return
+
+        data = bgzf_read_block(self._raw, self.input_file)
+        if data is None:
+            self._eof = True
+            return
+
+        if self._end is not None and block_offset == self._end[0]:
+            data = data[:self._end[1]]
+            self._eof = True
+        if self._skip:
+            data = data[self._skip:]
+            self._skip = 0
+
+        self._chunk = memoryview(data)
+
+    def readinto(self, buffer):
+        while not self._chunk and not self._eof:
+            self.__next_block()
+
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+        super().close()
+
+
+def bgzf_read_block(raw, input_file):
+    """
+    Read and inflate the BGZF block at the current position of an open binary file.  Returns None at the end of the
+    file.
+    :param raw:
+    :param input_file:
+    :return:
+    """
+    header = raw.read(12)
+    if not header:
+        return None
+    if len(header) < 12 or header[:2] != b"\x1f\x8b":
+        raise IOError("{} is not a valid BGZF file.".format(input_file))
+
+    xlen = struct.unpack("<H", header[10:12])[0]
+    block_size = ThreadedGzipReader.bsize(raw.read(xlen))
+    if block_size is None:
+        raise IOError("{} has a gzip member without a BGZF block size.".format(input_file))
+
+    body = raw.read(block_size + 1 - 12 - xlen)
+
+    return ThreadedGzipReader.inflate_block(body[:-8], body[-8:])
+
+
+def first_record(data):
+    """
+    Returns the offset of the first complete FASTQ record that starts after the first newline in data, or None if
+    there is not enough data to tell.  Only header and quality lines can begin with "@", and only a header line is
+    followed two lines later by a line beginning with "+".
+    :param data:
+    :return:
+    """
+    position = data.find(b"\n") + 1
+    while position:
+        next_line = data.find(b"\n", position) + 1
+        third_line = data.find(b"\n", next_line) + 1 if next_line else 0
+        if not third_line or third_line == len(data):
+            return None
+        if data[position:position+1] == b"@" and data[third_line:third_line+1] == b"+":
+            return position
+        position = next_line
+
+    return None
+
+
+class FastqIndex:
+    """
+    Sidecar index (input_file.fqi) holding the line count of a FASTQ file and the offset of every interval-th record.
+    Offsets are byte offsets for uncompressed files and (block offset, offset within block) virtual offsets for BGZF.
+    Ordinary gzip files only get the count.  The file size and modification time are stored so a stale index is
+    ignored.
+    """
+
+    def __init__(self, input_file, log=None, interval=100000):
+        """
+        :param input_file:
+        :param log:
+        :param interval: Records between stored offsets.
+        """
+        self.input_file = input_file
+        self.index_file = "{}.fqi".format(input_file)
+        self.log = log
+        self.interval = interval
+        self.line_count = None
+        self.offsets = []
+        self.bgzf = False
+
+    @property
+    def record_count(self):
+        return None if self.line_count is None else self.line_count // 4
+
+    def __file_stamp(self):
+        stat = os.stat(self.input_file)
+        return str(stat.st_size), str(int(stat.st_mtime))
+
+    def load(self):
+        """
+        Read an existing index.  Returns False if there is none or it does not match the FASTQ file.
+        :return:
+        """
+        if not os.path.isfile(self.index_file):
+            return False
+
+        header = {}
+        offsets = []
+        with open(self.index_file) as f:
+            for line in f:
+                if line.startswith("#") or not line.strip():
+                    continue
+                l_list = line.strip("\n").split("\t")
+                if l_list[0] == "Offset":
+                    offsets.append(int(l_list[1]) if len(l_list) == 2 else (int(l_list[1]), int(l_list[2])))
+                else:
+                    header[l_list[0]] = l_list[1]
+
+        if (header.get("Size"), header.get("MTime")) != self.__file_stamp():
+            if self.log:
+                self.log.warning("{} is out of date and will be ignored.".format(self.index_file))
+            return False
+
+        self.line_count = int(header["Lines"])
+        self.interval = int(header["Interval"])
+        self.bgzf = header.get("BGZF") == "True"
+        self.offsets = offsets
+
+        return True
+
+    def build(self):
+        """
+        Count the lines in the FASTQ file and note the offset of every interval-th record.
+        """
+        start_time = time.time()
+        step = 4 * self.interval
+        line_count = 0
+        offsets = [(0, 0)]
+
+        with open(self.input_file, 'rb') as f:
+            compressed = f.read(2) == b"\x1f\x8b"
+        self.bgzf = compressed and ThreadedGzipReader.bgzf_check(self.input_file)
+
+        if self.bgzf:
+            offsets = [(0, (0, 0))]
+            with open(self.input_file, 'rb') as f:
+                while True:
+                    block_offset = f.tell()
+                    data = bgzf_read_block(f, self.input_file)
+                    if data is None:
+                        break
+                    block_lines = data.count(b"\n")
+                    offsets.extend((line, (block_offset, position)) for line, position
+                                   in self.__line_positions(data, line_count, block_lines, step))
+                    line_count += block_lines
+
+        elif compressed:
+            offsets = []
+            with gzip.open(self.input_file, 'rb') as f:
+                for block in iter(lambda: f.read(4194304), b""):
+                    line_count += block.count(b"\n")
+
+        else:
+            position = 0
+            with open(self.input_file, 'rb') as f:
+                for block in iter(lambda: f.read(4194304), b""):
+                    block_lines = block.count(b"\n")
+                    offsets.extend((line, position + line_position) for line, line_position
+                                   in self.__line_positions(block, line_count, block_lines, step))
+                    line_count += block_lines
+                    position += len(block)
+
+        # Drop an offset that points at the end of the file.
+        self.line_count = line_count
+        self.offsets = [offset for line, offset in offsets if line < line_count]
+
+        if self.log:
+            self.log.info("Indexed {} reads in {} in {} seconds."
+                          .format(self.record_count, ntpath.basename(self.input_file), int(time.time() - start_time)))
+
+    @staticmethod
+    def __line_positions(data, line_count, block_lines, step):
+        """
+        (line number, position in data) of the lines that start a stored record.  Line numbers are counted from the
+        start of the file and every step-th line is stored.
+        :param data:
+        :param line_count: Lines seen before this block.
+        :param block_lines: Newlines in this block.
+        :param step:
+        :return:
+        """
+        positions = []
+        target = (line_count // step + 1) * step
+        if target > line_count + block_lines:
+            return positions
+
+        # A line starting right after the last newline is given as the end of this block.
+        lengths = [len(line) + 1 for line in data.split(b"\n")]
+        while target <= line_count + block_lines:
+            positions.append((target, sum(lengths[:target - line_count])))
+            target += step
+
+        return positions
+
+    def write(self):
+        """
+        Write the index next to the FASTQ file.  A read only location is not an error.
+        """
+        size, mtime = self.__file_stamp()
+        out_string = "# FASTQ Index v{}\nFile\t{}\nSize\t{}\nMTime\t{}\nBGZF\t{}\nLines\t{}\nInterval\t{}\n"\
+            .format(__version__, ntpath.basename(self.input_file), size, mtime, self.bgzf, self.line_count,
+                    self.interval)
+
+        for offset in self.offsets:
+            if isinstance(offset, tuple):
+                out_string += "Offset\t{}\t{}\n".format(*offset)
+            else:
+                out_string += "Offset\t{}\n".format(offset)
+
+        try:
+            with open(self.index_file, "w") as f:
+                f.write(out_string)
+        except OSError as err:
+            if self.log:
+                self.log.warning("Unable to write {}: {}".format(self.index_file, err))
+
+    def shards(self, shard_count):
+        """
+        Record aligned (start, end) ranges taken from the stored offsets.  Returns None if there are no offsets.
+        :param shard_count:
+        :return:
+        """
+        if not self.offsets:
+            return None
+
+        boundaries = []
+        for i in range(shard_count):
+            offset = self.offsets[len(self.offsets) * i // shard_count]
+            if not boundaries or offset > boundaries[-1]:
+                boundaries.append(offset)
+
+        return list(zip(boundaries, boundaries[1:] + [None]))
+
+
+def fastq_index(input_file, log=None, build=True, write=False):
+    """
+    Return the FastqIndex for a FASTQ file.  An existing, current index is loaded; otherwise, if build is set, the file
+    is scanned and, if write is set, the index is saved for later runs.  Returns None if there is no index to use.
+    :param input_file:
+    :param log:
+    :param build:
+    :param write:
+    :return:
+    """
+    index = FastqIndex(input_file, log)
+    if not index.load():
+        if not build:
+            return None
+        index.build()
+        if write:
+            index.write()
+
+    return index
+
+
+def fastq_shards(input_file, shard_count):
+    """
+    Split an uncompressed or BGZF FASTQ file into record aligned ranges that FASTQ_Reader can read independently.
+    Returns a list of (start, end) pairs, with end None for the last shard.  Plain text ranges are byte offsets; BGZF
+    ranges are virtual offsets.  Returns None for ordinary gzip files, which can only be read from the beginning.
+    :param input_file:
+    :param shard_count:
+    :return:
+    """
+    with open(input_file, 'rb') as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+
+    if compressed and not ThreadedGzipReader.bgzf_check(input_file):
+        return None
+
+    file_size = os.path.getsize(input_file)
+    boundaries = [0] if not compressed else [(0, 0)]
+
+    if compressed:
+        # Offsets of every block.  Only the headers are read.
+        block_offsets = []
+        with open(input_file, 'rb') as f:
+            while True:
+                header = f.read(12)
+                if len(header) < 12:
+                    break
+                xlen = struct.unpack("<H", header[10:12])[0]
+                block_size = ThreadedGzipReader.bsize(f.read(xlen))
+                block_offsets.append(f.tell() - 12 - xlen)
+                f.seek(block_offsets[-1] + block_size + 1)
+
+        with open(input_file, 'rb') as f:
+            for i in range(1, shard_count):
+                target = file_size * i // shard_count
+                block = next((j for j, offset in enumerate(block_offsets) if offset >= target), len(block_offsets))
+                data = b""
+                block_starts = []
+                record = None
+                while record is None and block < len(block_offsets):
+                    f.seek(block_offsets[block])
+                    block_starts.append(len(data))
+                    data += bgzf_read_block(f, input_file)
+                    record = first_record(data)
+                    block += 1
+                if record is None:
+                    break
+
+                # Convert the position in the inflated data to a virtual offset.
+                j = len([start for start in block_starts if start <= record]) - 1
+                j_block = block - len(block_starts) + j
+                boundary = (block_offsets[j_block], record - block_starts[j])
+                if boundary > boundaries[-1]:
+                    boundaries.append(boundary)
+    else:
+        with open(input_file, 'rb') as f:
+            for i in range(1, shard_count):
+                target = file_size * i // shard_count
+                read_size = 1048576
+                record = None
+                while record is None:
+                    f.seek(target)
+                    data = f.read(read_size)
+                    record = first_record(data)
+                    if len(data) < read_size:
+                        break
+                    read_size *= 2
+                if record is None:
+                    break
+
+                if target + record > boundaries[-1]:
+                    boundaries.append(target + record)
+
+    return list(zip(boundaries, boundaries[1:] + [None]))
+
+
+class FastqRead:
+    """
+    A single FASTQ record as produced by the block parser.  The attributes are writable so read_trim() and the header
+    rewrites done in FastqSplitter continue to work.
+    """
+    __slots__ = ['name', 'seq', 'index', 'qual']
+
+    def __init__(self, name, seq, index, qual):
+        self.name = name
+        self.seq = seq
+        self.index = index
+        self.qual = qual
+
+
+class MappedFastqRead:
+    """
+    A FASTQ record held as offsets into a memory mapped file.  memoryviews of the lines are available without copying;
+    the strings are built the first time they are asked for.
+    """
+    __slots__ = ['buffer', 'start', 'seq_start', 'index_start', 'qual_start', 'end', '_name', '_seq', '_index', '_qual']
+
+    def __init__(self, buffer, start, seq_start, index_start, qual_start, end):
+        self.buffer = buffer
+        self.start = start
+        self.seq_start = seq_start
+        self.index_start = index_start
+        self.qual_start = qual_start
+        self.end = end
+        self._name = None
+        self._seq = None
+        self._index = None
+        self._qual = None
+
+    @property
+    def seq_view(self):
+        return memoryview(self.buffer)[self.seq_start:self.index_start-1]
+
+    @property
+    def qual_view(self):
+        return memoryview(self.buffer)[self.qual_start:self.end]
+
+    @property
+    def name(self):
+        if self._name is None:
+            self._name = self.buffer[self.start:self.seq_start-1].decode().rstrip("\r").strip("@")
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        self._name = value
+
+    @property
+    def seq(self):
+        if self._seq is None:
+            self._seq = self.buffer[self.seq_start:self.index_start-1].decode().strip()
+        return self._seq
+
+    @seq.setter
+    def seq(self, value):
+        self._seq = value
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = self.buffer[self.index_start:self.qual_start-1].decode().strip()
+        return self._index
+
+    @index.setter
+    def index(self, value):
+        self._index = value
+
+    @property
+    def qual(self):
+        if self._qual is None:
+            self._qual = self.buffer[self.qual_start:self.end].decode().strip()
+        return self._qual
+
+    @qual.setter
+    def qual(self, value):
+        self._qual = value
+
+    def __reduce__(self):
+        """
+        The memory map can not be sent to another process so the read is sent as a FastqRead.
+        """
+        return FastqRead, (self.name, self.seq, self.index, self.qual)
+
 
 class FASTQ_Reader:
     """
-    Main class that creates FASTQ reads using a generator
+    Main class that creates FASTQ reads.  Iterating the object yields lists of FastqRead objects parsed from large
+    blocks of the file.  seq_read() is kept for code that still pulls one read at a time.
     """
-    __slots__ = ['input_file', 'log', 'name', 'seq', 'index', 'qual', 'read_block', 'file_name', 'fq_file']
+    __slots__ = ['input_file', 'log', 'name', 'seq', 'index', 'qual', 'read_block', 'file_name', 'fq_file',
+                 'block_size', 'read_position', 'batches', 'threads', 'memory_map', 'byte_range']
 
-    def __init__(self, input_file, log=None):
+    def __init__(self, input_file, log=None, block_size=4194304, threads=0, memory_map=False, byte_range=None):
         """
         Splits the FASTQ read list from the FASTQ Iterator into the lines to be manipulated.  Also does a check to make
         sure the sequence length = quality string length.
 
         :param input_file:
+        :param log:
+        :param block_size: Number of characters read from the file for each batch of reads.
+        :param threads: Decompression threads for gzip input.  0 decompresses on the calling thread.
+        :param memory_map: Memory map uncompressed FASTQ and return MappedFastqRead objects.
+        :param byte_range: (start, end) pair from fastq_shards().  Only the records in that range are read.
         :return:
         """
 
@@ -581,9 +1354,19 @@ class FASTQ_Reader:
         self.input_file = input_file
         self.log = log
         self.read_block = []
+        self.read_position = 0
+        self.block_size = block_size
+        self.threads = threads
+        self.memory_map = memory_map
+        self.byte_range = byte_range
         self.file_name = ntpath.basename(input_file)
         self.fq_file = self.__fastq_file()
 
+        if isinstance(self.fq_file, mmap.mmap):
+            self.batches = self.mapped_batch_read()
+        else:
+            self.batches = self.batch_read()
+
     def __fastq_file(self):
         """
         Create FASTQ file object.
@@ -602,8 +1385,20 @@ class FASTQ_Reader:
         except AttributeError:
             mime_type = magic.from_file(self.input_file, mime=True)
 
-        if "text" in mime_type:
+        if self.byte_range and "gzip" in mime_type:
+            fq_file = io.TextIOWrapper(io.BufferedReader(BgzfRangeReader(self.input_file, *self.byte_range),
+                                                         buffer_size=1048576), encoding='utf-8')
+        elif self.byte_range:
+            fq_file = io.TextIOWrapper(io.BufferedReader(PlainRangeReader(self.input_file, *self.byte_range),
+                                                         buffer_size=1048576), encoding='utf-8')
+        elif "text" in mime_type and self.memory_map and os.path.getsize(self.input_file) > 0:
+            with open(self.input_file, 'rb') as f:
+                fq_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        elif "text" in mime_type:
             fq_file = open(self.input_file, 'rU')
+        elif "gzip" in mime_type and self.threads > 0:
+            fq_file = io.TextIOWrapper(io.BufferedReader(ThreadedGzipReader(self.input_file, self.threads),
+                                                         buffer_size=1048576), encoding='utf-8')
         elif "gzip" in mime_type:
             fq_file = gzip.open(self.input_file, 'rt', encoding='utf-8')
         else:
@@ -611,47 +1406,272 @@ class FASTQ_Reader:
             raise SystemExit(1)
         return fq_file
 
-    def line_reader(self):
+    def __iter__(self):
         """
-        Part of generator for FASTQ reads
+        Yields lists of reads.  Any reads left over from seq_read() calls are returned first.
         """
-        for line in self.fq_file:
-            while True:
-                yield line
+        if self.read_position < len(self.read_block):
+            yield self.read_block[self.read_position:]
+            self.read_block = []
+            self.read_position = 0
 
-    def seq_read(self):
+        yield from self.batches
+
+    def batch_read(self):
         """
-        Generator reads FASTQ file creating read block.
+        Generator reads the FASTQ file in large blocks and splits each block into reads in bulk.  Partial records at
+        the end of a block are carried over to the next one.
         """
-        read_block = []
-        count = 0
-        eof = False
-        try:
-            # for i in range(4):
-            while count < 4:
-                read_block.append(next(FASTQ_Reader.line_reader(self)))
-                count += 1
-        except StopIteration:
-            eof = True
+        remainder = ""
+        while True:
+            block = self.fq_file.read(self.block_size)
+            if not block:
+                break
+
+            lines = (remainder + block).split("\n")
+            remainder = lines.pop()
+            partial = len(lines) % 4
+            if partial:
+                remainder = "\n".join(lines[-partial:] + [remainder])
+                del lines[-partial:]
+
+            if lines:
+                yield self.__parse_lines(lines)
+
+        # The last record may not have a trailing newline.
+        lines = [line for line in remainder.split("\n") if line]
+        if len(lines) >= 4:
+            yield self.__parse_lines(lines[:len(lines) - len(lines) % 4])
+            lines = lines[len(lines) - len(lines) % 4:]
+
+        if lines and self.log:
+            self.log.warning("{} ends with an incomplete FASTQ record.  Record ignored.".format(self.file_name))
+
+    def mapped_batch_read(self):
+        """
+        Generator that walks a memory mapped FASTQ file and yields lists of MappedFastqRead objects.  Only the line
+        offsets are found here; no strings are built.
+        """
+        buffer = self.fq_file
+        find = buffer.find
+        size = len(buffer)
+        position = 0
+
+        while position < size:
+            read_list = []
+            limit = position + self.block_size
+
+            while position < limit:
+                # Skip blank lines between records and at the end of the file.
+                while position < size and buffer[position] in (10, 13):
+                    position += 1
+                if position >= size:
+                    break
+
+                seq_start = find(b"\n", position) + 1
+                index_start = find(b"\n", seq_start) + 1 if seq_start else 0
+                qual_start = find(b"\n", index_start) + 1 if index_start else 0
+                if not qual_start:
+                    if self.log:
+                        self.log.warning("{} ends with an incomplete FASTQ record.  Record ignored."
+                                         .format(self.file_name))
+                    position = size
+                    break
+
+                end = find(b"\n", qual_start)
+                if end == -1:
+                    end = size
+
+                read = MappedFastqRead(buffer, position, seq_start, index_start, qual_start, end)
+                if index_start - seq_start != end - qual_start + 1 and len(read.seq) != len(read.qual):
+                    msg = "Sequence and quality scores of different lengths! \n{0:s}\n{1:s}\n{2:s}\n{3:s}"\
+                        .format(read.name, read.seq, read.index, read.qual)
+                    if self.log:
+                        self.log.error(msg)
+                    raise ValueError(msg)
+
+                read_list.append(read)
+                position = end + 1
+
+            if read_list:
+                yield read_list
+
+    def __parse_lines(self, lines):
+        """
+        Convert a list of lines, 4 per read, into a list of FastqRead objects.
+        :param lines:
+        :return:
+        """
+        read_list = []
+        for name, seq, index, qual in zip(lines[0::4], lines[1::4], lines[2::4], lines[3::4]):
+            seq = seq.strip()
+            qual = qual.strip()
 
-        if len(read_block) == 4 and not eof:
+            if len(seq) != len(qual):
+                msg = "Sequence and quality scores of different lengths! \n{0:s}\n{1:s}\n{2:s}\n{3:s}"\
+                    .format(name.strip("@"), seq, index.strip(), qual)
+                if self.log:
+                    self.log.error(msg)
+                raise ValueError(msg)
 
-            self.name = read_block[0].strip("\n").strip("@")
-            self.seq = read_block[1].strip("\n").strip()
-            self.index = read_block[2].strip("\n").strip()
-            self.qual = read_block[3].strip("\n").strip()
+            read_list.append(FastqRead(name.strip("@"), seq, index.strip(), qual))
 
-            if len(self.seq) != len(self.qual):
-                self.log.error("Sequence and quality scores of different lengths! \n{0:s}\n{1:s}\n{2:s}\n{3:s}"
-                               .format(self.name, self.seq, self.index, self.qual))
-                raise ValueError("Sequence and quality scores of different lengths! \n{0:s}\n{1:s}\n{2:s}\n{3:s}"
-                                 .format(self.name, self.seq, self.index, self.qual))
+        return read_list
+
+    def seq_read(self):
+        """
+        Generator returning the next read from the current block of reads.
+        """
+        if self.read_position >= len(self.read_block):
+            self.read_block = next(self.batches, [])
+            self.read_position = 0
+
+        if self.read_block:
+            read = self.read_block[self.read_position]
+            self.read_position += 1
+            self.name = read.name
+            self.seq = read.seq
+            self.index = read.index
+            self.qual = read.qual
             yield self
 
         # I am using this as my EOF.  Not so sure the code ever reaches this.
         self.name = None
 
 
+class PairedFastqReader:
+    """
+    Reads two to four FASTQ_Reader objects in lockstep.  Batches from the first file set the batch size; the other
+    files are sliced to match and the read names at both ends of every batch are compared.  Iterating yields lists of
+    tuples, one read from each file.
+    """
+    __slots__ = ['log', 'readers', 'check_names']
+
+    def __init__(self, log, fastq1, fastq2, index1=None, index2=None, check_names=True):
+        """
+        :param log:
+        :param fastq1: FASTQ_Reader for read 1.
+        :param fastq2: FASTQ_Reader for read 2.
+        :param index1: Optional FASTQ_Reader for index read 1.
+        :param index2: Optional FASTQ_Reader for index read 2.
+        :param check_names: Verify the first and last read names of each batch agree.
+        """
+        self.log = log
+        self.readers = [reader for reader in (fastq1, fastq2, index1, index2) if reader is not None]
+        self.check_names = check_names
+
+    @staticmethod
+    def read_id(name):
+        """
+        Returns the part of a read name shared by mates.  Comments after the first space and /1, /2 suffixes dropped.
+        :param name:
+        :return:
+        """
+        read_id = name.partition(" ")[0]
+        if read_id[-2:] in ("/1", "/2", "/3", "/4"):
+            read_id = read_id[:-2]
+        return read_id
+
+    def __name_check(self, reads):
+        """
+        Compare the read names of one tuple of reads.
+        :param reads:
+        """
+        read_id = self.read_id(reads[0].name)
+        for reader, read in zip(self.readers[1:], reads[1:]):
+            if self.read_id(read.name) != read_id:
+                self.log.error("FASTQ files out of sync.  {} in {} is paired with {} in {}."
+                               .format(reads[0].name, self.readers[0].file_name, read.name, reader.file_name))
+                raise SystemExit(1)
+
+    def __iter__(self):
+        mates = [itertools.chain.from_iterable(reader) for reader in self.readers[1:]]
+
+        for read_batch in self.readers[0]:
+            batch_size = len(read_batch)
+            mate_batches = [list(itertools.islice(mate, batch_size)) for mate in mates]
+
+            for reader, mate_batch in zip(self.readers[1:], mate_batches):
+                if len(mate_batch) != batch_size:
+                    self.log.error("{} has fewer reads than {}.".format(reader.file_name, self.readers[0].file_name))
+                    raise SystemExit(1)
+
+            paired_batch = list(zip(read_batch, *mate_batches))
+            if self.check_names and paired_batch:
+                self.__name_check(paired_batch[0])
+                self.__name_check(paired_batch[-1])
+
+            yield paired_batch
+
+        for reader, mate in zip(self.readers[1:], mates):
+            if next(mate, None) is not None:
+                self.log.error("{} has more reads than {}.".format(reader.file_name, self.readers[0].file_name))
+                raise SystemExit(1)
+
+
+class BatchPrefetcher:
+    """
+    Runs a batch generator on a background thread and hands the batches over through a bounded queue.  Reading and
+    parsing the next batches overlaps with whatever the caller does with the current one.  The producer blocks once
+    queue_depth batches are waiting.
+    """
+
+    def __init__(self, batches, queue_depth=4):
+        """
+        :param batches: Iterable of read batches, e.g. a FASTQ_Reader or PairedFastqReader.
+        :param queue_depth: Number of batches allowed to wait for the consumer.
+        """
+        self._batches = batches
+        self._queue = queue.Queue(maxsize=max(int(queue_depth), 1))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.__producer, daemon=True)
+        self._thread.start()
+
+    def __put(self, item):
+        """
+        Queue an item for the consumer, giving up if the prefetcher has been closed.
+        :param item:
+        :return:
+        """
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def __producer(self):
+        """
+        Pull batches from the wrapped iterable until it is exhausted or the consumer goes away.
+        """
+        try:
+            for batch in self._batches:
+                if not self.__put(batch):
+                    return
+            self.__put(None)
+        except BaseException as e:
+            # SystemExit raised after a logged error also has to reach the main thread.
+            self.__put(e)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            elif isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def close(self):
+        """
+        Stop the producer thread.
+        """
+        self._stop.set()
+        self._thread.join()
+
+
 def read_trim(fastq_read, trim5=None, trim3=None):
     """
     Provide additional trimming to reads beyond the adaptor trim.
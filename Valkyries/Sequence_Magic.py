@@ -7,11 +7,17 @@
 """
 
 from Levenshtein import distance
+from array import array
 import csv
+import os
+import pickle
+import shutil
+import tempfile
+import numpy
 from Valkyries.Tool_Box import deprecated
 
 __author__ = 'Dennis A. Simpson'
-__version__ = '0.2.1'
+__version__ = '0.2.2'
 
 
 @deprecated("Use function from Tool_Box")
@@ -134,3 +140,287 @@ def match_maker(query, unknown):
     adjusted_query_mismatch = query_mismatch-(len(unknown) - len(query))
 
     return adjusted_query_mismatch
+
+
+def mismatch_neighborhood(seq, mismatch=1, alphabet="ACGTN"):
+    """
+    Returns the set of sequences of the same length within the given number of substitutions of seq.  For sequences of
+    equal length this is everything match_maker() scores at or below mismatch.
+    :param seq:
+    :param mismatch:
+    :param alphabet:
+    :return:
+    """
+    neighborhood = {seq}
+    for _ in range(mismatch):
+        new_neighbors = set()
+        for neighbor in neighborhood:
+            for i, c in enumerate(neighbor):
+                for base in alphabet:
+                    if base != c:
+                        new_neighbors.add(neighbor[:i] + base + neighbor[i+1:])
+        neighborhood |= new_neighbors
+
+    return neighborhood
+
+
+class BarcodeMatrix:
+    """
+    Hamming distances between a block of barcodes and a fixed list of index sequences, all of one length, computed as
+    uint8 NumPy arrays.  For equal lengths a Hamming distance of 0 or 1 is the same as a match_maker() score of 0 or 1.
+    """
+
+    def __init__(self, index_list, block_size=65536):
+        """
+        :param index_list: Index sequences, all the same length.
+        :param block_size: Barcodes compared at a time, to bound the size of the temporary arrays.
+        """
+        self.length = len(index_list[0])
+        self.block_size = block_size
+        self.indices = numpy.frombuffer("".join(index_list).encode(), dtype=numpy.uint8)\
+            .reshape(len(index_list), self.length)
+
+    def distances(self, barcode_list):
+        """
+        Returns an array with one row per barcode and one column per index.
+        :param barcode_list: Barcodes, all self.length long.
+        :return:
+        """
+        barcodes = numpy.frombuffer("".join(barcode_list).encode(), dtype=numpy.uint8)\
+            .reshape(len(barcode_list), self.length)
+        distance_matrix = numpy.empty((len(barcode_list), len(self.indices)), dtype=numpy.uint8)
+
+        for start in range(0, len(barcode_list), self.block_size):
+            block = barcodes[start:start+self.block_size]
+            distance_matrix[start:start+len(block)] = \
+                (block[:, None, :] != self.indices[None, :, :]).sum(axis=2, dtype=numpy.uint8)
+
+        return distance_matrix
+
+
+class SeedMatcher:
+    """
+    Finds the queries that could be within mismatch edits of the start, or end, of a sequence.  Each query is cut into
+    mismatch + 1 seeds.  An alignment with at most mismatch edits leaves one seed intact, shifted by no more than
+    mismatch positions, so looking up every seed position and shift finds all true matches.  The candidates still
+    need to be checked with match_maker().
+    """
+
+    def __init__(self, query_dict, mismatch):
+        """
+        :param query_dict: Dictionary of name: query sequence.
+        :param mismatch: Edit distance allowed by the caller.
+        """
+        self.mismatch = mismatch
+        self.seed_dict = {}
+        self.segment_dict = {}
+
+        for name, query in query_dict.items():
+            length = len(query)
+            if length not in self.segment_dict:
+                seed_count = min(mismatch + 1, length)
+                self.segment_dict[length] = \
+                    [(length * i // seed_count, length * (i + 1) // seed_count - length * i // seed_count)
+                     for i in range(seed_count)]
+                self.seed_dict[length] = {}
+
+            for i, (start, seed_length) in enumerate(self.segment_dict[length]):
+                self.seed_dict[length].setdefault((i, query[start:start+seed_length]), set()).add(name)
+
+    def candidates(self, seq, from_end=False):
+        """
+        Names of the queries that share a seed with the matching stretch of seq.
+        :param seq:
+        :param from_end: Compare queries with the end of seq rather than the start.
+        :return:
+        """
+        candidate_set = set()
+        for length, segments in self.segment_dict.items():
+            window = seq[-length:] if from_end else seq[:length]
+            seed_dict = self.seed_dict[length]
+            for i, (start, seed_length) in enumerate(segments):
+                for shift in range(max(-self.mismatch, -start), self.mismatch + 1):
+                    names = seed_dict.get((i, window[start+shift:start+shift+seed_length]))
+                    if names:
+                        candidate_set |= names
+
+        return candidate_set
+
+
+class SequenceStore:
+    """
+    Compact list of DNA sequences.  Sequences are packed end to end in one buffer with an array of end offsets, which
+    avoids the per object overhead of millions of str objects and pickles as a few large blocks.  With two_bit=True
+    A, C, G and T are packed four to a byte and any other character, usually N, is kept in a per read mask.  spill()
+    moves the sequences held in memory to a temporary file; they are read back from it, in order, when iterating.
+    """
+    __slots__ = ['two_bit', 'data', 'ends', 'lengths', 'masks', 'spill_file', 'spill_count']
+
+    # Every byte value is mapped so characters int() would skip or misread, such as "_", " " or "-", become 0.
+    encode_table = {i: "0" for i in range(256)}
+    encode_table.update(str.maketrans("ACGT", "0123"))
+    strip_table = str.maketrans("", "", "ACGT")
+    decode_table = str.maketrans({"{:x}".format(i): "ACGT"[i >> 2] + "ACGT"[i & 3] for i in range(16)})
+
+    def __init__(self, sequences=None, two_bit=False):
+        """
+        :param sequences: Optional iterable of sequences to add.
+        :param two_bit: Pack bases in 2 bits rather than 1 byte.
+        """
+        self.two_bit = two_bit
+        self.data = bytearray()
+        self.ends = array('Q')
+        self.lengths = array('L')
+        self.masks = {}
+        self.spill_file = None
+        self.spill_count = 0
+
+        if sequences is not None:
+            self.extend(sequences)
+
+    def append(self, seq):
+        """
+        Add a sequence to the end of the store.
+        :param seq:
+        """
+        if not self.two_bit:
+            self.data += seq.encode()
+            self.ends.append(len(self.data))
+            return
+
+        length = len(seq)
+        digits = seq.translate(self.encode_table)
+
+        # Anything that is not A, C, G or T is stored as 0 and put back from the mask.
+        if seq.translate(self.strip_table):
+            self.masks[len(self.ends)] = [(i, c) for i, c in enumerate(seq) if c not in "ACGT"]
+
+        # Four bases to a byte.
+        digits += "0" * (-length % 4)
+
+        if digits:
+            self.data += bytes.fromhex("{:0{}x}".format(int(digits, 4), len(digits) // 2))
+        self.ends.append(len(self.data))
+        self.lengths.append(length)
+
+    def extend(self, sequences):
+        """
+        Add several sequences.  Another SequenceStore of the same kind is copied without unpacking.
+        :param sequences:
+        """
+        if isinstance(sequences, SequenceStore) and sequences.spill_file and sequences.two_bit == self.two_bit:
+            # The spill file of the other store is moved to this one.
+            if self.spill_file is None and not len(self.ends):
+                self.spill_file = sequences.spill_file
+            else:
+                self.spill(os.path.dirname(sequences.spill_file))
+                with open(self.spill_file, "ab") as spill, open(sequences.spill_file, "rb") as other_spill:
+                    shutil.copyfileobj(other_spill, spill)
+                os.remove(sequences.spill_file)
+            self.spill_count += sequences.spill_count
+            sequences.spill_file = None
+            sequences.spill_count = 0
+
+        if isinstance(sequences, SequenceStore) and sequences.two_bit == self.two_bit:
+            read_offset = len(self.ends)
+            data_offset = len(self.data)
+            self.data += sequences.data
+            self.ends.extend(end + data_offset for end in sequences.ends)
+            self.lengths.extend(sequences.lengths)
+            for read_number, mask in sequences.masks.items():
+                self.masks[read_number + read_offset] = mask
+        else:
+            for seq in sequences:
+                self.append(seq)
+
+    def __len__(self):
+        return self.spill_count + len(self.ends)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+
+        if item < 0:
+            item += len(self)
+        if item < 0 or item >= len(self):
+            raise IndexError("SequenceStore index out of range")
+
+        if item >= self.spill_count:
+            return self.__memory_item(item - self.spill_count)
+
+        # Spilled sequences are only reached by reading through the file.
+        for chunk in self.__spilled_chunks():
+            if item < len(chunk):
+                return chunk[item]
+            item -= len(chunk)
+
+    def __memory_item(self, item):
+        start = self.ends[item - 1] if item else 0
+        packed = self.data[start:self.ends[item]]
+        if not self.two_bit:
+            return packed.decode()
+
+        seq = packed.hex().translate(self.decode_table)[:self.lengths[item]]
+        if item in self.masks:
+            seq = list(seq)
+            for position, c in self.masks[item]:
+                seq[position] = c
+            seq = "".join(seq)
+
+        return seq
+
+    def __spilled_chunks(self):
+        if self.spill_file is None:
+            return
+
+        with open(self.spill_file, "rb") as spill:
+            while True:
+                try:
+                    yield pickle.load(spill)
+                except EOFError:
+                    break
+
+    def __iter__(self):
+        for chunk in self.__spilled_chunks():
+            yield from chunk
+        for i in range(len(self.ends)):
+            yield self.__memory_item(i)
+
+    def spill(self, directory=None):
+        """
+        Append the sequences held in memory to this store's temporary file, creating it in directory if needed.
+        :param directory:
+        """
+        if not len(self.ends):
+            return
+
+        if self.spill_file is None:
+            handle, self.spill_file = tempfile.mkstemp(suffix=".spill", dir=directory)
+            os.close(handle)
+
+        chunk = SequenceStore(two_bit=self.two_bit)
+        chunk.data, chunk.ends, chunk.lengths, chunk.masks = self.data, self.ends, self.lengths, self.masks
+        with open(self.spill_file, "ab") as spill:
+            pickle.dump(chunk, spill, pickle.HIGHEST_PROTOCOL)
+
+        self.spill_count += len(self.ends)
+        self.data = bytearray()
+        self.ends = array('Q')
+        self.lengths = array('L')
+        self.masks = {}
+
+    def discard(self):
+        """
+        Delete the temporary file.  The spilled sequences are lost.
+        """
+        if self.spill_file is not None and os.path.isfile(self.spill_file):
+            os.remove(self.spill_file)
+        self.spill_file = None
+        self.spill_count = 0
+
+    def nbytes(self):
+        """
+        Approximate memory used by the packed data held in memory.
+        :return:
+        """
+        return len(self.data) + self.ends.itemsize * len(self.ends) + self.lengths.itemsize * len(self.lengths)
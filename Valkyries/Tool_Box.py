@@ -38,6 +38,10 @@ import getpass
 import socket
 import logging
 import gzip
+import heapq
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from contextlib import suppress
 import re
@@ -140,20 +144,150 @@ def sort_dict(key_counts):
     return sorted(key_counts.items(), key=lambda x: (-1 * x[1], x[0]))
 
 
-def compress_files(file, log):
+# Empty BGZF block that marks the end of a BGZF file.
+BGZF_EOF = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00" \
+           b"\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def gzip_block(data, level=6, bgzf=False):
+    """
+    Compress data into one or more self-contained gzip members.  Concatenated members are a valid gzip file so blocks
+    can be compressed independently and written in order.  BGZF output is split into blocks of at most 65280 bytes.
+    :param data:
+    :param level:
+    :param bgzf:
+    :return:
+    """
+    if bgzf and len(data) > 65280:
+        return b"".join(gzip_block(data[i:i+65280], level, bgzf) for i in range(0, len(data), 65280))
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    trailer = struct.pack("<II", zlib.crc32(data), len(data) & 0xffffffff)
+
+    if bgzf:
+        header = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00" + struct.pack("<H", len(cdata) + 25)
+    else:
+        header = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+    return header + cdata + trailer
+
+
+class Compressor:
+    """
+    In-process gzip/BGZF compression.  Files are read in chunks and each chunk is compressed as an independent gzip
+    member on a thread pool; zlib releases the GIL so the threads run in parallel.
+    """
+
+    def __init__(self, log, level=6, threads=1, bgzf=False, chunk_size=4194304):
+        """
+        :param log:
+        :param level: zlib compression level, 1-9.
+        :param threads:
+        :param bgzf: Write BGZF instead of plain gzip.
+        :param chunk_size: Bytes of input handed to each thread.
+        """
+        self.log = log
+        self.level = int(level)
+        self.threads = max(int(threads), 1)
+        self.bgzf = bgzf
+        self.chunk_size = chunk_size
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+
+    def compress(self, data):
+        """
+        Compress a block of data on the calling thread.
+        :param data:
+        :return:
+        """
+        return gzip_block(data, self.level, self.bgzf)
+
+    def submit(self, data):
+        """
+        Compress a block of data on the thread pool.  Returns a future.
+        :param data:
+        :return:
+        """
+        return self.pool.submit(gzip_block, data, self.level, self.bgzf)
+
+    def compress_file(self, file):
+        """
+        Compress file to file.gz and delete the original, like gzip does.
+        :param file:
+        :return: Size of the input and output in bytes.
+        """
+        out_file = file + ".gz"
+        delete([out_file])  # if the compressed file already exists we need to delete it first.
+        in_size = 0
+        pending = collections.deque()
+
+        with open(file, 'rb') as infile, open(out_file, 'wb') as outfile:
+            while True:
+                data = infile.read(self.chunk_size)
+                if not data:
+                    break
+                in_size += len(data)
+                pending.append(self.submit(data))
+
+                # Keep a bounded number of blocks in flight and write them in order.
+                if len(pending) > self.threads * 2:
+                    outfile.write(pending.popleft().result())
+
+            while pending:
+                outfile.write(pending.popleft().result())
+
+            if self.bgzf:
+                outfile.write(BGZF_EOF)
+
+            out_size = outfile.tell()
+
+        delete([file])
+
+        return in_size, out_size
+
+    def compress_file_list(self, file_list):
+        """
+        Compress each file in the list and report throughput.
+        :param file_list:
+        """
+        start_time = time.time()
+        total_in = 0
+        total_out = 0
+        for file in file_list:
+            if not os.path.isfile(file):
+                self.log.warning("{} not found.  Unable to compress.".format(file))
+                continue
+
+            file_start = time.time()
+            in_size, out_size = self.compress_file(file)
+            total_in += in_size
+            total_out += out_size
+            self.log.debug("{} Compressed; {:.1f} Mb to {:.1f} Mb in {:.1f} seconds"
+                           .format(file, in_size/1048576, out_size/1048576, time.time()-file_start))
+
+        elapsed_time = max(time.time()-start_time, 1e-6)
+        self.log.info("Compressed {} files; {:.1f} Mb to {:.1f} Mb in {:.1f} seconds ({:.1f} Mb/s)"
+                      .format(len(file_list), total_in/1048576, total_out/1048576, elapsed_time,
+                              total_in/1048576/elapsed_time))
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+def compress_files(file, log, level=6, threads=1, bgzf=False):
     """
-    This function will compress our files.  Takes a very long time.
-    :param file:
+    This function will compress our files in-process.
+    :param file: A file name or a list of file names.
     :param log:
+    :param level:
+    :param threads:
+    :param bgzf:
     :return:
     """
-    # ToDo: Consider allowing user access to gzip compression level.
-    if os.path.isfile(file):
-        exists_list = [file + ".gz"]
-        delete(exists_list)  # if the compressed file already exists we need to delete it first.
-    cmd = "gzip -9 " + file
-    os.system(cmd)
-    log.debug("{0} Compressed".format(file))
+    file_list = [file] if isinstance(file, str) else file
+    compressor = Compressor(log, level, threads, bgzf)
+    compressor.compress_file_list(file_list)
+    compressor.close()
 
     return
 
@@ -194,6 +328,89 @@ class VivifiedDictionary(dict):
         return value
 
 
+class SpaceSaving:
+    """
+    Space-Saving heavy hitter counter (Metwally, Agrawal and El Abbadi, 2005).  At most capacity items are kept; a new
+    item replaces the one with the lowest count and takes over that count as its error.  A count is never below the
+    true count and is over by no more than the error.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.heap = []
+
+    def add(self, item, count=1, error=0):
+        """
+        Count item.
+        :param item:
+        :param count:
+        :param error: Overcount already carried by count, used when merging.
+        """
+        if item in self.counts:
+            self.counts[item] += count
+            self.errors[item] += error
+            return
+
+        if len(self.counts) < self.capacity:
+            self.counts[item] = count
+            self.errors[item] = error
+            heapq.heappush(self.heap, (count, item))
+            return
+
+        # Heap entries are not updated when an item is counted so stale entries are refreshed until the top is current.
+        while True:
+            low_count, low_item = self.heap[0]
+            if self.counts[low_item] == low_count:
+                break
+            heapq.heapreplace(self.heap, (self.counts[low_item], low_item))
+
+        del self.counts[low_item]
+        del self.errors[low_item]
+        self.counts[item] = low_count + count
+        self.errors[item] = low_count + error
+        heapq.heapreplace(self.heap, (low_count + count, item))
+
+    def floor(self):
+        """
+        :return: Largest count an item missing from a full counter can have, 0 if the counter is not full.
+        """
+        if len(self.counts) < self.capacity:
+            return 0
+
+        return min(self.counts.values())
+
+    def merge(self, other):
+        """
+        Add the counts of another SpaceSaving (Agarwal et al., Mergeable Summaries, 2012).  An item missing from one
+        counter is given that counter's floor as both count and error, then the capacity highest counts are kept.
+        :param other:
+        """
+        floor = self.floor()
+        other_floor = other.floor()
+
+        counts = {}
+        errors = {}
+        for item in self.counts.keys() | other.counts.keys():
+            counts[item] = self.counts.get(item, floor) + other.counts.get(item, other_floor)
+            errors[item] = self.errors.get(item, floor) + other.errors.get(item, other_floor)
+
+        kept = heapq.nlargest(self.capacity, counts, key=lambda k: (counts[k], k))
+        self.counts = {item: counts[item] for item in kept}
+        self.errors = {item: errors[item] for item in kept}
+        self.heap = [(count, item) for item, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def most_common(self, n):
+        """
+        :param n:
+        :return: List of the n highest (item, count, error) tuples.
+        """
+        items = sorted(self.counts, key=lambda k: (-self.counts[k], k))[:n]
+
+        return [(item, self.counts[item], self.errors[item]) for item in items]
+
+
 class CoverageCalculator:
     """
     This class will calculate the coverage depth and breadth from a sorted, indexed BAM file and a region of interest.
@@ -0,0 +1,90 @@
+"""
+Tests for FASTQ_Tools.  Run with "python3 -m pytest" from the top of the repository.
+"""
+
+import random
+import pytest
+from Valkyries import FASTQ_Tools, Tool_Box
+
+
+def random_records(count, seed=1):
+    """
+    FASTQ records of varied length.  Quality strings include "@" and "+" so shard boundaries have to be found from the
+    record layout.
+    :param count:
+    :param seed:
+    :return: List of (name, seq, qual) tuples.
+    """
+    rng = random.Random(seed)
+    records = []
+    for i in range(count):
+        length = rng.randint(40, 160)
+        seq = "".join(rng.choice("ACGTN") for _ in range(length))
+        qual = "".join(rng.choice("!+5@AFJ") for _ in range(length))
+        records.append(("read{}".format(i), seq, qual))
+
+    return records
+
+
+def fastq_text(records):
+    return "".join("@{}\n{}\n+\n{}\n".format(name, seq, qual) for name, seq, qual in records)
+
+
+def shard_records(input_file, shard_count):
+    """
+    Read every shard of input_file with FASTQ_Reader and return the records in shard order.
+    """
+    shards = FASTQ_Tools.fastq_shards(input_file, shard_count)
+    records = []
+    for byte_range in shards:
+        for read_batch in FASTQ_Tools.FASTQ_Reader(input_file, byte_range=byte_range, block_size=4096):
+            records.extend((read.name, read.seq, read.qual) for read in read_batch)
+
+    return shards, records
+
+
+@pytest.mark.parametrize("shard_count", [2, 3, 7, 16])
+def test_plain_shards_rebuild_file(tmp_path, shard_count):
+    records = random_records(3000)
+    input_file = str(tmp_path / "reads.fastq")
+    with open(input_file, "w") as f:
+        f.write(fastq_text(records))
+
+    shards, shard_list = shard_records(input_file, shard_count)
+
+    assert len(shards) == shard_count
+    assert shard_list == records
+
+
+@pytest.mark.parametrize("shard_count", [2, 3, 7, 16])
+def test_bgzf_shards_rebuild_file(tmp_path, shard_count):
+    records = random_records(3000)
+    input_file = str(tmp_path / "reads.fastq.gz")
+    with open(input_file, "wb") as f:
+        f.write(Tool_Box.gzip_block(fastq_text(records).encode(), bgzf=True))
+        f.write(Tool_Box.gzip_block(b"", bgzf=True))
+
+    shards, shard_list = shard_records(input_file, shard_count)
+
+    assert len(shards) > 1
+    assert shard_list == records
+
+
+def test_gzip_is_not_sharded(tmp_path):
+    input_file = str(tmp_path / "reads.fastq.gz")
+    with open(input_file, "wb") as f:
+        f.write(Tool_Box.gzip_block(fastq_text(random_records(100)).encode()))
+
+    assert FASTQ_Tools.fastq_shards(input_file, 4) is None
+
+
+def test_more_shards_than_records(tmp_path):
+    records = random_records(3)
+    input_file = str(tmp_path / "reads.fastq")
+    with open(input_file, "w") as f:
+        f.write(fastq_text(records))
+
+    shards, shard_list = shard_records(input_file, 10)
+
+    assert len(shards) <= 3
+    assert shard_list == records
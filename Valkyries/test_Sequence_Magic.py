@@ -0,0 +1,111 @@
+"""
+Tests for Sequence_Magic.  Run with "python3 -m pytest" from the top of the repository.
+"""
+
+import pickle
+import random
+import pytest
+from Valkyries.Sequence_Magic import SequenceStore
+
+
+def random_sequences(count, seed=1, alphabet="ACGT"):
+    rng = random.Random(seed)
+    return ["".join(rng.choice(alphabet) for _ in range(rng.randint(0, 60))) for _ in range(count)]
+
+
+@pytest.mark.parametrize("two_bit", [False, True])
+def test_round_trip(two_bit):
+    sequences = random_sequences(500) + random_sequences(500, seed=2, alphabet="ACGTN")
+    store = SequenceStore(sequences, two_bit=two_bit)
+
+    assert len(store) == len(sequences)
+    assert list(store) == sequences
+    assert [store[i] for i in range(len(store))] == sequences
+    assert store[-1] == sequences[-1]
+    assert store[10:20] == sequences[10:20]
+
+    with pytest.raises(IndexError):
+        store[len(sequences)]
+
+
+@pytest.mark.parametrize("seq", ["ACG_T", "GATTACA ", " GATTACA", "-ACG", "+ACG", "acgtn", "ACGT0123", "A9T",
+                                 "NNNN", "", "A", "ACGTACGTA", "ACGT\tACGT"])
+def test_two_bit_unusual_characters(seq):
+    """
+    int(digits, 4) accepts separators, whitespace and signs, so every character has to be packed as a digit.
+    """
+    store = SequenceStore(["ACGT", seq, "TTTT"], two_bit=True)
+
+    assert list(store) == ["ACGT", seq, "TTTT"]
+
+
+@pytest.mark.parametrize("two_bit", [False, True])
+def test_pickle(two_bit):
+    sequences = random_sequences(200, alphabet="ACGTN")
+    store = pickle.loads(pickle.dumps(SequenceStore(sequences, two_bit=two_bit)))
+
+    assert list(store) == sequences
+
+
+@pytest.mark.parametrize("two_bit", [False, True])
+def test_extend_with_store(two_bit):
+    first = random_sequences(100, seed=1, alphabet="ACGTN")
+    second = random_sequences(100, seed=2, alphabet="ACGTN")
+    store = SequenceStore(first, two_bit=two_bit)
+    store.extend(SequenceStore(second, two_bit=two_bit))
+
+    assert list(store) == first + second
+
+    # A store of the other kind is unpacked read by read.
+    store.extend(SequenceStore(first, two_bit=not two_bit))
+
+    assert list(store) == first + second + first
+
+
+@pytest.mark.parametrize("two_bit", [False, True])
+def test_spill_round_trip(tmp_path, two_bit):
+    sequences = random_sequences(300, alphabet="ACGTN")
+    store = SequenceStore(sequences[:100], two_bit=two_bit)
+    store.spill(str(tmp_path))
+    store.extend(sequences[100:200])
+    store.spill(str(tmp_path))
+    store.extend(sequences[200:])
+
+    assert store.nbytes() < SequenceStore(sequences, two_bit=two_bit).nbytes()
+    assert len(store) == len(sequences)
+    assert list(store) == sequences
+    assert store[50] == sequences[50]
+    assert store[150] == sequences[150]
+    assert store[-1] == sequences[-1]
+    assert store[95:105] == sequences[95:105]
+
+    store.discard()
+
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("two_bit", [False, True])
+def test_extend_with_spilled_store(tmp_path, two_bit):
+    first = random_sequences(100, seed=1, alphabet="ACGTN")
+    second = random_sequences(100, seed=2, alphabet="ACGTN")
+    third = random_sequences(100, seed=3, alphabet="ACGTN")
+
+    # The spill file moves to an empty store.
+    spilled = SequenceStore(first, two_bit=two_bit)
+    spilled.spill(str(tmp_path))
+    spilled.extend(second)
+    store = SequenceStore(two_bit=two_bit)
+    store.extend(spilled)
+
+    assert list(store) == first + second
+
+    # A store that already holds reads spills them and appends the other spill file.
+    spilled = SequenceStore(third, two_bit=two_bit)
+    spilled.spill(str(tmp_path))
+    store.extend(spilled)
+
+    assert len(store) == 300
+    assert list(store) == first + second + third
+    assert len(list(tmp_path.iterdir())) == 1
+
+    store.discard()
@@ -20,8 +20,24 @@ exit
 --Spawn	3 # How many parallel jobs?  Max should be n-1 threads or cpu's.  Minimum is 1.
 --Demultiplex	# True or False.  Write demultiplexed FASTQ files?
 --DeleteConsensusFASTQ	True
---HR_Donor	# 10 - 15 nucleotide sequence for HR Donor search.  Can be left blank. 
+--CompressionLevel	# Optional.  gzip compression level 1-9 for FASTQ output.  Default 6.
+--CompressionThreads	# Optional.  Threads used to compress FASTQ output.  Default is --Spawn.
+--BGZF	# Optional.  True or False.  Write block gzip (BGZF) instead of plain gzip.
+--HR_Donor	# 10 - 15 nucleotide sequence for HR Donor search.  Several donors can be separated by commas.  Can be left blank. 
+--HR_DonorRcomp	# Optional.  True or False.  Also search for the reverse complement of each HR Donor.
 --Platform	# Illumina, Ramsden
+--DecompressThreads	# Optional.  Threads used to decompress gzip FASTQ input.  Blank or 0 decompresses inline.
+--DemultiplexShards	# Optional.  Pieces the consensus FASTQ is split into and demultiplexed in parallel.  Default is --Spawn, 0 or 1 for none.
+--PrefetchDepth	# Optional.  FASTQ batches read ahead on a background thread.  Blank or 0 reads inline.
+--SequencePacking	# Optional.  Byte or TwoBit.  How demultiplexed reads are held in memory.  Default Byte.
+--FastqIndex	# Optional.  True or False.  Write a .fqi read count and offset index next to the FASTQ for later runs.
+--IndexEngine	# Optional.  Table, NumPy or Scan.  How Illumina header barcodes are matched to indices.  Default Table.
+--Pipeline	# Optional.  True or False.  Search libraries for scars while the FASTQ is still being demultiplexed.
+--MemoryBudget	# Optional.  Megabytes of demultiplexed reads held in memory before libraries are moved to temporary files.  Default 0, no limit.
+--UnknownBarcodes	# Optional.  Number of the most common unidentified barcodes listed in the summary file.  Default 10, 0 for none.
+--WindowEngine	# Optional.  Kernel, Hash or Scan.  How read windows are matched to the target region.  Default Kernel.
+--JunctionCache	# Optional.  SQLite file of junction search results reused by later runs.  Blank for none.
+--JunctionCacheSize	# Optional.  Most sequences kept in --JunctionCache, least recently used removed first.  Default 1000000.
 
 --N_Limit	0.01
 --Minimum_Length	100	# Length after trimming
@@ -7,14 +7,12 @@
 import csv
 import datetime
 import glob
-import itertools
 import os
 import collections
 import subprocess
 import argparse
 import sys
 import time
-import pathos
 from natsort import natsort
 from scipy import stats
 from distutils.util import strtobool
@@ -191,12 +189,12 @@ def main(command_line_args=None):
                     raise SystemExit(1)
                 fastq_consensus = file_list[0]
 
-                fq1 = FASTQ_Tools.FASTQ_Reader(fastq_consensus, log)
+                fq1 = FASTQ_Tools.FASTQ_Reader(fastq_consensus, log, memory_map=True)
                 fq2 = None
 
             else:
-                fq2 = FASTQ_Tools.FASTQ_Reader(args.FASTQ2, log)
-                fq1 = FASTQ_Tools.FASTQ_Reader(args.FASTQ1, log)
+                fq2 = FASTQ_Tools.FASTQ_Reader(args.FASTQ2, log, threads=args.DecompressThreads)
+                fq1 = FASTQ_Tools.FASTQ_Reader(args.FASTQ1, log, threads=args.DecompressThreads)
 
             sample_manifest = Tool_Box.FileParser.indices(log, args.SampleManifest)
             indel_processing = \
@@ -212,8 +210,7 @@ def main(command_line_args=None):
                     Tool_Box.delete(file_list)
                 else:
                     log.info("Compressing {} FASTQ Files Generated by PEAR.".format(len(file_list)))
-                    p = pathos.multiprocessing.Pool(int(args.Spawn))
-                    p.starmap(Tool_Box.compress_files, zip(file_list, itertools.repeat(log)))
+                    Tool_Box.compress_files(file_list, log, args.CompressionLevel, args.CompressionThreads, args.BGZF)
         else:
             log.error("Only 'Illumina' or 'Ramsden' --Platform methods currently allowed.")
             raise SystemExit(1)
@@ -408,6 +405,26 @@ def error_checking(args):
               .format(args.FASTQ2))
         raise SystemExit(1)
 
+    if getattr(args, "IndexEngine", "Table") not in ("Table", "NumPy", "Scan"):
+        print("\033[1;31mERROR:\n\t--IndexEngine: {} is not Table, NumPy or Scan.  Check Options File."
+              .format(args.IndexEngine))
+        raise SystemExit(1)
+
+    if getattr(args, "WindowEngine", "Kernel") not in ("Kernel", "Hash", "Scan"):
+        print("\033[1;31mERROR:\n\t--WindowEngine: {} is not Kernel, Hash or Scan.  Check Options File."
+              .format(args.WindowEngine))
+        raise SystemExit(1)
+
+    if getattr(args, "JunctionCache", "") and not os.path.isdir(os.path.dirname(os.path.abspath(args.JunctionCache))):
+        print("\033[1;31mERROR:\n\t--JunctionCache: folder for {} Not Found.  Check Options File."
+              .format(args.JunctionCache))
+        raise SystemExit(1)
+
+    if getattr(args, "HR_Donor", "") and set(args.HR_Donor) - set("ACGTN,"):
+        print("\033[1;31mERROR:\n\t--HR_Donor: {} is not a comma separated list of DNA sequences.  Check Options File."
+              .format(args.HR_Donor))
+        raise SystemExit(1)
+
     return args
 
 
@@ -426,6 +443,22 @@ def string_to_boolean(parser):
         options_parser.set_defaults(Demultiplex=bool(strtobool(args.Demultiplex)))
         options_parser.set_defaults(OutputRawData=bool(strtobool(args.OutputRawData)))
         options_parser.set_defaults(DeleteConsensusFASTQ=bool(strtobool(args.DeleteConsensusFASTQ)))
+        options_parser.set_defaults(DecompressThreads=int(getattr(args, "DecompressThreads", 0) or 0))
+        options_parser.set_defaults(CompressionLevel=int(getattr(args, "CompressionLevel", 6) or 6))
+        options_parser.set_defaults(CompressionThreads=int(getattr(args, "CompressionThreads", 0) or args.Spawn))
+        options_parser.set_defaults(BGZF=bool(strtobool(getattr(args, "BGZF", "False") or "False")))
+        options_parser.set_defaults(DemultiplexShards=int(getattr(args, "DemultiplexShards", "") or args.Spawn))
+        options_parser.set_defaults(PrefetchDepth=int(getattr(args, "PrefetchDepth", 0) or 0))
+        options_parser.set_defaults(SequencePacking=getattr(args, "SequencePacking", "Byte") or "Byte")
+        options_parser.set_defaults(FastqIndex=bool(strtobool(getattr(args, "FastqIndex", "False") or "False")))
+        options_parser.set_defaults(IndexEngine=getattr(args, "IndexEngine", "Table") or "Table")
+        options_parser.set_defaults(Pipeline=bool(strtobool(getattr(args, "Pipeline", "False") or "False")))
+        options_parser.set_defaults(MemoryBudget=int(getattr(args, "MemoryBudget", 0) or 0))
+        options_parser.set_defaults(UnknownBarcodes=int(getattr(args, "UnknownBarcodes", "10") or "10"))
+        options_parser.set_defaults(WindowEngine=getattr(args, "WindowEngine", "Kernel") or "Kernel")
+        options_parser.set_defaults(HR_DonorRcomp=bool(strtobool(getattr(args, "HR_DonorRcomp", "False") or "False")))
+        options_parser.set_defaults(JunctionCache=getattr(args, "JunctionCache", "") or "")
+        options_parser.set_defaults(JunctionCacheSize=int(getattr(args, "JunctionCacheSize", 1000000) or 1000000))
 
     options_parser.set_defaults(IndelProcessing=bool(strtobool(args.IndelProcessing)))
     options_parser.set_defaults(Verbose=args.Verbose.upper())
@@ -6,11 +6,17 @@
 """
 import collections
 import datetime
+import hashlib
 import itertools
+import json
+import os
+import queue
+import sqlite3
 import subprocess
 import time
+from array import array
+import numpy
 import pathos
-import pysam
 from scipy import stats
 from natsort import natsort
 import statistics
@@ -18,13 +24,16 @@ from Valkyries import Tool_Box, Sequence_Magic, FASTQ_Tools
 from scarmapper import SlidingWindow, ScarMapperPlot
 
 __author__ = 'Dennis A. Simpson'
-__version__ = '0.20.0'
+__version__ = '0.32.0'
 __package__ = 'ScarMapper'
 
 
 class ScarSearch:
+    # Reads of a library searched together by data_processing().
+    block_size = 1000000
+
     def __init__(self, log, args, version, run_start, target_dict, index_dict, index_name, sequence_list,
-                 indexed_read_count, lower_limit_count):
+                 indexed_read_count, lower_limit_count, target_bundle=None):
         self.log = log
         self.args = args
         self.version = version
@@ -36,6 +45,7 @@ class ScarSearch:
         self.lower_limit_count = lower_limit_count
         self.indexed_read_count = indexed_read_count
         self.summary_data = None
+        self.target_bundle = target_bundle
         self.target_region = ""
         self.cutsite = None
         self.lower_limit = None
@@ -43,151 +53,424 @@ class ScarSearch:
         self.target_length = None
         self.left_target_windows = []
         self.right_target_windows = []
+        self.left_window_dict = {}
+        self.right_window_dict = {}
+        self.target_windows = None
+        self.wild_type_sequences = set()
+        self.wild_type_count = 0
+        self.junction_cache = None
+        self.junction_cache_key = None
         '''
         if self.target_dict[index_dict[index_name][7]][5] == "YES":
             self.hr_donor = Sequence_Magic.rcomp(args.HR_Donor)
         else:
             self.hr_donor = args.HR_Donor
         '''
-        self.hr_donor = args.HR_Donor
-        self.data_processing()
-
-    def window_mapping(self):
+        self.hr_donors = hr_donor_list(args)
+        self.hr_donor = SlidingWindow.DonorScanner(self.hr_donors) if self.hr_donors else None
+        self.target_name = index_dict[index_name][7]
+        self.ready = False
+        self.junction_type_data = [0, 0, 0, 0, 0]
+        self.read_results_list = []
+        self.results_freq_dict = collections.defaultdict(list)
+        self.loop_count = 0
+        self.start_time = time.time()
+        self.split_time = self.start_time
+
+        # The streaming pipeline passes no sequence list and feeds the reads to add_reads() as they are found.
+        if sequence_list is not None:
+            self.data_processing()
+
+    def wild_type_reads(self, sequences, sequence_counts):
         """
-        Predetermine all the sliding window results for the target region.
+        Count the reads that match a known wild type sequence as no cut reads.
+        :param sequences: Distinct sequences to check.
+        :param sequence_counts: Dictionary of sequence: read count.
+        :return: Set of the sequences counted.
         """
+        wild_type = {seq for seq in sequences if seq in self.wild_type_sequences}
+        wild_type_count = sum(sequence_counts[seq] for seq in wild_type)
 
-        self.target_length = len(self.target_region)
+        self.progress(wild_type_count)
+        self.summary_data[6][1] += wild_type_count
+        self.wild_type_count += wild_type_count
 
-        # Set upper and lower limit to be 5 nt from end of primers
-        self.lower_limit = 15
-        self.upper_limit = self.target_length-15
-        lft_position = self.cutsite-10
-        rt_position = self.cutsite
+        return wild_type
 
-        while rt_position > self.lower_limit:
-            self.left_target_windows.append(self.target_region[lft_position:rt_position])
-            lft_position -= 1
-            rt_position -= 1
-
-        lft_position = self.cutsite
-        rt_position = self.cutsite+10
-        while lft_position < self.upper_limit:
-            self.right_target_windows.append(self.target_region[lft_position:rt_position])
-            lft_position += 1
-            rt_position += 1
+    def wild_type_found(self, seq):
+        """
+        Remember a read the search found to be no cut with no HR donor so later copies take the fast path.  The set is
+        capped to bound memory in the streaming pipeline.
+        :param seq:
+        """
+        if len(self.wild_type_sequences) < 100000:
+            self.wild_type_sequences.add(seq)
 
     def data_processing(self):
         """
         Generate the consensus sequence and find indels.  Write the frequency file.  Called by pathos pool
         :return:
         """
+        if self.setup():
+            # The library is searched a block at a time so a spilled SequenceStore is never read back into memory whole.
+            reads = iter(self.sequence_list)
+            while True:
+                read_block = list(itertools.islice(reads, self.block_size))
+                if not read_block:
+                    break
+                self.add_reads(read_block)
+            self.finish()
+
+        # Libraries spilled to disk by --MemoryBudget are not needed again.
+        if isinstance(self.sequence_list, Sequence_Magic.SequenceStore):
+            self.sequence_list.discard()
+
+        return self.summary_data
+
+    def setup(self):
+        """
+        Take the target region, cutsite and search tables from the locus TargetBundle.  Returns False if the target is
+        not usable.
+        :return:
+        """
 
         self.log.info("Begin Processing {}".format(self.index_name))
         """
         Summary_Data List: index_name, total aberrant, left deletions, right deletions, total deletions, left 
         insertions, right insertions, total insertions, microhomology, number filtered, target_name
         """
-        target_name = self.index_dict[self.index_name][7]
-        self.summary_data = [self.index_name, 0, 0, 0, 0, 0, [0, 0], [0, 0], 'junction data', target_name, [0, 0]]
-        junction_type_data = [0, 0, 0, 0, 0]
-        read_results_list = []
-        results_freq_dict = collections.defaultdict(list)
-        refseq = pysam.FastaFile(self.args.RefSeq)
+        target_name = self.target_name
+        self.summary_data = [self.index_name, 0, 0, 0, 0, 0, [0, 0], [0, 0], 'junction data', target_name, [0, 0],
+                             [[0, 0] for _ in self.hr_donors]]
+        bundle = self.target_bundle
 
-        try:
-            # Get the genomic 5' coordinate of the reference target region.
-            start = int(self.target_dict[target_name][2])
-        except IndexError:
+        if bundle is None:
             self.log.error("Target file incorrectly formatted for {}".format(target_name))
+            return False
+
+        self.target_region = bundle.target_region
+        self.cutsite = bundle.cutsite
+        self.target_length = len(bundle.target_region)
+        self.lower_limit = bundle.lower_limit
+        self.upper_limit = bundle.upper_limit
+        self.left_target_windows = bundle.left_target_windows
+        self.right_target_windows = bundle.right_target_windows
+        self.left_window_dict = bundle.left_window_dict
+        self.right_window_dict = bundle.right_window_dict
+        self.target_windows = bundle.target_windows
+
+        # Copied as the no cut reads found for this library are added to it.
+        self.wild_type_sequences = set(bundle.wild_type_sequences)
+        self.start_time = time.time()
+        self.split_time = self.start_time
+        self.ready = True
+
+        return True
+
+    def add_reads(self, sequence_list):
+        """
+        Search a group of consensus reads for repair scars.  May be called any number of times between setup() and
+        finish().
+        :param sequence_list:
+        """
+        if not self.ready:
             return
 
-        # Get the genomic 3' coordinate of the reference target region.
-        stop = int(self.target_dict[target_name][3])
+        read_results_list = self.read_results_list
+        left_target_windows = self.left_target_windows
+        right_target_windows = self.right_target_windows
+        if self.args.WindowEngine == "Hash":
+            left_target_windows = self.left_window_dict
+            right_target_windows = self.right_window_dict
 
-        chrm = self.target_dict[target_name][1]
+        # Amplicon libraries are mostly copies of a few sequences so each distinct sequence is only searched once.
+        sequence_counts = collections.Counter(sequence_list)
 
-        # Get the sequence of the sgRNA.
-        sgrna = self.target_dict[target_name][4]
-        self.target_region = refseq.fetch(chrm, start, stop)
-        Tool_Box.debug_messenger([target_name, self.target_region])
-        self.cutsite_search(target_name, sgrna, chrm, start, stop)
-        self.window_mapping()
-        loop_count = 0
-        start_time = time.time()
-        split_time = start_time
+        # Each step returns the sequences it has counted and the rest go on to the next.
+        filtered = self.read_filters(sequence_counts)
+        sequences = [seq for seq in sequence_counts if seq not in filtered]
 
-        # Extract and process read 1 and read 2 from our list of sequences.
-        for seq in self.sequence_list:
-            loop_count += 1
+        # Unedited reads are counted without a search.
+        wild_type = self.wild_type_reads(sequences, sequence_counts)
+        sequences = [seq for seq in sequences if seq not in wild_type]
+
+        # As are reads found in the junction cache from an earlier run.
+        search_results = self.cached_reads(sequences, sequence_counts)
+        sequences = [seq for seq in sequences if seq not in search_results]
+
+        if self.args.WindowEngine == "Kernel":
+            new_results = self.batch_search(sequences, sequence_counts)
+        else:
+            new_results = self.read_search(sequences, sequence_counts, left_target_windows, right_target_windows)
+
+        if self.junction_cache is not None:
+            self.junction_cache.store(self.junction_cache_key, new_results)
+        search_results.update(new_results)
 
-            if loop_count % 5000 == 0:
+        # Scars are added in the order each sequence was first read so the first read of each scar type is the one
+        # written to the frequency file.  The raw data file gets a line for every read, with the copies of a sequence
+        # together.
+        for seq, read_count in sequence_counts.items():
+            sub_list = search_results[seq][1] if seq in search_results else None
+            if sub_list:
+                self.scar_found(sub_list, read_count)
+                if self.args.OutputRawData:
+                    read_results_list.extend([sub_list] * read_count)
+
+    def read_filters(self, sequence_counts):
+        """
+        Count the sequences with too many N's, or that are too short, as filtered.  The other reads are counted as
+        passing the filters.
+        :param sequence_counts: Dictionary of sequence: read count.
+        :return: Set of the filtered sequences.
+        """
+        n_limit = float(self.args.N_Limit)
+        minimum_length = int(self.args.Minimum_Length)
+
+        '''
+        The summary_data list contains information for a single library.  [0] index name; [1] reads passing all 
+        filters; [2] left junction count; [3] right junction count; [4] insertion count; [5] microhomology count; 
+        [6] [No junction count, no cut count]; [7] [consensus N + short filtered count, unused]; 
+        [8] junction_type_data list; [9] target name; 10 [HR left junction count, HR right junction count];
+        [11] [HR first copy count, HR repeat count] for each donor
+
+        The junction_type_data list contains the repair type category counts.  [0] TMEJ, del_size >= 4 and 
+        microhomology_size >= 2; [1] NHEJ, del_size < 4 and ins_size < 5; [2] insertions >= 5 
+        [3] Junctions with scars not represented by the other categories; [4] Non-MH Deletions, del_size >= 4 and 
+        microhomology_size < 2 and ins_size < 5
+        '''
+        # No need to attempt an analysis of bad data or of sequences that are too short.
+        filtered = {seq for seq in sequence_counts
+                    if seq.count("N") / len(seq) > n_limit or len(seq) <= minimum_length}
+        filtered_count = sum(sequence_counts[seq] for seq in filtered)
+        self.progress(filtered_count)
+        self.summary_data[7][0] += filtered_count
+
+        # count reads that pass the read filters
+        self.summary_data[1] += sum(sequence_counts.values()) - filtered_count
+
+        return filtered
+
+    def cached_reads(self, sequences, sequence_counts):
+        """
+        Look up sequences in the junction cache and add the results of those found to summary_data.
+        :param sequences: Distinct sequences to look up.
+        :param sequence_counts: Dictionary of sequence: read count.
+        :return: Dictionary of sequence: (junction count change, sub_list or None) for the sequences found.
+        """
+        if not self.args.JunctionCache or not sequences:
+            return {}
+
+        # The connection is opened here, in the process doing the search, as it can not be pickled.
+        if self.junction_cache is None:
+            self.junction_cache = JunctionCache(self.args.JunctionCache, self.args.JunctionCacheSize)
+            self.junction_cache_key = JunctionCache.locus_key(
+                self.target_region, self.cutsite, self.lower_limit, self.upper_limit, self.hr_donors)
+
+        search_results = self.junction_cache.lookup(self.junction_cache_key, sequences)
+        for seq, (change, sub_list) in search_results.items():
+            read_count = sequence_counts[seq]
+            self.progress(read_count)
+            self.add_junction_counts(change, read_count)
+
+        return search_results
+
+    def progress(self, read_count):
+        """
+        Count reads searched and log every 5000.
+        :param read_count:
+        """
+        previous_count = self.loop_count
+        self.loop_count += read_count
+
+        if self.loop_count // 5000 > previous_count // 5000:
+            if self.sequence_list is not None:
                 self.log.info("Processed {} reads of {} for {} in {} seconds. Elapsed time: {} seconds."
-                              .format(loop_count, len(self.sequence_list), self.index_name, time.time() - split_time,
-                                      time.time() - start_time))
-                split_time = time.time()
+                              .format(self.loop_count, len(self.sequence_list), self.index_name,
+                                      time.time() - self.split_time, time.time() - self.start_time))
+            else:
+                self.log.info("Processed {} reads for {} in {} seconds. Elapsed time: {} seconds."
+                              .format(self.loop_count, self.index_name, time.time() - self.split_time,
+                                      time.time() - self.start_time))
+            self.split_time = time.time()
 
-            consensus_seq = seq
+    def scar_found(self, sub_list, read_count):
+        """
+        Add a read, or read_count copies of it, to the frequency data.
+        :param sub_list:
+        :param read_count:
+        """
+        freq_key = "{}|{}|{}|{}|{}".format(sub_list[0], sub_list[1], sub_list[2], sub_list[3], sub_list[9])
 
-            # No need to attempt an analysis of bad data.
-            if consensus_seq.count("N") / len(consensus_seq) > float(self.args.N_Limit):
-                self.summary_data[7][0] += 1
-                continue
+        if freq_key in self.results_freq_dict:
+            self.results_freq_dict[freq_key][0] += read_count
+        else:
+            self.results_freq_dict[freq_key] = [read_count, sub_list]
 
-            # No need to analyze sequences that are too short.
-            if len(consensus_seq) <= int(self.args.Minimum_Length):
-                self.summary_data[7][0] += 1
-                continue
+    def batch_search(self, sequences, sequence_counts):
+        """
+        Search all the distinct sequences with one call to SlidingWindow.junction_batch().  The summary_data counts
+        come from the result columns weighted by the read count of each sequence.
+        :param sequences: Distinct sequences to search.
+        :param sequence_counts: Dictionary of sequence: read count.
+        :return: Dictionary of sequence: (junction count change, sub_list or None).
+        """
+        search_results = {}
+
+        if not sequences:
+            return search_results
+
+        ends = numpy.cumsum([len(seq) for seq in sequences], dtype=numpy.int64)
+        columns = SlidingWindow.junction_batch("".join(sequences).encode(), ends, self.target_windows,
+                                               self.lower_limit, self.hr_donor)
+
+        # One row per sequence of the counts sliding_window() would have added, in junction_counts() order.
+        # A read counts once in the HR total and every further donor copy in it is a repeat.
+        status = columns["status"]
+        hr_copies = \
+            columns["hr_found"].sum(axis=1, dtype=numpy.int64) + columns["hr_extra"].sum(axis=1, dtype=numpy.int64)
+        change_columns = [columns["left_deletion"], columns["right_deletion"], columns["insertion"],
+                          columns["microhomology"], status == SlidingWindow.NO_JUNCTION,
+                          status == SlidingWindow.NO_CUT, columns["hr"], hr_copies - columns["hr"]]
+        for i in range(len(self.hr_donors)):
+            change_columns.extend([columns["hr_found"][:, i], columns["hr_extra"][:, i]])
+        changes = numpy.column_stack(change_columns).astype(numpy.int64)
+
+        read_counts = numpy.array([sequence_counts[seq] for seq in sequences], dtype=numpy.int64)
+        self.progress(int(read_counts.sum()))
+        self.add_junction_counts(numpy.dot(read_counts, changes).tolist(), 1)
+
+        wild_type = (status == SlidingWindow.NO_CUT) & (columns["hr"] == 0)
+        for i in numpy.flatnonzero(wild_type).tolist():
+            self.wild_type_found(sequences[i])
+
+        for seq, change in zip(sequences, changes.tolist()):
+            search_results[seq] = (change, None)
+
+        # Only the reads with a scar need the sub_list sliding_window() would have made.
+        target_region = self.target_region
+        cutsite = self.cutsite
+        for i in numpy.flatnonzero(status == SlidingWindow.SCAR).tolist():
+            seq = sequences[i]
+            consensus_lft_junction = int(columns["consensus_lft_junction"][i])
+            consensus_rt_junction = int(columns["consensus_rt_junction"][i])
+            target_lft_junction = int(columns["target_lft_junction"][i])
+            target_rt_junction = int(columns["target_rt_junction"][i])
+
+            consensus_insertion = ""
+            if 0 < consensus_lft_junction < consensus_rt_junction:
+                consensus_insertion = seq[consensus_lft_junction:consensus_rt_junction]
+
+            consensus_microhomology = ""
+            if consensus_lft_junction > consensus_rt_junction > 0:
+                consensus_microhomology = seq[consensus_rt_junction:consensus_lft_junction]
+
+            sub_list = [target_region[target_lft_junction:cutsite], target_region[cutsite:target_rt_junction],
+                        consensus_insertion, consensus_microhomology, seq, consensus_lft_junction,
+                        consensus_rt_junction, target_lft_junction, target_rt_junction,
+                        "HR" if columns["hr"][i] else ""]
+            search_results[seq] = (search_results[seq][0], sub_list)
+
+        return search_results
+
+    def read_search(self, sequences, sequence_counts, left_target_windows, right_target_windows):
+        """
+        Search the distinct sequences one at a time with SlidingWindow.sliding_window().
+        :param sequences: Distinct sequences to search.
+        :param sequence_counts: Dictionary of sequence: read count.
+        :param left_target_windows:
+        :param right_target_windows:
+        :return: Dictionary of sequence: (junction count change, sub_list or None).
+        """
+        search_results = {}
 
-            '''
-            The summary_data list contains information for a single library.  [0] index name; [1] reads passing all 
-            filters; [2] left junction count; [3] right junction count; [4] insertion count; [5] microhomology count; 
-            [6] [No junction count, no cut count]; [7] [consensus N + short filtered count, unused]; 
-            [8] junction_type_data list; [9] target name; 10 [HR left junction count, HR right junction count]
-
-            The junction_type_data list contains the repair type category counts.  [0] TMEJ, del_size >= 4 and 
-            microhomology_size >= 2; [1] NHEJ, del_size < 4 and ins_size < 5; [2] insertions >= 5 
-            [3] Junctions with scars not represented by the other categories; [4] Non-MH Deletions, del_size >= 4 and 
-            microhomology_size < 2 and ins_size < 5
-            '''
-            # count reads that pass the read filters
-            self.summary_data[1] += 1
+        # The cutwindow is used to filter out false positives.
+        cutwindow = self.target_region[self.cutsite-4:self.cutsite+4]
 
-            # The cutwindow is used to filter out false positives.
-            cutwindow = self.target_region[self.cutsite-4:self.cutsite+4]
+        # Extract and process read 1 and read 2 from our list of sequences.
+        for seq in sequences:
+            read_count = sequence_counts[seq]
+            self.progress(read_count)
 
+            junction_counts = self.junction_counts()
             sub_list, self.summary_data = \
                 SlidingWindow.sliding_window(
-                    consensus_seq, self.target_region, self.cutsite, self.target_length, self.lower_limit,
-                    self.upper_limit, self.summary_data, self.left_target_windows, self.right_target_windows, cutwindow,
+                    seq, self.target_region, self.cutsite, self.target_length, self.lower_limit,
+                    self.upper_limit, self.summary_data, left_target_windows, right_target_windows, cutwindow,
                     self.hr_donor)
 
+            change = [after - before for after, before in zip(self.junction_counts(), junction_counts)]
+            if change[5] == 1 and not any(change[:5] + change[6:]):
+                self.wild_type_found(seq)
+
+            # The search only counted the sequence once.
+            if read_count > 1:
+                self.add_junction_counts(change, read_count - 1)
+
             '''
             The sub_list holds the data for a single consensus read.  These data are [left deletion, right deletion, 
             insertion, microhomology, consensus sequence].  The list could be empty if nothing was found or the 
             consensus was too short.
             '''
+            search_results[seq] = (change, sub_list or None)
 
-            if sub_list:
-                read_results_list.append(sub_list)
-                freq_key = "{}|{}|{}|{}|{}".format(sub_list[0], sub_list[1], sub_list[2], sub_list[3], sub_list[9])
+        return search_results
 
-            else:
-                continue
+    def junction_counts(self):
+        """
+        The summary_data counts that SlidingWindow.sliding_window() adds to.
+        :return:
+        """
+        return (self.summary_data[2], self.summary_data[3], self.summary_data[4], self.summary_data[5],
+                self.summary_data[6][0], self.summary_data[6][1], self.summary_data[10][0], self.summary_data[10][1]) \
+            + tuple(count for donor_counts in self.summary_data[11] for count in donor_counts)
 
-            if freq_key in results_freq_dict:
-                results_freq_dict[freq_key][0] += 1
-            else:
-                results_freq_dict[freq_key] = [1, sub_list]
+    def add_junction_counts(self, change, repeats):
+        """
+        Add a change in the junction_counts() counts, repeats times.
+        :param change:
+        :param repeats:
+        """
+        self.summary_data[2] += change[0] * repeats
+        self.summary_data[3] += change[1] * repeats
+        self.summary_data[4] += change[2] * repeats
+        self.summary_data[5] += change[3] * repeats
+        self.summary_data[6][0] += change[4] * repeats
+        self.summary_data[6][1] += change[5] * repeats
+        self.summary_data[10][0] += change[6] * repeats
+        self.summary_data[10][1] += change[7] * repeats
+        for i, donor_counts in enumerate(self.summary_data[11]):
+            donor_counts[0] += change[8 + 2 * i] * repeats
+            donor_counts[1] += change[9 + 2 * i] * repeats
+
+    def finish(self):
+        """
+        Write the frequency file and, if asked for, the raw data file.
+        :return:
+        """
+        if not self.ready:
+            return self.summary_data
 
         self.log.info("Finished Processing {}".format(self.index_name))
+        self.log.info("{} of {} reads for {} matched a wild type amplicon and were not searched."
+                      .format(self.wild_type_count, self.loop_count, self.index_name))
+
+        if self.junction_cache is not None:
+            self.log.info("Junction cache for {}: {} hits and {} misses of distinct sequences."
+                          .format(self.index_name, self.junction_cache.hits, self.junction_cache.misses))
+            self.junction_cache.close()
+            self.junction_cache = None
 
         # Write frequency results file
-        self.frequency_output(self.index_name, results_freq_dict, junction_type_data)
+        self.frequency_output(self.index_name, self.results_freq_dict, self.junction_type_data)
 
         # Format and output raw data if user has so chosen.
         if self.args.OutputRawData:
-            self.raw_data_output(self.index_name, read_results_list)
+            self.raw_data_output(self.index_name, self.read_results_list)
+
+        self.read_results_list = []
+        self.results_freq_dict = collections.defaultdict(list)
+        self.ready = False
 
         return self.summary_data
 
@@ -204,8 +487,8 @@ class ScarSearch:
         sample_name = "{}.{}".format(self.index_dict[index_name][5], self.index_dict[index_name][6])
 
         hr_donor = ""
-        if self.args.HR_Donor:
-            hr_donor = "# HR Donor: {}\n".format(self.args.HR_Donor)
+        if self.hr_donors:
+            hr_donor = "# HR Donor: {}\n".format(", ".join(self.hr_donors))
 
         page_header = \
             "# ScarMapper Search v{}\n# Run Start: {}\n# Run End: {}\n# Sample Name: {}\n# Locus Name: {}\n" \
@@ -506,44 +789,6 @@ class ScarSearch:
         results_file.write(results_outstring)
         results_file.close()
 
-    def cutsite_search(self, target_name, sgrna, chrm, start, stop):
-        """
-        Find the sgRNA cutsite on the gapped genomic DNA.
-        :param stop:
-        :param start:
-        :param chrm:
-        :param sgrna:
-        :param target_name:
-        """
-
-        lft_position = 0
-        rt_position = len(sgrna)
-        upper_limit = len(self.target_region)-1
-        working_sgrna = sgrna
-        rcomp_sgrna = False
-
-        if self.target_dict[target_name][5] == 'YES':
-            working_sgrna = Sequence_Magic.rcomp(sgrna)
-            rcomp_sgrna = True
-
-        cutsite_found = False
-        while not cutsite_found and rt_position < upper_limit:
-            if self.target_region[lft_position:rt_position] == working_sgrna:
-                cutsite_found = True
-
-                if rcomp_sgrna:
-                    self.cutsite = lft_position+3
-                else:
-                    self.cutsite = rt_position-3
-
-            lft_position += 1
-            rt_position += 1
-
-        if not cutsite_found:
-            self.log.error("sgRNA {} does not map to locus {}; chr{}:{}-{}.  Check --TargetFile and try again."
-                           .format(sgrna, target_name, chrm, start, stop))
-            raise SystemExit(1)
-
     def gapped_aligner(self, fasta_data):
         """
         Generates and returns a simple consensus from the given FASTA data using Muscle.
@@ -604,125 +849,535 @@ class ScarSearch:
         return consensus_seq
 
 
-class DataProcessing:
-    def __init__(self, log, args, run_start, version, targeting, fq1=None, fq2=None):
+def hr_donor_list(args):
+    """
+    The --HR_Donor sequences, separated by commas, and with --HR_DonorRcomp their reverse complements.  Repeats are
+    dropped.
+    :param args:
+    :return:
+    """
+    donors = [donor for donor in args.HR_Donor.split(",") if donor] if args.HR_Donor else []
+    if getattr(args, "HR_DonorRcomp", False):
+        donors += [Sequence_Magic.rcomp(donor) for donor in donors]
+
+    return list(collections.OrderedDict.fromkeys(donors))
+
+
+def shard_file_name(args, index_name, shard):
+    """
+    Name of the demultiplexed FASTQ written by one shard.
+    :param args:
+    :param index_name:
+    :param shard:
+    :return:
+    """
+    return "{}{}_{}_R1.shard{}.fastq.gz".format(args.WorkingFolder, args.Job_Name, index_name, shard)
+
+
+def shard_demultiplex(log, args, index_dict, phase_dict, barcode_table, input_file, byte_range, shard):
+    """
+    Search one shard of the consensus FASTQ.  Runs in a worker process.  Demultiplexed reads go to per shard files
+    that DataProcessing appends to the final files in shard order.
+    :param log:
+    :param args:
+    :param index_dict:
+    :param phase_dict:
+    :param barcode_table: IndexSearch.barcode_table from the main process so it is only built once.
+    :param input_file:
+    :param byte_range:
+    :param shard:
+    :return:
+    """
+    index_search = IndexSearch(log, args, index_dict, phase_dict, barcode_table)
+    fastq_data_dict = None
+    compressor = None
+    writer_dict = {}
+
+    if args.Demultiplex:
+        fastq_data_dict = collections.defaultdict(lambda: collections.defaultdict(list))
+        compressor = Tool_Box.Compressor(log, args.CompressionLevel, 1, args.BGZF)
+
+    for read_batch in FASTQ_Tools.FASTQ_Reader(input_file, log, byte_range=byte_range):
+        index_search.batch_search([(fastq1_read, None) for fastq1_read in read_batch], fastq_data_dict)
+        index_search.spill(args.MemoryBudget * 1048576 // int(args.Spawn))
+
+        if args.Demultiplex:
+            for index_name in fastq_data_dict:
+                if index_name not in writer_dict:
+                    writer_dict[index_name] = \
+                        FASTQ_Tools.Writer(log, shard_file_name(args, index_name, shard), compressor)
+                writer_dict[index_name].write(fastq_data_dict[index_name]["R1"])
+                fastq_data_dict[index_name]["R2"].clear()
+
+    if args.Demultiplex:
+        for writer in writer_dict.values():
+            writer.close()
+        compressor.close()
+
+    return index_search
+
+
+def shard_demultiplex_list(arg_list):
+    """
+    shard_demultiplex() taking its arguments as one list, for Pool.imap().
+    :param arg_list:
+    :return:
+    """
+    return shard_demultiplex(*arg_list)
+
+
+pipeline_index_search = None
+pipeline_queues = None
+pipeline_routes = None
+
+# Seconds a matcher waits for room on an aggregator queue before deciding the aggregator has died.
+pipeline_queue_timeout = 3600
+
+
+def pipeline_matcher_setup(log, args, index_dict, phase_dict, barcode_table, read_queues, routes):
+    """
+    Pool initializer for the streaming pipeline matchers.  Each matcher builds its IndexSearch once and keeps the
+    queues of the aggregator processes.
+    :param log:
+    :param args:
+    :param index_dict:
+    :param phase_dict:
+    :param barcode_table: IndexSearch.barcode_table from the main process so it is only built once.
+    :param read_queues: One queue per aggregator.
+    :param routes: Dictionary of index name to aggregator number.
+    """
+    global pipeline_index_search, pipeline_queues, pipeline_routes
+    pipeline_index_search = IndexSearch(log, args, index_dict, phase_dict, barcode_table)
+    pipeline_queues = read_queues
+    pipeline_routes = routes
+
+
+def pipeline_match(batch_number, read_batch):
+    """
+    Search one batch of reads in a matcher process.  The sequences found for each library are sent straight to the
+    aggregator that owns it.  The counts, library sizes and reads to demultiplex go back to the reader.
+    :param batch_number:
+    :param read_batch:
+    :return:
+    """
+    index_search = pipeline_index_search
+    index_search.reset()
+    fastq_data_dict = None
+    if index_search.args.Demultiplex:
+        fastq_data_dict = collections.defaultdict(lambda: collections.defaultdict(list))
+
+    index_search.batch_search(read_batch, fastq_data_dict)
+
+    # Every aggregator gets every batch number, even when empty, so it can keep the batches in file order.
+    library_sizes = collections.OrderedDict()
+    routed_dicts = [{} for i in range(len(pipeline_queues))]
+    for index_name, sequence_list in index_search.sequence_dict.items():
+        library_sizes[index_name] = len(sequence_list)
+        routed_dicts[pipeline_routes[index_name]][index_name] = sequence_list
+    for aggregator, (read_queue, sequence_dict) in enumerate(zip(pipeline_queues, routed_dicts)):
+        try:
+            read_queue.put((batch_number, sequence_dict), timeout=pipeline_queue_timeout)
+        except queue.Full:
+            raise RuntimeError("Scar search process {} took no reads for {} seconds.  It has probably failed."
+                               .format(aggregator, pipeline_queue_timeout))
+    index_search.sequence_dict.clear()
+
+    if fastq_data_dict is not None:
+        fastq_data_dict = {index_name: dict(read_dict) for index_name, read_dict in fastq_data_dict.items()}
+
+    return index_search, library_sizes, fastq_data_dict
+
+
+def pipeline_aggregator(log, args, version, run_start, target_dict, index_dict, target_bundles, read_queue,
+                        result_queue):
+    """
+    Runs the scar search for the libraries routed to this process as their reads arrive.  Batches are searched in file
+    order so the results are the same as searching each complete library.  The final message on read_queue is
+    (None, batch count, indexed read count, lower limit).
+    :param log:
+    :param args:
+    :param version:
+    :param run_start:
+    :param target_dict:
+    :param index_dict:
+    :param target_bundles:
+    :param read_queue:
+    :param result_queue:
+    """
+    scar_searches = collections.OrderedDict()
+    pending_dict = {}
+    batch_number = 0
+    batch_count = None
+    indexed_read_count = None
+    lower_limit = None
+
+    while batch_count is None or batch_number < batch_count:
+        message = read_queue.get()
+        if message[0] is None:
+            batch_count, indexed_read_count, lower_limit = message[1:]
+        else:
+            pending_dict[message[0]] = message[1]
+
+        while batch_number in pending_dict:
+            for index_name, sequence_list in pending_dict.pop(batch_number).items():
+                if index_name not in scar_searches:
+                    scar_searches[index_name] = \
+                        ScarSearch(log, args, version, run_start, target_dict, index_dict, index_name, None, 0, 0,
+                                   target_bundles.get(index_dict[index_name][7]))
+                    scar_searches[index_name].setup()
+                scar_searches[index_name].add_reads(sequence_list)
+            batch_number += 1
+
+    # The output files need the totals so they are only written once every read has been searched.
+    for scar_search in scar_searches.values():
+        scar_search.indexed_read_count = indexed_read_count
+        scar_search.lower_limit_count = lower_limit
+        scar_search.finish()
+
+    result_queue.put(list(scar_searches.values()))
+
+
+class JunctionCache:
+    """
+    SQLite file of junction search results kept from run to run.  A row holds the summary_data counts and sub_list of
+    one consensus sequence at one locus.  Rows record when they were last used and the least recently used are
+    deleted once the file holds more than size rows.
+    """
+
+    def __init__(self, file_name, size):
+        """
+        :param file_name:
+        :param size: Most rows kept.
+        """
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+        # Several processes share the file so wait for the write lock rather than fail.
+        self.connection = sqlite3.connect(file_name, timeout=600)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS junctions (locus TEXT, consensus TEXT, result TEXT, "
+                                "used REAL, PRIMARY KEY (locus, consensus))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS junctions_used ON junctions (used)")
+        self.connection.commit()
+
+    @staticmethod
+    def locus_key(target_region, cutsite, lower_limit, upper_limit, hr_donors):
+        """
+        Hash of everything besides the consensus sequence that the search result depends on.  The SlidingWindow
+        version is included so results from an older search are not used.
+        :param target_region:
+        :param cutsite:
+        :param lower_limit:
+        :param upper_limit:
+        :param hr_donors:
+        :return:
+        """
+        key = "{}|{}|{}|{}|{}|{}".format(SlidingWindow.__version__, target_region, cutsite, lower_limit, upper_limit,
+                                         ",".join(hr_donors))
+
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def lookup(self, locus, sequences):
+        """
+        Results for the sequences found at locus.
+        :param locus:
+        :param sequences:
+        :return: Dictionary of sequence: (junction count change, sub_list or None).
+        """
+        search_results = {}
+
+        # Stay under the SQLite limit on query parameters.
+        for start in range(0, len(sequences), 500):
+            block = sequences[start:start+500]
+            rows = self.connection.execute(
+                "SELECT consensus, result FROM junctions WHERE locus = ? AND consensus IN ({})"
+                .format(",".join("?" * len(block))), [locus] + block)
+
+            for consensus, result in rows:
+                change, sub_list = json.loads(result)
+                if sub_list:
+                    sub_list.insert(4, consensus)
+                search_results[consensus] = (change, sub_list)
+
+        if search_results:
+            used = time.time()
+            self.connection.executemany("UPDATE junctions SET used = ? WHERE locus = ? AND consensus = ?",
+                                        ((used, locus, consensus) for consensus in search_results))
+            self.connection.commit()
+
+        self.hits += len(search_results)
+        self.misses += len(sequences) - len(search_results)
+
+        return search_results
+
+    def store(self, locus, search_results):
+        """
+        Add search results for locus and trim the file back to size rows.
+        :param locus:
+        :param search_results: Dictionary of sequence: (junction count change, sub_list or None).
+        """
+        if not search_results:
+            return
+
+        used = time.time()
+        rows = []
+        for consensus, (change, sub_list) in search_results.items():
+            # The consensus is the key so is not stored again in the sub_list.
+            if sub_list:
+                sub_list = sub_list[:4] + sub_list[5:]
+            rows.append((locus, consensus, json.dumps([change, sub_list]), used))
+
+        self.connection.executemany("INSERT OR REPLACE INTO junctions VALUES (?, ?, ?, ?)", rows)
+        self.connection.commit()
+        self.trim()
+
+    def trim(self):
+        """
+        Delete the least recently used rows past size.
+        """
+        excess = self.connection.execute("SELECT COUNT(*) FROM junctions").fetchone()[0] - self.size
+        if excess > 0:
+            self.connection.execute(
+                "DELETE FROM junctions WHERE rowid IN (SELECT rowid FROM junctions ORDER BY used LIMIT ?)", (excess,))
+            self.connection.commit()
+
+    def close(self):
+        self.trim()
+        self.connection.close()
+
+
+class PhaseTable:
+    """
+    The primer phasing of one locus compiled into prefix and suffix lookups.  Each phase that can be scored has a slot
+    in a count array so a read is phased with one dictionary lookup per phase length rather than a pass over every
+    phase.
+    """
+    __slots__ = ("labels", "unphased", "r1_lookup", "r2_lookup", "no_r1", "no_r2")
+
+    def __init__(self, phase_dict):
+        self.labels = []
+        self.unphased = []
+        self.r1_lookup = collections.defaultdict(dict)
+        self.r2_lookup = collections.defaultdict(dict)
+
+        for r2_phase, r1_phase in zip(phase_dict["R2"], phase_dict["R1"]):
+            # Phases that should not be present are flagged with -1.
+            if not r1_phase[0]:
+                self.unphased.extend(["Phase " + r1_phase[1], "Phase " + r2_phase[1]])
+                continue
+
+            # The first phase listed wins when two phases share a sequence.
+            self.r1_lookup[len(r1_phase[0])].setdefault(r1_phase[0], len(self.labels))
+            self.labels.append("Phase " + r1_phase[1])
+
+            # The R2 phasing is the reverse complement of the last N nucleotides of the consensus.
+            self.r2_lookup[len(r2_phase[0])].setdefault(Sequence_Magic.rcomp(r2_phase[0]), len(self.labels))
+            self.labels.append("Phase " + r2_phase[1])
+
+        self.r1_lookup = list(self.r1_lookup.items())
+        self.r2_lookup = list(self.r2_lookup.items())
+        self.no_r1 = len(self.labels)
+        self.no_r2 = self.no_r1 + 1
+
+    def counter(self):
+        """
+        :return: A zeroed count array for this locus.
+        """
+        return array("q", bytes(8 * (self.no_r2 + 1)))
+
+    def score(self, seq, counts):
+        """
+        Count the first R1 and R2 phase found in seq.
+        :param seq:
+        :param counts:
+        """
+        r1_slot = None
+        for length, lookup in self.r1_lookup:
+            slot = lookup.get(seq[:length])
+            if slot is not None and (r1_slot is None or slot < r1_slot):
+                r1_slot = slot
+
+        r2_slot = None
+        for length, lookup in self.r2_lookup:
+            slot = lookup.get(seq[-length:])
+            if slot is not None and (r2_slot is None or slot < r2_slot):
+                r2_slot = slot
+
+        counts[self.no_r1 if r1_slot is None else r1_slot] += 1
+        counts[self.no_r2 if r2_slot is None else r2_slot] += 1
+
+    def phase_counts(self, counts, phase_counts):
+        """
+        Write a count array into a dictionary of counts keyed by phase label.
+        :param counts:
+        :param phase_counts:
+        """
+        for label in self.unphased:
+            phase_counts[label] = -1
+        for slot, label in enumerate(self.labels):
+            phase_counts[label] += counts[slot]
+
+        # if no phasing is found then note that.
+        if counts[self.no_r2]:
+            phase_counts["No Read 2 Phasing"] += counts[self.no_r2]
+        if counts[self.no_r1]:
+            phase_counts["No Read 1 Phasing"] += counts[self.no_r1]
+
+
+class IndexSearch:
+    """
+    Matches reads to their library index and scores the primer phasing.  Holds the per index sequence lists and read
+    counts so shards searched in separate processes can be merged.
+    """
+    def __init__(self, log, args, index_dict, phase_dict, barcode_table=None):
         self.log = log
         self.args = args
-        self.version = version
-        self.date_format = "%a %b %d %H:%M:%S %Y"
-        self.run_start = run_start
-        self.fastq_outfile_dict = None
-        self.target_dict = targeting.targets
-        self.phase_dict = targeting.phasing
-        self.phase_count = collections.defaultdict(lambda: collections.defaultdict(int))
-        self.index_dict = self.dictionary_build()
-        self.results_dict = collections.defaultdict(list)
-        self.sequence_dict = collections.defaultdict(list)
+        self.index_dict = index_dict
+        self.phase_dict = phase_dict
+        self.phase_tables = {}
+        self.phase_arrays = None
+        self.sequence_dict = None
+        self.read_count_dict = None
+        self.ambiguous_read_count = 0
+        self.read_count = 0
+        self.indexed_read_count = 0
+        self.reset()
+        self.barcode_table = None
+        self.barcode_matrices = None
+        self.barcode_lengths = None
+        if args.Platform == "Illumina":
+            self.barcode_lengths = self.__barcode_lengths()
+
+        # --IndexEngine Table looks each read up in a dict, NumPy scores whole batches at once and Scan compares
+        # every index with every read.
+        if args.IndexEngine == "Table" and args.Platform == "Illumina":
+            self.barcode_table = barcode_table if barcode_table is not None else self.barcode_lookup_table()
+        elif args.IndexEngine == "NumPy" and self.barcode_lengths is not None:
+            index_keys = list(index_dict)
+            self.barcode_matrices = \
+                (Sequence_Magic.BarcodeMatrix([index_dict[index_key][2] for index_key in index_keys]),
+                 Sequence_Magic.BarcodeMatrix([index_dict[index_key][0] for index_key in index_keys]))
+
+        # Ramsden primers are found through seed lookups and only the candidates are scored.
+        self.index_order = {index_key: i for i, index_key in enumerate(index_dict)}
+        self.right_seeds = None
+        self.left_seeds = None
+        self.left_rcomp = None
+        self.primer_lengths = None
+        if args.Platform == "Ramsden":
+            self.primer_lengths = (min(len(index_dict[index_key][2]) for index_key in index_dict),
+                                   min(len(index_dict[index_key][0]) for index_key in index_dict))
+            self.left_rcomp = {index_key: Sequence_Magic.rcomp(index_dict[index_key][0]) for index_key in index_dict}
+            self.right_seeds = \
+                Sequence_Magic.SeedMatcher({index_key: index_dict[index_key][2] for index_key in index_dict}, 3)
+            if args.PEAR:
+                self.left_seeds = \
+                    Sequence_Magic.SeedMatcher({index_key: index_dict[index_key][0] for index_key in index_dict}, 3)
+            else:
+                self.left_seeds = Sequence_Magic.SeedMatcher(self.left_rcomp, 3)
+        self.total_reads = None
+        self.start_time = time.time()
+        self.split_time = time.time()
+
+    def __getstate__(self):
+        """
+        Only the results are sent between processes.  The index lookups are large and are not needed to merge.
+        :return:
+        """
+        state = self.__dict__.copy()
+        for name in ("barcode_table", "barcode_matrices", "right_seeds", "left_seeds", "left_rcomp"):
+            state[name] = None
+
+        return state
+
+    def reset(self):
+        """
+        Clear the sequence lists and counts, keeping the index lookups and phasing tables.
+        """
+        two_bit = self.args.SequencePacking == "TwoBit"
+        self.sequence_dict = collections.defaultdict(lambda: Sequence_Magic.SequenceStore(two_bit=two_bit))
         self.read_count_dict = collections.defaultdict()
-        self.fastq1 = fq1
-        self.fastq2 = fq2
+        for index_key in self.index_dict:
+            self.read_count_dict[index_key] = 0
+        self.phase_arrays = collections.OrderedDict()
+        self.ambiguous_read_count = 0
         self.read_count = 0
+        self.indexed_read_count = 0
+        self.unknown_barcodes = None
+        if self.args.UnknownBarcodes:
+            self.unknown_barcodes = Tool_Box.SpaceSaving(50 * self.args.UnknownBarcodes)
 
-    def consensus_demultiplex(self):
+    def unknown_barcode(self, fastq1_read, fastq2_read=None):
         """
-        Takes a FASTQ file of consensus reads and identifies each by index.  Handles writing demultiplexed FASTQ if
-        user desired.
+        The part of an unidentified read compared with the indices.  For Illumina this is the header barcode pair.  For
+        Ramsden it is the start and end of the read, the length of the shortest primers, joined with "+".
+        :param fastq1_read:
+        :param fastq2_read:
+        :return:
         """
-        self.log.info("Consensus Index Search")
-        eof = False
-        start_time = time.time()
-        split_time = time.time()
-        fastq_file_name_list = []
-        fastq_data_dict = collections.defaultdict(lambda: collections.defaultdict(list))
-        indexed_read_count = 0
-        key_counts = []
-        while not eof:
-            # Debugging Code Block
-            if self.args.Verbose == "DEBUG":
-                read_limit = 1000000
-                if self.read_count > read_limit:
-                    if self.args.Demultiplex:
-                        for index_name in fastq_data_dict:
-                            r1_data = fastq_data_dict[index_name]["R1"]
-                            r1, r2 = self.fastq_outfile_dict[index_name]
-                            r1.write(r1_data)
-                            r1.close()
-                            if not self.args.PEAR:
-                                r2_data = fastq_data_dict[index_name]["R2"]
-                                r2.write(r2_data)
-                                r2.close()
-
-                    Tool_Box.debug_messenger("Limiting Reads Here to {}".format(read_limit))
-                    eof = True
-            fastq2_read = None
-            try:
-                fastq1_read = next(self.fastq1.seq_read())
-                if not self.args.PEAR:
-                    fastq2_read = next(self.fastq2.seq_read())
+        if self.args.Platform == "Illumina":
+            return fastq1_read.name.split(":")[-1]
 
-            except StopIteration:
-                if self.args.Demultiplex:
-                    for index_name in fastq_data_dict:
-                        r1_data = fastq_data_dict[index_name]["R1"]
-                        r1, r2 = self.fastq_outfile_dict[index_name]
-                        r1.write(r1_data)
-                        r1.close()
-                        if not self.args.PEAR:
-                            r2_data = fastq_data_dict[index_name]["R2"]
-                            r2.write(r2_data)
-                            r2.close()
-
-                eof = True
-                continue
+        right_length, left_length = self.primer_lengths
+        if self.args.PEAR:
+            return "{}+{}".format(fastq1_read.seq[:right_length], fastq1_read.seq[-left_length:])
+
+        return "{}+{}".format(fastq1_read.seq[:right_length], fastq2_read.seq[:left_length])
+
+    def batch_search(self, read_batch, fastq_data_dict=None, read_limit=None):
+        """
+        Search a list of (read 1, read 2) tuples.  When fastq_data_dict is given the reads are also sorted into it for
+        writing.  Returns True once read_limit is passed.
+        :param read_batch:
+        :param fastq_data_dict:
+        :param read_limit:
+        :return:
+        """
+        batch_keys = None
+        if self.barcode_matrices is not None:
+            batch_keys = self.batch_barcode_matching(read_batch)
+
+        for read_number, (fastq1_read, fastq2_read) in enumerate(read_batch):
+            if read_limit and self.read_count > read_limit:
+                Tool_Box.debug_messenger("Limiting Reads Here to {}".format(read_limit))
+                return True
 
             self.read_count += 1
             if self.read_count % 100000 == 0:
-                elapsed_time = int(time.time() - start_time)
-                block_time = int(time.time() - split_time)
-                split_time = time.time()
-                self.log.info("Processed {} reads in {} seconds.  Total elapsed time: {} seconds."
-                              .format(self.read_count, block_time, elapsed_time))
+                elapsed_time = int(time.time() - self.start_time)
+                block_time = int(time.time() - self.split_time)
+                self.split_time = time.time()
+                if self.total_reads:
+                    remaining_time = int(elapsed_time * (self.total_reads - self.read_count) / self.read_count)
+                    self.log.info("Processed {} of {} reads ({:.1f}%) in {} seconds.  Total elapsed time: {} seconds.  "
+                                  "Estimated time remaining: {} seconds."
+                                  .format(self.read_count, self.total_reads, 100 * self.read_count / self.total_reads,
+                                          block_time, elapsed_time, max(remaining_time, 0)))
+                else:
+                    self.log.info("Processed {} reads in {} seconds.  Total elapsed time: {} seconds."
+                                  .format(self.read_count, block_time, elapsed_time))
 
             # Match read with library index.
-            match_found, left_seq, right_seq, index_name, fastq1_read, fastq2_read = \
-                self.index_matching(fastq1_read, fastq2_read)
+            if batch_keys is not None and batch_keys[read_number] is not False:
+                match_found, left_seq, right_seq, index_name, fastq1_read, fastq2_read = \
+                    self.assign_index(batch_keys[read_number], fastq1_read, fastq2_read)
+            else:
+                match_found, left_seq, right_seq, index_name, fastq1_read, fastq2_read = \
+                    self.index_matching(fastq1_read, fastq2_read)
 
             if match_found:
-                indexed_read_count += 1
+                self.indexed_read_count += 1
                 locus = self.index_dict[index_name][7]
                 phase_key = "{}+{}".format(index_name, locus)
-                r2_found = False
-                r1_found = False
                 if self.args.Platform == "Illumina":
 
                     # Score the phasing and place the reads in a dictionary.
-                    for r2_phase, r1_phase in zip(self.phase_dict[locus]["R2"], self.phase_dict[locus]["R1"]):
-
-                        r2_phase_name = r2_phase[1]
-                        r1_phase_name = r1_phase[1]
-
-                        # Tag reads that should not have any phasing.
-                        if not r1_phase[0]:
-                            self.phase_count[phase_key]["Phase " + r1_phase_name] = -1
-                            self.phase_count[phase_key]["Phase " + r2_phase_name] = -1
-                            continue
-                        else:
-                            self.phase_count[phase_key]["Phase " + r1_phase_name] += 0
-                            self.phase_count[phase_key]["Phase " + r2_phase_name] += 0
-
-                        # The phasing is the last N nucleotides of the consensus.
-                        if r2_phase[0] == Sequence_Magic.rcomp(fastq1_read.seq[-len(r2_phase[0]):]) and not r2_found:
-                            self.phase_count[phase_key]["Phase "+r2_phase_name] += 1
-                            r2_found = True
-
-                        if r1_phase[0] == fastq1_read.seq[:len(r1_phase[0])] and not r1_found:
-                            self.phase_count[phase_key]["Phase "+r1_phase_name] += 1
-                            r1_found = True
-                    # if no phasing is found then note that.
-                    if not r2_found:
-                        self.phase_count[phase_key]["No Read 2 Phasing"] += 1
-                    if not r1_found:
-                        self.phase_count[phase_key]["No Read 1 Phasing"] += 1
+                    if phase_key not in self.phase_arrays:
+                        if locus not in self.phase_tables:
+                            self.phase_tables[locus] = PhaseTable(self.phase_dict[locus])
+                        self.phase_arrays[phase_key] = (locus, self.phase_tables[locus].counter())
+                    self.phase_tables[locus].score(fastq1_read.seq, self.phase_arrays[phase_key][1])
 
                     # The adapters on AAVS1.1 are reversed causing the reads to be reversed.
                     if locus == "AAVS1.1":
@@ -737,138 +1392,209 @@ class DataProcessing:
                                    .format(self.args.Platform))
                     raise SystemExit(1)
 
-                if self.args.Demultiplex:
+                if fastq_data_dict is not None:
                     # fastq_data_dict[index_name]["R1"].append([fastq1_read.name, fastq1_read.seq[15:], fastq1_read.qual[15:]])
                     fastq_data_dict[index_name]["R1"].append([fastq1_read.name, fastq1_read.seq, fastq1_read.qual])
                     if not self.args.PEAR:
-                        fastq_data_dict[index_name]["R2"].append([fastq2_read.name, fastq2_read.seq, fastq2_read.qual])
+                        fastq_data_dict[index_name]["R2"]\
+                            .append([fastq2_read.name, fastq2_read.seq, fastq2_read.qual])
 
-                    fastq_file_name_list.append("{}{}_{}_Consensus.fastq"
-                                                .format(self.args.WorkingFolder, self.args.Job_Name, index_name))
+            else:
+                if self.unknown_barcodes is not None:
+                    self.unknown_barcodes.add(self.unknown_barcode(fastq1_read, fastq2_read))
 
-            elif self.args.Demultiplex and not match_found:
-                fastq_data_dict['Unknown']["R1"].append([fastq1_read.name, fastq1_read.seq, fastq1_read.qual])
-                fastq_data_dict['Unknown']["R2"].append([fastq1_read.name, fastq1_read.seq, fastq1_read.qual])
+                if fastq_data_dict is not None:
+                    fastq_data_dict['Unknown']["R1"].append([fastq1_read.name, fastq1_read.seq, fastq1_read.qual])
+                    fastq_data_dict['Unknown']["R2"].append([fastq1_read.name, fastq1_read.seq, fastq1_read.qual])
 
-                fastq_file_name_list.append("{}{}_Unknown_Consensus.fastq"
-                                            .format(self.args.WorkingFolder, self.args.Job_Name))
+        return False
 
-        if self.args.Demultiplex:
-            self.fastq_compress(list(set(fastq_file_name_list)))
+    def merge(self, other):
+        """
+        Add the results of another IndexSearch, from a later part of the file, to this one.
+        :param other:
+        """
+        self.read_count += other.read_count
+        self.indexed_read_count += other.indexed_read_count
+        self.ambiguous_read_count += other.ambiguous_read_count
 
-        for key in self.sequence_dict:
-            key_counts.append(len(self.sequence_dict[key]))
+        for index_key, count in other.read_count_dict.items():
+            self.read_count_dict[index_key] = self.read_count_dict.get(index_key, 0) + count
 
-        lower, upper_limit = stats.norm.interval(0.9, loc=statistics.mean(key_counts), scale=stats.sem(key_counts))
-        lower_limit = statistics.mean(key_counts)-lower
+        for index_key, sequence_list in other.sequence_dict.items():
+            self.sequence_dict[index_key].extend(sequence_list)
+
+        if self.unknown_barcodes is not None and other.unknown_barcodes is not None:
+            self.unknown_barcodes.merge(other.unknown_barcodes)
 
-        return indexed_read_count, lower_limit
+        for phase_key, (locus, counts) in other.phase_arrays.items():
+            if phase_key not in self.phase_arrays:
+                self.phase_tables.setdefault(locus, other.phase_tables[locus])
+                self.phase_arrays[phase_key] = (locus, self.phase_tables[locus].counter())
+            self_counts = self.phase_arrays[phase_key][1]
+            for slot, count in enumerate(counts):
+                self_counts[slot] += count
 
-    def fastq_compress(self, fastq_file_name_list):
+    @property
+    def phase_count(self):
         """
-        Take a list of file names and gzip each file.
-        :param fastq_file_name_list:
+        The phasing counts keyed by "index+locus" and then by phase label.  Phases that can not be present are flagged
+        with -1 rather than counted.
+        :return:
         """
-        self.log.info("Spawning {} Jobs to Compress {} Files.".format(self.args.Spawn, len(fastq_file_name_list)))
+        phase_count = collections.defaultdict(lambda: collections.defaultdict(int))
+        for phase_key, (locus, counts) in self.phase_arrays.items():
+            self.phase_tables[locus].phase_counts(counts, phase_count[phase_key])
 
-        p = pathos.multiprocessing.Pool(int(self.args.Spawn))
-        p.starmap(Tool_Box.compress_files, zip(fastq_file_name_list, itertools.repeat(self.log)))
-
-        self.log.info("All Files Compressed")
+        return phase_count
 
-    def main_loop(self):
+    def spill(self, budget):
         """
-        Main entry point for repair scar search and processing.
+        When the sequence lists use more than budget bytes of memory move the largest to temporary files in the working
+        folder until they use no more than half of it.  A budget of 0 means no limit.
+        :param budget:
         """
+        if not budget:
+            return
 
-        self.log.info("Beginning main loop|Demultiplexing FASTQ")
-        indexed_read_count, lower_limit = self.consensus_demultiplex()
+        total = sum(sequence_list.nbytes() for sequence_list in self.sequence_dict.values())
+        if total <= budget:
+            return
 
-        self.log.info("Spawning {} Jobs to Process {} Libraries".format(self.args.Spawn, len(self.sequence_dict)))
-        p = pathos.multiprocessing.Pool(int(self.args.Spawn))
+        for index_name in sorted(self.sequence_dict, key=lambda k: self.sequence_dict[k].nbytes(), reverse=True):
+            if total <= budget // 2:
+                break
+            total -= self.sequence_dict[index_name].nbytes()
+            self.sequence_dict[index_name].spill(self.args.WorkingFolder)
 
-        # My solution for passing key:value pairs to the multiprocessor.  Largest value group goes first.
-        data_list = []
-        for key in sorted(self.sequence_dict, key=lambda k: len(self.sequence_dict[k]), reverse=True):
-            data_list.append([self.log, self.args, self.version, self.run_start, self.target_dict, self.index_dict,
-                              key, self.sequence_dict[key], indexed_read_count, lower_limit])
+    def __barcode_lengths(self):
+        """
+        The lengths of the two header barcodes if every index has the same lengths, otherwise None.
+        :return:
+        """
+        lengths = set((len(self.index_dict[index_key][2]), len(self.index_dict[index_key][0]))
+                      for index_key in self.index_dict)
 
-        # Not sure if clearing this is really necessary but it is not used again so why keep the RAM tied up.
-        self.sequence_dict.clear()
+        return lengths.pop() if len(lengths) == 1 else None
 
-        # Each job is a single instance of the ScarSearch class..
-        self.data_output(p.starmap(ScarSearch, data_list))
+    def barcode_lookup_table(self):
+        """
+        Map every (right, left) barcode pair within one mismatch per barcode of an Illumina index to that index.  When
+        a pair is near more than one index the first in the manifest wins, as it would in a linear search.
+        :return:
+        """
+        barcode_table = {}
+        collision_counts = collections.Counter()
 
-        self.log.info("Main Loop Finished")
+        for index_key in self.index_dict:
+            # The first header barcode is compared with index_dict[2] and the second with index_dict[0].
+            right_neighbors = Sequence_Magic.mismatch_neighborhood(self.index_dict[index_key][2])
+            left_neighbors = Sequence_Magic.mismatch_neighborhood(self.index_dict[index_key][0])
+            for right_barcode in right_neighbors:
+                for left_barcode in left_neighbors:
+                    barcode_pair = (right_barcode, left_barcode)
+                    if barcode_pair in barcode_table:
+                        collision_counts[(barcode_table[barcode_pair], index_key)] += 1
+                    else:
+                        barcode_table[barcode_pair] = index_key
 
-    def dictionary_build(self):
+        for (first_index, second_index), count in collision_counts.items():
+            self.log.warning("{} barcode pairs are within one mismatch of both {} and {}.  These reads will be assigned "
+                             "to {}.  Check {}.".format(count, first_index, second_index, first_index,
+                                                        self.args.SampleManifest))
+        self.log.info("Barcode lookup table holds {} barcode pairs for {} indices."
+                      .format(len(barcode_table), len(self.index_dict)))
+
+        return barcode_table
+
+    def header_barcodes(self, fastq1_read):
         """
-        Build the index dictionary from the index list.
+        Returns the (right, left) barcodes from an Illumina read header, or None if they are not the expected length
+        or contain anything other than A, C, G, T and N.  Those reads need the full comparison.
+        :param fastq1_read:
         :return:
         """
+        if self.barcode_lengths is None:
+            return None
 
-        self.log.info("Building DataFrames.")
+        # The indices are after the last ":" in the header.
+        barcodes = fastq1_read.name.split(":")[-1].split("+")
+        right_barcode = barcodes[0]
+        left_barcode = barcodes[1]
 
-        # If we are saving the demultipled FASTQ then setup the output files and dataframe.
-        if self.args.Demultiplex:
-            self.fastq_outfile_dict = collections.defaultdict(list)
-            r1 = FASTQ_Tools.Writer(self.log, "{}{}_Unknown_R1.fastq"
-                                    .format(self.args.WorkingFolder, self.args.Job_Name))
-            r2 = FASTQ_Tools.Writer(self.log, "{}{}_Unknown_R2.fastq"
-                                    .format(self.args.WorkingFolder, self.args.Job_Name))
-            self.fastq_outfile_dict['Unknown'] = [r1, r2]
+        if (len(right_barcode), len(left_barcode)) != self.barcode_lengths \
+                or (right_barcode + left_barcode).strip("ACGTN"):
+            return None
 
-        # ToDo: call the demultiplex stuff from FASTQ_Tools.
-        master_index_dict = {}
-        with open(self.args.Master_Index_File) as f:
-            for l in f:
-                if "#" in l or not l:
-                    continue
-                l_list = [x for x in l.strip("\n").split("\t")]
-                master_index_dict[l_list[0]] = [l_list[1], l_list[2]]
+        return right_barcode, left_barcode
 
-        sample_index_list = Tool_Box.FileParser.indices(self.log, self.args.SampleManifest)
-        index_dict = collections.defaultdict(list)
+    def assign_index(self, index_key, fastq1_read, fastq2_read=None):
+        """
+        Count a read for index_key, or as unidentified if index_key is None, and return the same tuple as
+        index_matching().
+        :param index_key:
+        :param fastq1_read:
+        :param fastq2_read:
+        :return:
+        """
+        if index_key is None:
+            self.read_count_dict['unidentified'] = self.read_count_dict.get('unidentified', 0) + 1
+            return False, "", "", 'unidentified', fastq1_read, fastq2_read
 
-        for sample in sample_index_list:
-            index_name = sample[0]
+        self.read_count_dict[index_key] += 1
+        if fastq2_read:
+            # iSeq runs generally have low quality reads on the 3' ends.  This does a blanket trim to remove them.
+            return True, fastq2_read.seq[:-5], fastq1_read.seq[:-5], index_key, fastq1_read, fastq2_read
 
-            if index_name in index_dict:
-                self.log.error("The index {} is duplicated.  Correct the error in {} and try again."
-                               .format(sample[0], self.args.SampleManifest))
-                raise SystemExit(1)
+        return True, "", fastq1_read.seq, index_key, fastq1_read, fastq2_read
 
-            sample_name = sample[1]
-            sample_replicate = sample[2]
-            try:
-                target_name = sample[4]
-            except IndexError:
-                self.log.error("Sample Manifest is missing Target Name column")
-                raise SystemExit(1)
+    def batch_barcode_matching(self, read_batch):
+        """
+        Score the header barcodes of a whole batch against every index with NumPy.  Returns one entry per read: the
+        first index in the manifest within one mismatch on both barcodes, None if there is none, or False if the
+        read has to go through index_matching().  Reads near more than one index are counted as ambiguous.
+        :param read_batch:
+        :return:
+        """
+        batch_keys = [False] * len(read_batch)
+        read_numbers = []
+        right_barcodes = []
+        left_barcodes = []
 
-            left_index_sequence, right_index_sequence = master_index_dict[index_name]
-            index_dict[index_name] = \
-                [right_index_sequence.upper(), 0, left_index_sequence.upper(), 0, index_name, sample_name,
-                 sample_replicate, target_name]
+        for read_number, (fastq1_read, fastq2_read) in enumerate(read_batch):
+            barcodes = self.header_barcodes(fastq1_read)
+            if barcodes:
+                read_numbers.append(read_number)
+                right_barcodes.append(barcodes[0])
+                left_barcodes.append(barcodes[1])
 
-            if self.args.Demultiplex:
-                r1 = FASTQ_Tools.Writer(self.log, "{}{}_{}_R1.fastq"
-                                        .format(self.args.WorkingFolder, self.args.Job_Name, index_name))
-                r2 = ""
-                if not self.args.PEAR:
-                    r2 = FASTQ_Tools.Writer(self.log, "{}{}_{}_R2.fastq"
-                                            .format(self.args.WorkingFolder, self.args.Job_Name, index_name))
-                self.fastq_outfile_dict[index_name] = [r1, r2]
+        if not read_numbers:
+            return batch_keys
 
-        return index_dict
+        match_matrix = (self.barcode_matrices[0].distances(right_barcodes) <= 1) & \
+                       (self.barcode_matrices[1].distances(left_barcodes) <= 1)
+        match_counts = match_matrix.sum(axis=1)
+        best_matches = match_matrix.argmax(axis=1)
+        self.ambiguous_read_count += int((match_counts > 1).sum())
+
+        index_keys = list(self.index_dict)
+        for read_number, match_count, best_match in zip(read_numbers, match_counts, best_matches):
+            batch_keys[read_number] = index_keys[best_match] if match_count else None
+
+        return batch_keys
 
     def index_matching(self, fastq1_read, fastq2_read=None):
         """
-        This matches an index sequence with the index found in the sequence reads.
+        This matches an index sequence with the index found in the sequence reads.  Illumina barcodes of the expected
+        length are looked up in the barcode table; anything else falls back to comparing every index.
         :param fastq1_read:
         :param fastq2_read:
         :return:
         """
+        if self.barcode_table is not None:
+            barcodes = self.header_barcodes(fastq1_read)
+            if barcodes:
+                return self.assign_index(self.barcode_table.get(barcodes), fastq1_read, fastq2_read)
 
         match_found = False
         left_seq = ""
@@ -878,10 +1604,21 @@ class DataProcessing:
         left_match = 5
         right_match = 5
 
+        index_keys = self.index_dict
+
         if self.args.Platform == "Ramsden":
             mismatch = 3
 
-        for index_key in self.index_dict:
+            # Only primers sharing a seed with both ends of the read can be within the mismatch limit.
+            if self.right_seeds is not None:
+                if self.args.PEAR:
+                    left_candidates = self.left_seeds.candidates(fastq1_read.seq, from_end=True)
+                else:
+                    left_candidates = self.left_seeds.candidates(fastq2_read.seq)
+                index_keys = sorted(self.right_seeds.candidates(fastq1_read.seq) & left_candidates,
+                                    key=self.index_order.get)
+
+        for index_key in index_keys:
             left_index = self.index_dict[index_key][0]
             right_index = self.index_dict[index_key][2]
 
@@ -896,7 +1633,7 @@ class DataProcessing:
                         Sequence_Magic.match_maker(left_index, fastq1_read.seq[-len(left_index):])
                 else:
                     left_match = \
-                        Sequence_Magic.match_maker(Sequence_Magic.rcomp(left_index), fastq2_read.seq[:len(left_index)])
+                        Sequence_Magic.match_maker(self.left_rcomp[index_key], fastq2_read.seq[:len(left_index)])
                 right_match = \
                     Sequence_Magic.match_maker(right_index, fastq1_read.seq[:len(right_index)])
 
@@ -924,6 +1661,387 @@ class DataProcessing:
 
         return match_found, left_seq, right_seq, index_key, fastq1_read, fastq2_read
 
+
+class DataProcessing:
+    def __init__(self, log, args, run_start, version, targeting, fq1=None, fq2=None):
+        self.log = log
+        self.args = args
+        self.version = version
+        self.date_format = "%a %b %d %H:%M:%S %Y"
+        self.run_start = run_start
+        self.fastq_outfile_dict = None
+        self.compressor = None
+        if self.args.Demultiplex:
+            self.compressor = Tool_Box.Compressor(log, args.CompressionLevel, args.CompressionThreads, args.BGZF)
+        self.target_dict = targeting.targets
+        self.phase_dict = targeting.phasing
+
+        # Each locus is set up once here rather than by every library.
+        self.target_bundles = targeting.bundles(hr_donor_list(args))
+        self.phase_count = collections.defaultdict(lambda: collections.defaultdict(int))
+        self.index_dict = self.dictionary_build()
+        self.results_dict = collections.defaultdict(list)
+        self.sequence_dict = collections.defaultdict(list)
+        self.read_count_dict = collections.defaultdict()
+        self.fastq1 = fq1
+        self.fastq2 = fq2
+        self.read_count = 0
+        self.unknown_barcodes = None
+
+    def consensus_demultiplex(self):
+        """
+        Takes a FASTQ file of consensus reads and identifies each by index.  Handles writing demultiplexed FASTQ if
+        user desired.  Demultiplexed reads are handed to the compressed writers after each batch so they are never all
+        held in memory.  Uncompressed or BGZF consensus files are split into --DemultiplexShards shards searched in
+        parallel.
+        """
+        self.log.info("Consensus Index Search")
+        fastq_data_dict = None
+        if self.args.Demultiplex:
+            fastq_data_dict = collections.defaultdict(lambda: collections.defaultdict(list))
+        index_search = IndexSearch(self.log, self.args, self.index_dict, self.phase_dict)
+        read_limit = None
+        shards = None
+        memory_budget = self.args.MemoryBudget * 1048576
+
+        # An existing .fqi index gives the read count for progress reports and record aligned shard offsets.
+        fastq_index = FASTQ_Tools.fastq_index(self.fastq1.input_file, self.log, self.args.FastqIndex,
+                                              self.args.FastqIndex)
+        if fastq_index:
+            index_search.total_reads = fastq_index.record_count
+
+        # Debugging Code Block
+        if self.args.Verbose == "DEBUG":
+            read_limit = 1000000
+        elif self.args.PEAR and int(self.args.Spawn) > 1 and self.args.DemultiplexShards > 1:
+            if fastq_index and len(fastq_index.offsets) >= self.args.DemultiplexShards:
+                shards = fastq_index.shards(self.args.DemultiplexShards)
+            if not shards:
+                shards = FASTQ_Tools.fastq_shards(self.fastq1.input_file, self.args.DemultiplexShards)
+
+        if shards and len(shards) > 1:
+            self.log.info("Searching {} shards of {}".format(len(shards), self.fastq1.input_file))
+            p = pathos.multiprocessing.Pool(int(self.args.Spawn))
+            data_list = []
+            for shard, byte_range in enumerate(shards):
+                data_list.append([self.log, self.args, self.index_dict, self.phase_dict, index_search.barcode_table,
+                                  self.fastq1.input_file, byte_range, shard])
+
+            # Shards come back in file order so merged lists keep the order of a serial search.  Each is merged and
+            # spilled as it arrives so the shards are never all held here at once.
+            for shard_search in p.imap(shard_demultiplex_list, data_list):
+                index_search.merge(shard_search)
+                index_search.spill(memory_budget)
+            p.close()
+            p.join()
+
+            if self.args.Demultiplex:
+                for index_name, (r1, r2) in self.fastq_outfile_dict.items():
+                    for shard in range(len(shards)):
+                        shard_file = shard_file_name(self.args, index_name, shard)
+                        if os.path.isfile(shard_file):
+                            r1.append_file(shard_file)
+                            Tool_Box.delete([shard_file])
+        else:
+            # Read and parse the FASTQ on a background thread while the reads are matched here.
+            read_batches = self.read_batches()
+            if self.args.PrefetchDepth > 0:
+                read_batches = FASTQ_Tools.BatchPrefetcher(read_batches, self.args.PrefetchDepth)
+
+            for read_batch in read_batches:
+                limit_reached = index_search.batch_search(read_batch, fastq_data_dict, read_limit)
+                index_search.spill(memory_budget)
+
+                if self.args.Demultiplex:
+                    self.demultiplex_write(fastq_data_dict)
+
+                if limit_reached:
+                    break
+
+            if isinstance(read_batches, FASTQ_Tools.BatchPrefetcher):
+                read_batches.close()
+
+        key_counts = [len(sequence_list) for sequence_list in index_search.sequence_dict.values()]
+        self.sequence_dict = index_search.sequence_dict
+
+        return index_search.indexed_read_count, self.search_results(index_search, fastq_data_dict, key_counts)
+
+    def search_results(self, index_search, fastq_data_dict, key_counts):
+        """
+        Finish the demultiplexed FASTQ files and keep the counts from the index search.  Returns the lower limit on
+        library size used to flag low read libraries.
+        :param index_search:
+        :param fastq_data_dict:
+        :param key_counts: Number of reads found for each library with any.
+        :return:
+        """
+        if self.args.Demultiplex:
+            self.demultiplex_write(fastq_data_dict)
+            for r1, r2 in self.fastq_outfile_dict.values():
+                r1.close()
+                if r2:
+                    r2.close()
+            self.compressor.close()
+
+        self.read_count_dict = index_search.read_count_dict
+        self.phase_count = index_search.phase_count
+        self.read_count = index_search.read_count
+        self.unknown_barcodes = index_search.unknown_barcodes
+
+        if index_search.ambiguous_read_count:
+            self.log.warning("{} reads were within one mismatch of more than one index.  They were assigned to the "
+                             "first of those indices in {}."
+                             .format(index_search.ambiguous_read_count, self.args.SampleManifest))
+
+        lower, upper_limit = stats.norm.interval(0.9, loc=statistics.mean(key_counts), scale=stats.sem(key_counts))
+
+        return statistics.mean(key_counts)-lower
+
+    def pipeline_search(self):
+        """
+        Streaming mode.  This process reads the consensus FASTQ and hands batches to matcher processes.  The matchers
+        send the reads for each library on to aggregator processes that run the scar search as the reads arrive, so
+        the scar search does not wait for demultiplexing to finish.  Returns the ScarSearch results for data_output().
+        :return:
+        """
+        matcher_count = max(1, int(self.args.Spawn) // 2)
+        aggregator_count = max(1, int(self.args.Spawn) - matcher_count)
+        self.log.info("Streaming pipeline with {} index search and {} scar search processes"
+                      .format(matcher_count, aggregator_count))
+
+        fastq_data_dict = None
+        if self.args.Demultiplex:
+            fastq_data_dict = collections.defaultdict(lambda: collections.defaultdict(list))
+        index_search = IndexSearch(self.log, self.args, self.index_dict, self.phase_dict)
+        fastq_index = FASTQ_Tools.fastq_index(self.fastq1.input_file, self.log, self.args.FastqIndex,
+                                              self.args.FastqIndex)
+        if fastq_index:
+            index_search.total_reads = fastq_index.record_count
+
+        # Libraries are spread over the aggregators in manifest order.
+        routes = {index_name: i % aggregator_count for i, index_name in enumerate(self.index_dict)}
+        read_queues = [pathos.helpers.mp.Queue(4 * matcher_count) for i in range(aggregator_count)]
+        result_queue = pathos.helpers.mp.Queue()
+        aggregators = []
+        for read_queue in read_queues:
+            aggregator = pathos.helpers.mp.Process(
+                target=pipeline_aggregator,
+                args=(self.log, self.args, self.version, self.run_start, self.target_dict, self.index_dict,
+                      self.target_bundles, read_queue, result_queue))
+            aggregator.start()
+            aggregators.append(aggregator)
+
+        p = pathos.multiprocessing.Pool(
+            matcher_count, pipeline_matcher_setup,
+            (self.log, self.args, self.index_dict, self.phase_dict, index_search.barcode_table, read_queues, routes))
+
+        # Results are collected in submission order and only a few batches are allowed in flight so the reader can not
+        # run ahead of the searches.
+        library_sizes = collections.OrderedDict()
+        in_flight = collections.deque()
+        batch_count = 0
+        for read_batch in self.read_batches():
+            in_flight.append(p.apply_async(pipeline_match, (batch_count, read_batch)))
+            batch_count += 1
+            if len(in_flight) > 2 * matcher_count:
+                self.pipeline_merge(self.pipeline_result(in_flight.popleft(), aggregators), index_search,
+                                    library_sizes, fastq_data_dict)
+        while in_flight:
+            self.pipeline_merge(self.pipeline_result(in_flight.popleft(), aggregators), index_search, library_sizes,
+                                fastq_data_dict)
+        p.close()
+        p.join()
+
+        lower_limit = self.search_results(index_search, fastq_data_dict, list(library_sizes.values()))
+        for read_queue in read_queues:
+            while True:
+                try:
+                    read_queue.put((None, batch_count, index_search.indexed_read_count, lower_limit), timeout=10)
+                    break
+                except queue.Full:
+                    self.pipeline_check(aggregators)
+
+        scar_search_dict = {}
+        while len(scar_search_dict) < len(library_sizes):
+            try:
+                for scar_search in result_queue.get(timeout=10):
+                    scar_search_dict[scar_search.index_name] = scar_search
+            except queue.Empty:
+                self.pipeline_check(aggregators)
+        for aggregator in aggregators:
+            aggregator.join()
+
+        # Largest libraries first, as in main_loop().
+        return [scar_search_dict[index_name]
+                for index_name in sorted(library_sizes, key=lambda k: library_sizes[k], reverse=True)]
+
+    def pipeline_result(self, match_result, aggregators):
+        """
+        Wait for a pipeline_match() result.  A matcher stuck on the queue of a dead aggregator never returns, so the
+        aggregators are checked while waiting.
+        :param match_result: AsyncResult from the matcher pool.
+        :param aggregators:
+        :return:
+        """
+        while True:
+            try:
+                return match_result.get(timeout=10)
+            except pathos.helpers.mp.TimeoutError:
+                self.pipeline_check(aggregators)
+
+    def pipeline_check(self, aggregators):
+        """
+        Stop the run if a scar search process has died.  The others are stopped too so the exit does not wait on them.
+        :param aggregators:
+        """
+        if any(aggregator.exitcode for aggregator in aggregators):
+            self.log.error("A scar search process failed.  See the log for details.")
+            for aggregator in aggregators:
+                aggregator.terminate()
+            raise SystemExit(1)
+
+    def pipeline_merge(self, match_result, index_search, library_sizes, fastq_data_dict):
+        """
+        Add the results of one pipeline_match() to the run totals and write its demultiplexed reads.
+        :param match_result:
+        :param index_search:
+        :param library_sizes:
+        :param fastq_data_dict:
+        """
+        batch_search, batch_sizes, batch_fastq_dict = match_result
+        read_count = index_search.read_count
+        index_search.merge(batch_search)
+        for index_name, size in batch_sizes.items():
+            library_sizes[index_name] = library_sizes.get(index_name, 0) + size
+
+        if index_search.read_count // 100000 > read_count // 100000:
+            self.log.info("Searched {} reads in {} seconds."
+                          .format(index_search.read_count, int(time.time() - index_search.start_time)))
+
+        if fastq_data_dict is not None:
+            for index_name, read_dict in batch_fastq_dict.items():
+                for read, read_list in read_dict.items():
+                    fastq_data_dict[index_name][read].extend(read_list)
+            self.demultiplex_write(fastq_data_dict)
+
+    def read_batches(self):
+        """
+        Yields lists of (read 1, read 2) tuples.  Read 2 is None when working with PEAR consensus reads.
+        """
+        if self.args.PEAR:
+            for read_batch in self.fastq1:
+                yield [(fastq1_read, None) for fastq1_read in read_batch]
+        else:
+            yield from FASTQ_Tools.PairedFastqReader(self.log, self.fastq1, self.fastq2)
+
+    def demultiplex_write(self, fastq_data_dict):
+        """
+        Hand the reads gathered for each index to the compressed FASTQ writers.  The writers clear the lists.
+        :param fastq_data_dict:
+        """
+        for index_name in fastq_data_dict:
+            r1, r2 = self.fastq_outfile_dict[index_name]
+            r1.write(fastq_data_dict[index_name]["R1"])
+            if not self.args.PEAR:
+                r2.write(fastq_data_dict[index_name]["R2"])
+            else:
+                fastq_data_dict[index_name]["R2"].clear()
+
+    def main_loop(self):
+        """
+        Main entry point for repair scar search and processing.
+        """
+
+        if self.args.Pipeline and self.args.Verbose != "DEBUG":
+            self.log.info("Beginning main loop|Demultiplexing FASTQ and searching libraries")
+            self.data_output(self.pipeline_search())
+            self.log.info("Main Loop Finished")
+            return
+
+        self.log.info("Beginning main loop|Demultiplexing FASTQ")
+        indexed_read_count, lower_limit = self.consensus_demultiplex()
+
+        self.log.info("Spawning {} Jobs to Process {} Libraries".format(self.args.Spawn, len(self.sequence_dict)))
+        p = pathos.multiprocessing.Pool(int(self.args.Spawn))
+
+        # My solution for passing key:value pairs to the multiprocessor.  Largest value group goes first.
+        data_list = []
+        for key in sorted(self.sequence_dict, key=lambda k: len(self.sequence_dict[k]), reverse=True):
+            data_list.append([self.log, self.args, self.version, self.run_start, self.target_dict, self.index_dict,
+                              key, self.sequence_dict[key], indexed_read_count, lower_limit,
+                              self.target_bundles.get(self.index_dict[key][7])])
+
+        # Not sure if clearing this is really necessary but it is not used again so why keep the RAM tied up.
+        self.sequence_dict.clear()
+
+        # Each job is a single instance of the ScarSearch class..
+        self.data_output(p.starmap(ScarSearch, data_list))
+
+        self.log.info("Main Loop Finished")
+
+    def dictionary_build(self):
+        """
+        Build the index dictionary from the index list.
+        :return:
+        """
+
+        self.log.info("Building DataFrames.")
+
+        # If we are saving the demultipled FASTQ then setup the output files and dataframe.
+        if self.args.Demultiplex:
+            self.fastq_outfile_dict = collections.defaultdict(list)
+            r1 = FASTQ_Tools.Writer(self.log, "{}{}_Unknown_R1.fastq.gz"
+                                    .format(self.args.WorkingFolder, self.args.Job_Name), self.compressor)
+            r2 = FASTQ_Tools.Writer(self.log, "{}{}_Unknown_R2.fastq.gz"
+                                    .format(self.args.WorkingFolder, self.args.Job_Name), self.compressor)
+            self.fastq_outfile_dict['Unknown'] = [r1, r2]
+
+        # ToDo: call the demultiplex stuff from FASTQ_Tools.
+        master_index_dict = {}
+        with open(self.args.Master_Index_File) as f:
+            for l in f:
+                if "#" in l or not l:
+                    continue
+                l_list = [x for x in l.strip("\n").split("\t")]
+                master_index_dict[l_list[0]] = [l_list[1], l_list[2]]
+
+        sample_index_list = Tool_Box.FileParser.indices(self.log, self.args.SampleManifest)
+        index_dict = collections.defaultdict(list)
+
+        for sample in sample_index_list:
+            index_name = sample[0]
+
+            if index_name in index_dict:
+                self.log.error("The index {} is duplicated.  Correct the error in {} and try again."
+                               .format(sample[0], self.args.SampleManifest))
+                raise SystemExit(1)
+
+            sample_name = sample[1]
+            sample_replicate = sample[2]
+            try:
+                target_name = sample[4]
+            except IndexError:
+                self.log.error("Sample Manifest is missing Target Name column")
+                raise SystemExit(1)
+
+            left_index_sequence, right_index_sequence = master_index_dict[index_name]
+            index_dict[index_name] = \
+                [right_index_sequence.upper(), 0, left_index_sequence.upper(), 0, index_name, sample_name,
+                 sample_replicate, target_name]
+
+            if self.args.Demultiplex:
+                r1 = FASTQ_Tools.Writer(self.log, "{}{}_{}_R1.fastq.gz"
+                                        .format(self.args.WorkingFolder, self.args.Job_Name, index_name),
+                                        self.compressor)
+                r2 = ""
+                if not self.args.PEAR:
+                    r2 = FASTQ_Tools.Writer(self.log, "{}{}_{}_R2.fastq.gz"
+                                            .format(self.args.WorkingFolder, self.args.Job_Name, index_name),
+                                            self.compressor)
+                self.fastq_outfile_dict[index_name] = [r1, r2]
+
+        return index_dict
+
     def data_output(self, summary_data_list):
         """
         Format data and write the summary file.
@@ -934,9 +2052,14 @@ class DataProcessing:
 
         summary_file = open("{}{}_ScarMapper_Summary.txt".format(self.args.WorkingFolder, self.args.Job_Name), "w")
 
+        # With more than one donor each also gets its own count and fraction after the totals.
+        hr_donors = hr_donor_list(self.args)
         hr_labels = ""
-        if self.args.HR_Donor:
+        if hr_donors:
             hr_labels = "\tHR Count\tHR Fraction"
+            if len(hr_donors) > 1:
+                for hr_donor in hr_donors:
+                    hr_labels += "\t{0} HR Count\t{0} HR Fraction".format(hr_donor)
 
         sub_header = \
             "No Junction\tScar Count\tScar Fraction{}\tLeft Deletion Count\tRight Deletion Count\t" \
@@ -953,8 +2076,8 @@ class DataProcessing:
                 break
 
         hr_data = ""
-        if self.args.HR_Donor:
-            hr_data = "HR Donor: {}\n".format(self.args.HR_Donor)
+        if hr_donors:
+            hr_data = "HR Donor: {}\n".format(", ".join(hr_donors))
 
         run_stop = datetime.datetime.today().strftime(self.date_format)
         summary_outstring = \
@@ -1010,10 +2133,14 @@ class DataProcessing:
 
             # Process HR data if present
             hr_data = ""
-            if self.args.HR_Donor:
+            if hr_donors:
                 hr_count = "{}; {}".format(data_list.summary_data[10][0], data_list.summary_data[10][1])
                 hr_frequency = sum(data_list.summary_data[10])/passing_filters
                 hr_data = "\t{}\t{}".format(hr_count, hr_frequency)
+                if len(hr_donors) > 1:
+                    for donor_counts in data_list.summary_data[11]:
+                        hr_data += "\t{}; {}\t{}"\
+                            .format(donor_counts[0], donor_counts[1], sum(donor_counts)/passing_filters)
 
             try:
                 tmej = data_list.summary_data[8][0]
@@ -1049,5 +2176,12 @@ class DataProcessing:
         summary_outstring += "\nUnidentified\t{}\t{}" \
             .format(self.read_count_dict["unidentified"], self.read_count_dict["unidentified"] / self.read_count)
 
+        # The counts come from a Space-Saving sketch so each may be over by up to its Maximum Overcount.
+        if self.unknown_barcodes is not None and self.unknown_barcodes.counts:
+            summary_outstring += "\n\nMost Common Unidentified Barcodes\nBarcode\tCount\tFraction Total\t" \
+                                 "Maximum Overcount\n"
+            for barcode, count, error in self.unknown_barcodes.most_common(self.args.UnknownBarcodes):
+                summary_outstring += "{}\t{}\t{}\t{}\n".format(barcode, count, count / self.read_count, error)
+
         summary_file.write(summary_outstring)
         summary_file.close()
@@ -13,13 +13,448 @@ Cython version of Sliding Window Module
 
 """
 
-__version__ = "0.5.0"
-
+__version__ = "0.10.1"
+
+import collections
+from array import array
+cimport cython
+from libc.stdint cimport int64_t, uint64_t
+from libc.string cimport memchr, memcmp
+import numpy
 from Valkyries import Tool_Box
 
+cdef enum:
+    WINDOW = 10
+
+cdef uint64_t HASH_BASE = 1099511628211
+
+
+cdef struct Junctions:
+    # True if the left junction window is the cut window, which is scored as no cut.
+    bint no_cut
+    int consensus_lft_junction
+    int consensus_rt_junction
+    int target_lft_junction
+    int target_rt_junction
+
+
+cdef inline uint64_t window_hash(const unsigned char* window) noexcept nogil:
+    cdef uint64_t window_value = 0
+    cdef int i
+    for i in range(WINDOW):
+        window_value = window_value * HASH_BASE + window[i]
+    return window_value
+
+
+cdef class TargetWindows:
+    """
+    The 10 nt windows on either side of the cutsite, hashed and sorted so find_junctions() can look a read window up
+    with a binary search and a memcmp.  Equal hashes are sorted by position so the first window wins, as in the list
+    scan.
+    """
+    cdef readonly bytes target
+    cdef readonly bytes cutwindow
+    cdef readonly int cutsite
+    cdef readonly int left_count
+    cdef readonly int right_count
+    cdef const unsigned char[:] target_view
+    cdef const unsigned char[:] cutwindow_view
+    cdef int cutwindow_length
+    cdef const uint64_t[:] left_hashes
+    cdef const int[:] left_positions
+    cdef const uint64_t[:] right_hashes
+    cdef const int[:] right_positions
+
+    def __init__(self, str target_region, int cutsite, int left_count, int right_count, str cutwindow):
+        """
+        :param target_region:
+        :param cutsite:
+        :param left_count: Length of ScarSearch.left_target_windows.
+        :param right_count: Length of ScarSearch.right_target_windows.
+        :param cutwindow:
+        """
+        cdef const unsigned char* target_pointer
+        cdef int i, start
+        self.target = target_region.encode()
+        self.cutwindow = cutwindow.encode()
+        self.cutsite = cutsite
+        self.left_count = left_count
+        self.right_count = right_count
+        self.target_view = self.target
+        self.cutwindow_view = self.cutwindow
+        self.cutwindow_length = len(self.cutwindow)
+        target_pointer = self.target
+
+        # Windows that run off the target region are short and can never match a read window.
+        left_windows = []
+        for i in range(left_count):
+            start = cutsite - WINDOW - i
+            if 0 <= start and start + WINDOW <= len(self.target):
+                left_windows.append((window_hash(target_pointer + start), i))
+        right_windows = []
+        for i in range(right_count):
+            start = cutsite + i
+            if 0 <= start and start + WINDOW <= len(self.target):
+                right_windows.append((window_hash(target_pointer + start), i))
+
+        left_windows.sort()
+        right_windows.sort()
+        self.left_hashes = array('Q', [window[0] for window in left_windows])
+        self.left_positions = array('i', [window[1] for window in left_windows])
+        self.right_hashes = array('Q', [window[0] for window in right_windows])
+        self.right_positions = array('i', [window[1] for window in right_windows])
+
+    def __reduce__(self):
+        # Rebuilt from the target region rather than pickling the C buffers.
+        return TargetWindows, (self.target.decode(), self.cutsite, self.left_count, self.right_count,
+                               self.cutwindow.decode())
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline int window_lookup(const unsigned char* query, const unsigned char* target, const uint64_t[:] hashes,
+                              const int[:] positions, int cutsite, bint left) noexcept nogil:
+    """
+    Position of the first target window equal to the read window at query, or -1.
+    """
+    cdef uint64_t query_hash = window_hash(query)
+    cdef Py_ssize_t low = 0
+    cdef Py_ssize_t high = hashes.shape[0]
+    cdef Py_ssize_t middle
+    cdef int start
+
+    while low < high:
+        middle = (low + high) // 2
+        if hashes[middle] < query_hash:
+            low = middle + 1
+        else:
+            high = middle
+
+    while low < hashes.shape[0] and hashes[low] == query_hash:
+        if left:
+            start = cutsite - WINDOW - positions[low]
+        else:
+            start = cutsite + positions[low]
+        if memcmp(query, target + start, WINDOW) == 0:
+            return positions[low]
+        low += 1
+
+    return -1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Junctions junction_search(const unsigned char[:] consensus, TargetWindows target_windows,
+                               int lower_limit) noexcept nogil:
+    """
+    The junction search of sliding_window() on byte buffers.
+    """
+    cdef Junctions junctions
+    cdef Py_ssize_t consensus_length = consensus.shape[0]
+    cdef Py_ssize_t lft_position, rt_position
+    cdef const unsigned char* consensus_pointer
+    cdef const unsigned char* target_pointer = &target_windows.target_view[0]
+    cdef int i
+
+    junctions.no_cut = False
+    junctions.consensus_lft_junction = 0
+    junctions.consensus_rt_junction = 0
+    junctions.target_lft_junction = target_windows.cutsite
+    junctions.target_rt_junction = target_windows.cutsite
+    if consensus_length == 0:
+        return junctions
+    consensus_pointer = &consensus[0]
+
+    # 5' junction, moving from the 3' end of the read toward the 5' end.
+    rt_position = consensus_length - WINDOW
+    lft_position = rt_position - WINDOW
+    while lft_position > lower_limit:
+        i = window_lookup(consensus_pointer + lft_position, target_pointer, target_windows.left_hashes,
+                          target_windows.left_positions, target_windows.cutsite, True)
+        if i >= 0:
+            if target_windows.cutwindow_length == WINDOW and \
+                    memcmp(consensus_pointer + lft_position, &target_windows.cutwindow_view[0], WINDOW) == 0:
+                junctions.no_cut = True
+                return junctions
+            junctions.target_lft_junction = target_windows.cutsite - i
+            junctions.consensus_lft_junction = rt_position
+            break
+        lft_position -= 1
+        rt_position -= 1
+
+    # 3' junction, moving from position 10 of the read toward the 3' end.
+    lft_position = 10
+    rt_position = lft_position + WINDOW
+    while rt_position < consensus_length - 15:
+        i = window_lookup(consensus_pointer + lft_position, target_pointer, target_windows.right_hashes,
+                          target_windows.right_positions, target_windows.cutsite, False)
+        if i >= 0:
+            junctions.target_rt_junction = target_windows.cutsite + i
+            junctions.consensus_rt_junction = lft_position
+            break
+        lft_position += 1
+        rt_position += 1
+
+    return junctions
+
+
+cpdef tuple find_junctions(const unsigned char[:] consensus, TargetWindows target_windows, int lower_limit):
+    """
+    Find the junctions of a read given as bytes.  The GIL is released during the search so reads can be searched from
+    several threads.
+    :return: (no cut, consensus left junction, consensus right junction, target left junction, target right junction)
+    """
+    cdef Junctions junctions
+    with nogil:
+        junctions = junction_search(consensus, target_windows, lower_limit)
+
+    return (junctions.no_cut, junctions.consensus_lft_junction, junctions.consensus_rt_junction,
+            junctions.target_lft_junction, junctions.target_rt_junction)
+
+
+cdef class DonorScanner:
+    """
+    Aho-Corasick automaton over the HR donor sequences.  A read is scanned once, one table lookup per base, whatever
+    the number of donors.  Each donor is counted as in the single donor search: the first copy found between 25 nt from
+    either end of the read, and any more copies.
+    """
+    cdef readonly tuple donors
+    cdef const int[:, :] transitions
+    cdef const int[:] terminal
+    cdef const int[:] output
+    cdef const int[:] lengths
+
+    def __init__(self, donors):
+        """
+        :param donors: Donor sequences.  Blanks and repeats are dropped.
+        """
+        self.donors = tuple(donor for donor in collections.OrderedDict.fromkeys(donors) if donor)
+
+        # Trie of the donors.  terminal is the donor ending at a state, or -1.
+        goto = [{}]
+        terminal = [-1]
+        for donor_number, donor in enumerate(self.donors):
+            state = 0
+            for base in donor.encode():
+                if base not in goto[state]:
+                    goto[state][base] = len(goto)
+                    goto.append({})
+                    terminal.append(-1)
+                state = goto[state][base]
+            terminal[state] = donor_number
+
+        # Breadth first so the failure link of each state, the longest suffix that is also in the trie, is finished
+        # before it is needed.  output links a state to the next donor ending along its chain of failure links.
+        transitions = numpy.zeros((len(goto), 256), dtype=numpy.int32)
+        fail = [0] * len(goto)
+        output = [-1] * len(goto)
+        states = collections.deque()
+        for base, child in goto[0].items():
+            transitions[0, base] = child
+            states.append(child)
+
+        while states:
+            state = states.popleft()
+            transitions[state] = transitions[fail[state]]
+            output[state] = fail[state] if terminal[fail[state]] >= 0 else output[fail[state]]
+            for base, child in goto[state].items():
+                fail[child] = transitions[fail[state], base]
+                transitions[state, base] = child
+                states.append(child)
+
+        self.transitions = transitions
+        self.terminal = array('i', terminal)
+        self.output = array('i', output)
+        self.lengths = array('i', [len(donor) for donor in self.donors])
+
+    def counts(self, str consensus):
+        """
+        First copy found and number of further copies of each donor in consensus.
+        :param consensus:
+        :return: (found, extra) arrays with one entry per donor.
+        """
+        found = numpy.zeros(len(self.donors), dtype=numpy.uint8)
+        extra = numpy.zeros(len(self.donors), dtype=numpy.int32)
+        donor_scan(consensus.encode(), self, found, extra)
+
+        return found, extra
+
+    def __reduce__(self):
+        return DonorScanner, (list(self.donors),)
+
+    def __len__(self):
+        return len(self.donors)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef bint donor_scan(const unsigned char[:] consensus, DonorScanner scanner, unsigned char[:] found,
+                     int[:] extra) noexcept nogil:
+    """
+    Count the copies of each donor in consensus into found and extra.  Returns True if any donor was found.
+    """
+    cdef Py_ssize_t position
+    cdef Py_ssize_t length = consensus.shape[0]
+    cdef int state = 0
+    cdef int match, donor
+    cdef bint donor_found = False
+
+    # A copy must end before the last 25 nt.
+    for position in range(length - 26):
+        state = scanner.transitions[state, consensus[position]]
+        match = state if scanner.terminal[state] >= 0 else scanner.output[state]
+        while match > 0:
+            donor = scanner.terminal[match]
+            if position + 1 - scanner.lengths[donor] >= 25:
+                if found[donor]:
+                    extra[donor] += 1
+                else:
+                    found[donor] = 1
+                    donor_found = True
+            match = scanner.output[match]
+
+    return donor_found
+
+cdef inline int window_position(str query_segment, object target_windows, bint window_dict):
+    """
+    Position of the first target window equal to query_segment, or -1.
+    """
+    cdef int i
+    if window_dict:
+        return target_windows.get(query_segment, -1)
+
+    for i, target_segment in enumerate(target_windows):
+        if query_segment == target_segment:
+            return i
+
+    return -1
+
+
+# junction_batch() status codes.
+cdef enum:
+    STATUS_SCAR = 0
+    STATUS_NO_CUT = 1
+    STATUS_NO_JUNCTION = 2
+    STATUS_N_INSERTION = 3
+
+SCAR = STATUS_SCAR
+NO_CUT = STATUS_NO_CUT
+NO_JUNCTION = STATUS_NO_JUNCTION
+N_INSERTION = STATUS_N_INSERTION
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def junction_batch(const unsigned char[:] data, const int64_t[:] ends, TargetWindows target_windows, int lower_limit,
+                   DonorScanner hr_donors):
+    """
+    sliding_window() for a block of reads packed end to end in data, as in a byte SequenceStore.  The search runs
+    without the GIL and the results come back as NumPy columns, one row per read.  status is SCAR, NO_CUT,
+    NO_JUNCTION or N_INSERTION; the insertion, left_deletion, right_deletion and microhomology flags and the HR
+    columns are the summary_data counts sliding_window() would have added for the read.  hr_found and hr_extra have a
+    column for each donor and hr is set if any donor was found.
+    :param data:
+    :param ends: End offset of each read in data.
+    :param target_windows:
+    :param lower_limit:
+    :param hr_donors: DonorScanner or None.
+    :return: Dictionary of column name: array.
+    """
+    cdef Py_ssize_t read_count = ends.shape[0]
+    cdef Py_ssize_t donor_count = len(hr_donors) if hr_donors is not None else 0
+    cdef Py_ssize_t read, start, end
+    cdef int cutsite = target_windows.cutsite
+    cdef const unsigned char* consensus
+    cdef Junctions junctions
+    cdef bint cut_found
+
+    columns = {"status": numpy.zeros(read_count, dtype=numpy.int8),
+               "consensus_lft_junction": numpy.zeros(read_count, dtype=numpy.int32),
+               "consensus_rt_junction": numpy.zeros(read_count, dtype=numpy.int32),
+               "target_lft_junction": numpy.zeros(read_count, dtype=numpy.int32),
+               "target_rt_junction": numpy.zeros(read_count, dtype=numpy.int32),
+               "insertion": numpy.zeros(read_count, dtype=numpy.uint8),
+               "left_deletion": numpy.zeros(read_count, dtype=numpy.uint8),
+               "right_deletion": numpy.zeros(read_count, dtype=numpy.uint8),
+               "microhomology": numpy.zeros(read_count, dtype=numpy.uint8),
+               "hr": numpy.zeros(read_count, dtype=numpy.uint8),
+               "hr_found": numpy.zeros((read_count, donor_count), dtype=numpy.uint8),
+               "hr_extra": numpy.zeros((read_count, donor_count), dtype=numpy.int32)}
+
+    cdef signed char[:] status = columns["status"]
+    cdef int[:] consensus_lft_junction = columns["consensus_lft_junction"]
+    cdef int[:] consensus_rt_junction = columns["consensus_rt_junction"]
+    cdef int[:] target_lft_junction = columns["target_lft_junction"]
+    cdef int[:] target_rt_junction = columns["target_rt_junction"]
+    cdef unsigned char[:] insertion = columns["insertion"]
+    cdef unsigned char[:] left_deletion = columns["left_deletion"]
+    cdef unsigned char[:] right_deletion = columns["right_deletion"]
+    cdef unsigned char[:] microhomology = columns["microhomology"]
+    cdef unsigned char[:] hr = columns["hr"]
+    cdef unsigned char[:, :] hr_found = columns["hr_found"]
+    cdef int[:, :] hr_extra = columns["hr_extra"]
+
+    with nogil:
+        start = 0
+        for read in range(read_count):
+            end = ends[read]
+            junctions = junction_search(data[start:end], target_windows, lower_limit)
+            consensus_lft_junction[read] = junctions.consensus_lft_junction
+            consensus_rt_junction[read] = junctions.consensus_rt_junction
+            target_lft_junction[read] = junctions.target_lft_junction
+            target_rt_junction[read] = junctions.target_rt_junction
+
+            if junctions.no_cut:
+                status[read] = STATUS_NO_CUT
+            elif junctions.consensus_lft_junction < 1 and junctions.consensus_rt_junction < 1:
+                status[read] = STATUS_NO_JUNCTION
+            else:
+                consensus = &data[start]
+
+                # HR donors: the first copy of each is counted in hr_found and any more in hr_extra.
+                if donor_count and donor_scan(data[start:end], hr_donors, hr_found[read], hr_extra[read]):
+                    hr[read] = 1
+
+                cut_found = False
+                if 0 < junctions.consensus_lft_junction < junctions.consensus_rt_junction:
+                    if memchr(consensus + junctions.consensus_lft_junction, b'N',
+                              junctions.consensus_rt_junction - junctions.consensus_lft_junction) != NULL:
+                        status[read] = STATUS_N_INSERTION
+                        start = end
+                        continue
+                    cut_found = True
+                    insertion[read] = 1
+
+                if junctions.target_lft_junction < cutsite:
+                    cut_found = True
+                    left_deletion[read] = 1
+
+                if junctions.target_rt_junction > cutsite:
+                    cut_found = True
+                    right_deletion[read] = 1
+
+                if junctions.consensus_lft_junction > junctions.consensus_rt_junction > 0:
+                    cut_found = True
+                    microhomology[read] = 1
+
+                if not cut_found:
+                    status[read] = STATUS_NO_CUT
+            start = end
+
+    return columns
+
+
 cpdef sliding_window(str consensus, str target_region, int cutsite, int target_length, int lower_limit, int upper_limit,
-                     object summary_data, list left_target_windows, list right_target_windows, str cutwindow,
-                     str hr_donor):
+                     object summary_data, object left_target_windows, object right_target_windows, str cutwindow,
+                     object hr_donor):
+    """
+    The target windows are either lists, which are scanned in order, or dictionaries of window: list position built
+    with the first position of any repeated window, which give the same result with one lookup per query window.  A
+    TargetWindows given as left_target_windows runs the junction search in junction_search() instead.  hr_donor is a
+    single donor sequence or a DonorScanner; with a DonorScanner the counts for each donor are added to
+    summary_data[11].  summary_data[10] counts reads, as with a single donor: the read is counted once if any donor is
+    found and every further donor copy in it is a repeat.
+    """
 
     cdef int consensus_length = len(consensus)
     cdef int consensus_lft_junction = 0
@@ -33,13 +468,31 @@ cpdef sliding_window(str consensus, str target_region, int cutsite, int target_l
 
     ldel = ""
     rdel = ""
+    hr_label = ""
 
     cdef bint left_found = False
     cdef bint right_found = False
     cdef bint cut_found = False
+    cdef bint window_dict = isinstance(left_target_windows, dict)
+    cdef Junctions junctions
 
     cdef int lft_position, rt_position, consensus_rt_position, consensus_lft_position, i
 
+    if isinstance(left_target_windows, TargetWindows):
+        junctions = junction_search(consensus.encode(), left_target_windows, lower_limit)
+        if junctions.no_cut:
+            summary_data[6][1] += 1
+            return [], summary_data
+
+        consensus_lft_junction = junctions.consensus_lft_junction
+        consensus_rt_junction = junctions.consensus_rt_junction
+        target_lft_junction = junctions.target_lft_junction
+        target_rt_junction = junctions.target_rt_junction
+        ldel = target_region[target_lft_junction:cutsite]
+        rdel = target_region[cutsite:target_rt_junction]
+        left_found = True
+        right_found = True
+
     '''
     Find the 5' junction.  Start at the cut position, derived from the target region, and move toward the 5'
     end of the read one nucleotide at a time using a 10 nucleotide sliding window.  The 3' position of
@@ -51,19 +504,18 @@ cpdef sliding_window(str consensus, str target_region, int cutsite, int target_l
 
     while not left_found and consensus_lft_position > lower_limit:
         query_segment = consensus[consensus_lft_position:consensus_rt_position]
-        for i, target_segment in enumerate(left_target_windows):
-            if query_segment == target_segment:
-                query_cutwindow = consensus[consensus_lft_position:consensus_rt_position]
+        i = window_position(query_segment, left_target_windows, window_dict)
+        if i >= 0:
+            query_cutwindow = consensus[consensus_lft_position:consensus_rt_position]
 
-                if query_cutwindow == cutwindow:
-                    summary_data[6][1] += 1
-                    return [], summary_data
+            if query_cutwindow == cutwindow:
+                summary_data[6][1] += 1
+                return [], summary_data
 
-                left_found = True
-                target_lft_junction = cutsite-i
-                consensus_lft_junction = consensus_rt_position
-                ldel = target_region[target_lft_junction:cutsite]
-                break
+            left_found = True
+            target_lft_junction = cutsite-i
+            consensus_lft_junction = consensus_rt_position
+            ldel = target_region[target_lft_junction:cutsite]
 
         consensus_lft_position -= 1
         consensus_rt_position -= 1
@@ -80,13 +532,12 @@ cpdef sliding_window(str consensus, str target_region, int cutsite, int target_l
     consensus_rt_position = consensus_lft_position+10
     while not right_found and consensus_rt_position < upper_consensus_limit:
         query_segment = consensus[consensus_lft_position:consensus_rt_position]
-        for i, target_segment in enumerate(right_target_windows):
-            if query_segment == target_segment:
-                right_found = True
-                target_rt_junction = cutsite+i
-                consensus_rt_junction = consensus_lft_position
-                rdel = target_region[cutsite:target_rt_junction]
-                break
+        i = window_position(query_segment, right_target_windows, window_dict)
+        if i >= 0:
+            right_found = True
+            target_rt_junction = cutsite+i
+            consensus_rt_junction = consensus_lft_position
+            rdel = target_region[cutsite:target_rt_junction]
 
         # increment consensus window
         consensus_lft_position += 1
@@ -98,7 +549,19 @@ cpdef sliding_window(str consensus, str target_region, int cutsite, int target_l
         return [], summary_data
 
     # If requested, do a search for HR Donor
-    if hr_donor:
+    if isinstance(hr_donor, DonorScanner):
+        found, extra = hr_donor.counts(consensus)
+        if found.any():
+            hr_label = "HR"
+
+        summary_data[10][0] += int(found.any())
+        summary_data[10][1] += int(found.sum()) + int(extra.sum()) - int(found.any())
+
+        for i in range(len(hr_donor)):
+            summary_data[11][i][0] += int(found[i])
+            summary_data[11][i][1] += int(extra[i])
+
+    elif hr_donor:
         rt_position = len(hr_donor)+25
         lft_position = 25
         donor_found = False
@@ -112,7 +575,6 @@ cpdef sliding_window(str consensus, str target_region, int cutsite, int target_l
             rt_position+=1
             lft_position+=1
 
-        hr_label = ""
         if donor_found:
             hr_label = "HR"
         # If HR Donor is found then find but do not score INDELS
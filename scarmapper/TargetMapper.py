@@ -7,13 +7,21 @@
 """
 
 import collections
+import numpy
 from Valkyries import Tool_Box, Sequence_Magic
+from scarmapper import SlidingWindow
 import pysam
 
 __author__ = 'Dennis A. Simpson'
-__version__ = '0.11.0'
+__version__ = '0.12.0'
 __package__ = 'ScarMapper'
 
+# The per locus search tables.  Built once by TargetMapper.bundles() and only read after that.
+TargetBundle = collections.namedtuple(
+    "TargetBundle", ["target_name", "target_region", "cutsite", "reverse_complement", "lower_limit", "upper_limit",
+                     "left_target_windows", "right_target_windows", "left_window_dict", "right_window_dict",
+                     "target_windows", "wild_type_sequences"])
+
 
 class TargetMapper:
     def __init__(self, log, args, sample_manifest):
@@ -99,4 +107,131 @@ class TargetMapper:
 
         return target_dict
 
+    def bundles(self, hr_donors):
+        """
+        Build the TargetBundle of each locus in the sample manifest.  Each is made once here, in the parent process, and
+        shared by every library at the locus.
+        :param hr_donors: HR Donor sequences.  Needed to find the wild type amplicons.
+        :return: Dictionary of locus name: TargetBundle.
+        """
+        target_dict = self.targets
+        hr_donor = SlidingWindow.DonorScanner(hr_donors) if hr_donors else None
+        bundle_dict = {}
+
+        for sample in self.sample_manifest:
+            locus = sample[4]
+
+            # Only need to process each locus 1x.  ScarSearch reports loci missing from the target file.
+            if locus in bundle_dict or locus not in target_dict:
+                continue
+
+            bundle_dict[locus] = self.target_bundle(target_dict[locus], hr_donor)
+
+        return bundle_dict
+
+    def target_bundle(self, target, hr_donor):
+        """
+        Fetch the target region, find the cutsite and build the search tables for one locus.
+        :param target: target_dict entry.
+        :param hr_donor: DonorScanner or None.
+        :return:
+        """
+        locus_name, chrm, start, stop, sgrna, rcomp = target
+        reverse_complement = rcomp == "YES"
+        target_region = self.refseq.fetch(chrm, start, stop)
+        Tool_Box.debug_messenger([locus_name, target_region])
+        cutsite = self.cutsite_search(locus_name, target_region, sgrna, reverse_complement, chrm, start, stop)
+        target_length = len(target_region)
+
+        # Set upper and lower limit to be 5 nt from end of primers
+        lower_limit = 15
+        upper_limit = target_length-15
+
+        # Predetermine all the sliding window results for the target region.
+        left_target_windows = []
+        lft_position = cutsite-10
+        rt_position = cutsite
+        while rt_position > lower_limit:
+            left_target_windows.append(target_region[lft_position:rt_position])
+            lft_position -= 1
+            rt_position -= 1
+
+        right_target_windows = []
+        lft_position = cutsite
+        rt_position = cutsite+10
+        while lft_position < upper_limit:
+            right_target_windows.append(target_region[lft_position:rt_position])
+            lft_position += 1
+            rt_position += 1
+
+        # --WindowEngine Hash looks the query windows up by sequence.  A repeated window keeps its first position.
+        left_window_dict = {}
+        for i, target_window in enumerate(left_target_windows):
+            left_window_dict.setdefault(target_window, i)
+        right_window_dict = {}
+        for i, target_window in enumerate(right_target_windows):
+            right_window_dict.setdefault(target_window, i)
+
+        # --WindowEngine Kernel, and the wild type search below, use the hashed windows.
+        target_windows = SlidingWindow.TargetWindows(target_region, cutsite, len(left_target_windows),
+                                                     len(right_target_windows), target_region[cutsite-4:cutsite+4])
+
+        '''
+        The unedited amplicon, and copies of it missing up to 5 nt of primer from either end, that the junction search 
+        scores as no cut with no HR donor.  Reads matching one of these exactly skip the search.
+        '''
+        n_limit = float(self.args.N_Limit)
+        minimum_length = int(self.args.Minimum_Length)
+        candidates = []
+        for left_trim in range(6):
+            for right_trim in range(6):
+                seq = target_region[left_trim:target_length-right_trim]
+                if seq and seq.count("N") / len(seq) <= n_limit and len(seq) > minimum_length:
+                    candidates.append(seq)
+
+        wild_type_sequences = frozenset()
+        if candidates:
+            ends = numpy.cumsum([len(seq) for seq in candidates], dtype=numpy.int64)
+            columns = SlidingWindow.junction_batch("".join(candidates).encode(), ends, target_windows, lower_limit,
+                                                   hr_donor)
+            wild_type = (columns["status"] == SlidingWindow.NO_CUT) & (columns["hr"] == 0)
+            wild_type_sequences = frozenset(candidates[i] for i in numpy.flatnonzero(wild_type).tolist())
+
+        return TargetBundle(locus_name, target_region, cutsite, reverse_complement, lower_limit, upper_limit,
+                            tuple(left_target_windows), tuple(right_target_windows), left_window_dict,
+                            right_window_dict, target_windows, wild_type_sequences)
+
+    def cutsite_search(self, target_name, target_region, sgrna, reverse_complement, chrm, start, stop):
+        """
+        Find the sgRNA cutsite on the target region.
+        :param target_name:
+        :param target_region:
+        :param sgrna:
+        :param reverse_complement:
+        :param chrm:
+        :param start:
+        :param stop:
+        :return:
+        """
+
+        lft_position = 0
+        rt_position = len(sgrna)
+        upper_limit = len(target_region)-1
+        working_sgrna = sgrna
+
+        if reverse_complement:
+            working_sgrna = Sequence_Magic.rcomp(sgrna)
+
+        while rt_position < upper_limit:
+            if target_region[lft_position:rt_position] == working_sgrna:
+                if reverse_complement:
+                    return lft_position+3
+                else:
+                    return rt_position-3
+
+            lft_position += 1
+            rt_position += 1
 
+        self.log.error("sgRNA {} does not map to locus {}; chr{}:{}-{}.  Check --TargetFile and try again."
+                       .format(sgrna, target_name, chrm, start, stop))
+        raise SystemExit(1)
@@ -0,0 +1,169 @@
+"""
+Tests for ScarSearch.  Build SlidingWindow first with "python3 scarmapper/setup.py build_ext --inplace" and run with
+"python3 -m pytest" from the top of the repository.
+"""
+
+import argparse
+import logging
+import random
+import sys
+import time
+import pathos
+import pytest
+from Valkyries import FASTQ_Tools
+from scarmapper import INDEL_Processing
+from scarmapper.test_SlidingWindow import random_reads, random_target, target_bundle
+
+
+def scar_search(bundle, reads, block_size=None, **options):
+    """
+    Search reads with a ScarSearch set up the way pipeline_aggregator() does it, block_size reads at a time.
+    :return: The ScarSearch, before finish() is called.
+    """
+    args = argparse.Namespace(N_Limit=0.05, Minimum_Length=50, HR_Donor="", HR_DonorRcomp=False,
+                              WindowEngine="Kernel", OutputRawData=True, JunctionCache="", JunctionCacheSize=1000)
+    vars(args).update(options)
+    index_dict = {"Index": ["", "", "", "", "", "Sample", "1", "Locus"]}
+    search = INDEL_Processing.ScarSearch(logging.getLogger(__name__), args, "test", None, {}, index_dict, "Index",
+                                         None, 0, 0, bundle)
+    search.setup()
+
+    block_size = block_size or len(reads)
+    for start in range(0, len(reads), block_size):
+        search.add_reads(reads[start:start+block_size])
+
+    return search
+
+
+def search_output(search):
+    """
+    The summary_data, frequency counts and raw data lines.  The raw data lines are sorted as the copies of each
+    sequence are written together.
+    """
+    frequency_counts = {freq_key: freq_data[0] for freq_key, freq_data in search.results_freq_dict.items()}
+
+    return search.summary_data, frequency_counts, sorted(map(str, search.read_results_list))
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("hr_donor", ["", "GATTACAGATTACA,CCTTAAGGCCTTAAGG"])
+def test_window_engines_give_the_same_summary(seed, hr_donor):
+    rng = random.Random(seed)
+    hr_donors = tuple(donor for donor in hr_donor.split(",") if donor)
+    target_region = random_target(rng, repeat=bool(seed % 2))
+    bundle = target_bundle(target_region, hr_donors)
+    reads = random_reads(rng, target_region, 3000, hr_donors=hr_donors)
+
+    scan = search_output(scar_search(bundle, reads, WindowEngine="Scan", HR_Donor=hr_donor))
+
+    assert search_output(scar_search(bundle, reads, WindowEngine="Hash", HR_Donor=hr_donor)) == scan
+    assert search_output(scar_search(bundle, reads, WindowEngine="Kernel", HR_Donor=hr_donor)) == scan
+
+
+@pytest.mark.parametrize("engine", ["Kernel", "Scan"])
+@pytest.mark.parametrize("hr_donor", ["", "GATTACAGATTACA,CCTTAAGGCCTTAAGG"])
+def test_junction_cache_gives_the_same_summary(tmp_path, engine, hr_donor):
+    rng = random.Random(7)
+    hr_donors = tuple(donor for donor in hr_donor.split(",") if donor)
+    target_region = random_target(rng)
+    bundle = target_bundle(target_region, hr_donors)
+    reads = random_reads(rng, target_region, 3000, hr_donors=hr_donors)
+    options = dict(WindowEngine=engine, HR_Donor=hr_donor, JunctionCache=str(tmp_path / "junctions.db"))
+
+    uncached = search_output(scar_search(bundle, reads, WindowEngine=engine, HR_Donor=hr_donor))
+
+    # The first run fills the cache with half the library and the second finds those sequences in it.
+    for run_reads in (reads[:1500], reads):
+        search = scar_search(bundle, run_reads, block_size=700, **options)
+        hits = search.junction_cache.hits
+        search.junction_cache.close()
+
+    assert hits > 0
+    assert search_output(search) == uncached
+
+
+def test_junction_cache_size(tmp_path):
+    rng = random.Random(8)
+    target_region = random_target(rng)
+    bundle = target_bundle(target_region)
+    reads = random_reads(rng, target_region, 2000)
+    cache_file = str(tmp_path / "junctions.db")
+
+    search = scar_search(bundle, reads, JunctionCache=cache_file, JunctionCacheSize=100)
+    search.junction_cache.close()
+    cache = INDEL_Processing.JunctionCache(cache_file, 100)
+
+    assert cache.connection.execute("SELECT COUNT(*) FROM junctions").fetchone()[0] == 100
+    cache.close()
+
+
+def test_blocks_give_the_same_summary():
+    rng = random.Random(9)
+    target_region = random_target(rng)
+    bundle = target_bundle(target_region)
+    reads = random_reads(rng, target_region, 3000)
+
+    assert search_output(scar_search(bundle, reads, block_size=97)) == search_output(scar_search(bundle, reads))
+
+
+def test_pipeline_stops_when_a_scar_search_process_dies():
+    """
+    A matcher blocked on the queue of a dead aggregator never returns, so waiting on it has to watch the aggregators.
+    """
+    data_processing = INDEL_Processing.DataProcessing.__new__(INDEL_Processing.DataProcessing)
+    data_processing.log = logging.getLogger(__name__)
+    aggregator = pathos.helpers.mp.Process(target=sys.exit, args=(1,))
+    aggregator.start()
+    aggregator.join()
+    p = pathos.multiprocessing.Pool(1)
+    match_result = p.apply_async(time.sleep, (60,))
+
+    with pytest.raises(SystemExit):
+        data_processing.pipeline_result(match_result, [aggregator])
+    p.terminate()
+
+
+def test_sharded_demultiplex_matches_serial_search(tmp_path):
+    """
+    Shards are merged and spilled one at a time.  The merged libraries must hold the reads of a serial search, in
+    the same order, after spilling.
+    """
+    rng = random.Random(11)
+    barcodes = ["".join(rng.choice("ACGT") for _ in range(8)) for _ in range(6)]
+    index_dict = {"Index{}".format(i): [barcodes[i], "", barcodes[i + 3], "", "", "Sample", str(i), "Locus"]
+                  for i in range(3)}
+    args = argparse.Namespace(Verbose="INFO", PEAR=True, Spawn=2, DemultiplexShards=5, MemoryBudget=1,
+                              FastqIndex=False, Demultiplex=False, Platform="Illumina", IndexEngine="Table",
+                              SequencePacking="Byte", UnknownBarcodes=10, WorkingFolder=str(tmp_path) + "/",
+                              SampleManifest="", PrefetchDepth=0)
+
+    records = []
+    for i in range(20000):
+        index = rng.randrange(4)
+        barcode = "{}+{}".format(barcodes[index + 3], barcodes[index]) if index < 3 else "TTTTTTTT+GGGGGGGG"
+        seq = "".join(rng.choice("ACGT") for _ in range(rng.randint(80, 150)))
+        records.append(FASTQ_Tools.FastqRead("read{} 1:N:0:{}".format(i, barcode), seq, "+", "F" * len(seq)))
+    input_file = str(tmp_path / "consensus.fastq")
+    with open(input_file, "w") as f:
+        f.write("".join("@{}\n{}\n+\n{}\n".format(read.name, read.seq, read.qual) for read in records))
+
+    serial_search = INDEL_Processing.IndexSearch(logging.getLogger(__name__), args, index_dict,
+                                                 {"Locus": {"R1": [], "R2": []}})
+    serial_search.batch_search([(read, None) for read in records])
+
+    data_processing = INDEL_Processing.DataProcessing.__new__(INDEL_Processing.DataProcessing)
+    data_processing.log = logging.getLogger(__name__)
+    data_processing.args = args
+    data_processing.index_dict = index_dict
+    data_processing.phase_dict = {"Locus": {"R1": [], "R2": []}}
+    data_processing.fastq1 = argparse.Namespace(input_file=input_file)
+    data_processing.fastq_outfile_dict = None
+    data_processing.consensus_demultiplex()
+
+    assert any(sequence_list.spill_count for sequence_list in data_processing.sequence_dict.values())
+    assert {index_name: list(sequence_list) for index_name, sequence_list in data_processing.sequence_dict.items()} \
+        == {index_name: list(sequence_list) for index_name, sequence_list in serial_search.sequence_dict.items()}
+    assert dict(data_processing.read_count_dict) == dict(serial_search.read_count_dict)
+
+    for sequence_list in data_processing.sequence_dict.values():
+        sequence_list.discard()
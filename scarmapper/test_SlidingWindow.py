@@ -0,0 +1,219 @@
+"""
+Tests for the SlidingWindow search engines, checked against the original list scan of sliding_window().  Build the
+module first with "python3 scarmapper/setup.py build_ext --inplace" and run with "python3 -m pytest" from the top of
+the repository.
+"""
+
+import argparse
+import logging
+import random
+import numpy
+import pytest
+from scarmapper import SlidingWindow, TargetMapper
+
+
+class Reference:
+    """
+    Stands in for the pysam.FastaFile TargetMapper reads the target region from.
+    """
+    def __init__(self, target_region):
+        self.target_region = target_region
+
+    def fetch(self, chrm, start, stop):
+        return self.target_region
+
+
+def random_target(rng, length=200, repeat=False):
+    """
+    Random target region with the sgRNA in the middle.  With repeat a 14 nt stretch on each side of the cutsite is
+    copied elsewhere on the same side so some target windows appear twice.
+    """
+    target_region = "".join(rng.choice("ACGT") for _ in range(length))
+    if repeat:
+        target_region = target_region[:30] + target_region[70:84] + target_region[44:140] + target_region[110:124] + \
+            target_region[154:]
+
+    return target_region
+
+
+def target_bundle(target_region, hr_donors=()):
+    """
+    The TargetBundle ScarSearch would be given for target_region, with the sgRNA at 90 - 110 and the cutsite at 107.
+    """
+    mapper = TargetMapper.TargetMapper.__new__(TargetMapper.TargetMapper)
+    mapper.refseq = Reference(target_region)
+    mapper.log = logging.getLogger(__name__)
+    mapper.args = argparse.Namespace(N_Limit=0.05, Minimum_Length=50)
+    hr_donor = SlidingWindow.DonorScanner(hr_donors) if hr_donors else None
+
+    return mapper.target_bundle(("Locus", "chr1", 0, len(target_region), target_region[90:110], "NO"), hr_donor)
+
+
+def random_reads(rng, target_region, count, cutsite=107, hr_donors=()):
+    """
+    Wild type reads, deletions, insertions, microhomology deletions, reads with an N in the insertion, donor
+    insertions, random sequence and reads with point mutations near the cutsite.
+    """
+    def random_seq(length, alphabet="ACGT"):
+        return "".join(rng.choice(alphabet) for _ in range(length))
+
+    reads = []
+    for _ in range(count):
+        kind = rng.randrange(8)
+        left = rng.randint(0, 40)
+        right = rng.randint(0, 40)
+        if kind == 0:
+            seq = target_region
+        elif kind == 1:
+            seq = target_region[:cutsite-left] + target_region[cutsite+right:]
+        elif kind == 2:
+            seq = target_region[:cutsite-left] + random_seq(rng.randint(1, 20)) + target_region[cutsite+right:]
+        elif kind == 3:
+            microhomology = target_region[cutsite-left-rng.randint(2, 6):cutsite-left]
+            seq = target_region[:cutsite-left] + microhomology + target_region[cutsite+right:]
+        elif kind == 4:
+            seq = target_region[:cutsite-left] + random_seq(rng.randint(1, 10), "ACGTN") + target_region[cutsite+right:]
+        elif kind == 5 and hr_donors:
+            insert = "".join(rng.choice(hr_donors) for _ in range(rng.randint(1, 3)))
+            seq = target_region[:cutsite-left] + insert + target_region[cutsite+right:]
+        elif kind == 6:
+            seq = random_seq(rng.randint(60, 220))
+        else:
+            position = rng.randint(cutsite-25, cutsite+25)
+            seq = target_region[:position] + rng.choice("ACGT") + target_region[position+1:]
+        reads.append(seq)
+
+    return reads
+
+
+def summary_data(hr_donor_count=0):
+    return ["Index", 0, 0, 0, 0, 0, [0, 0], [0, 0], 'junction data', "Locus", [0, 0],
+            [[0, 0] for _ in range(hr_donor_count)]]
+
+
+def search(bundle, reads, engine, hr_donor=""):
+    """
+    Run sliding_window() on each read with the windows of one engine.
+    :return: List of sub_lists and the summary_data.
+    """
+    if engine == "Scan":
+        left_target_windows, right_target_windows = bundle.left_target_windows, bundle.right_target_windows
+    elif engine == "Hash":
+        left_target_windows, right_target_windows = bundle.left_window_dict, bundle.right_window_dict
+    else:
+        left_target_windows, right_target_windows = bundle.target_windows, bundle.target_windows
+
+    target_region = bundle.target_region
+    cutsite = bundle.cutsite
+    cutwindow = target_region[cutsite-4:cutsite+4]
+    hr_donor_count = len(hr_donor) if isinstance(hr_donor, SlidingWindow.DonorScanner) else 0
+    data = summary_data(hr_donor_count)
+    sub_lists = []
+    for seq in reads:
+        sub_list, data = SlidingWindow.sliding_window(
+            seq, target_region, cutsite, len(target_region), bundle.lower_limit, bundle.upper_limit, data,
+            left_target_windows, right_target_windows, cutwindow, hr_donor)
+        sub_lists.append(sub_list)
+
+    return sub_lists, data
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("repeat", [False, True])
+def test_hash_engine_matches_list_scan(seed, repeat):
+    rng = random.Random(seed)
+    target_region = random_target(rng, repeat=repeat)
+    bundle = target_bundle(target_region)
+    reads = random_reads(rng, target_region, 2000)
+
+    assert search(bundle, reads, "Hash") == search(bundle, reads, "Scan")
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("repeat", [False, True])
+def test_kernel_engine_matches_list_scan(seed, repeat):
+    rng = random.Random(seed)
+    target_region = random_target(rng, repeat=repeat)
+    bundle = target_bundle(target_region)
+    reads = random_reads(rng, target_region, 2000)
+
+    assert search(bundle, reads, "Kernel") == search(bundle, reads, "Scan")
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("hr_donors", [(), ("GATTACAGATTACA", "CCTTAAGGCCTTAAGG")])
+def test_junction_batch_matches_list_scan(seed, hr_donors):
+    rng = random.Random(seed)
+    target_region = random_target(rng, repeat=bool(seed % 2))
+    bundle = target_bundle(target_region, hr_donors)
+    reads = random_reads(rng, target_region, 1000, hr_donors=hr_donors)
+    hr_donor = SlidingWindow.DonorScanner(hr_donors) if hr_donors else None
+    ends = numpy.cumsum([len(seq) for seq in reads], dtype=numpy.int64)
+
+    columns = SlidingWindow.junction_batch("".join(reads).encode(), ends, bundle.target_windows, bundle.lower_limit,
+                                           hr_donor)
+
+    for i, seq in enumerate(reads):
+        (sub_list,), data = search(bundle, [seq], "Scan", hr_donor or "")
+        if sub_list:
+            assert columns["status"][i] == SlidingWindow.SCAR
+            assert sub_list[5:9] == [columns["consensus_lft_junction"][i], columns["consensus_rt_junction"][i],
+                                     columns["target_lft_junction"][i], columns["target_rt_junction"][i]]
+        elif data[6][0]:
+            assert columns["status"][i] == SlidingWindow.NO_JUNCTION
+        elif data[6][1]:
+            assert columns["status"][i] == SlidingWindow.NO_CUT
+        else:
+            assert columns["status"][i] == SlidingWindow.N_INSERTION
+
+        assert data[2:6] == [columns["left_deletion"][i], columns["right_deletion"][i], columns["insertion"][i],
+                             columns["microhomology"][i]]
+        assert data[11] == [[columns["hr_found"][i][j], columns["hr_extra"][i][j]] for j in range(len(hr_donors))]
+        assert data[10][0] == columns["hr"][i]
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_donor_scanner_matches_single_donor_search(seed):
+    rng = random.Random(seed)
+    hr_donors = ("GATTACAGATTACA", "CCTTAAGGCCTTAAGG", "TACAGATT")
+    target_region = random_target(rng)
+    bundle = target_bundle(target_region, hr_donors)
+    reads = random_reads(rng, target_region, 2000, hr_donors=hr_donors)
+
+    scanner_sub_lists, scanner_data = search(bundle, reads, "Scan", SlidingWindow.DonorScanner(hr_donors))
+
+    # Each donor is counted as if it were searched alone.
+    for i, hr_donor in enumerate(hr_donors):
+        sub_lists, data = search(bundle, reads, "Scan", hr_donor)
+
+        assert scanner_data[11][i] == data[10]
+        assert scanner_data[:10] == data[:10]
+
+    # The HR total counts reads, however many donors each holds, and the repeats are the further donor copies.
+    donor_reads = 0
+    donor_copies = 0
+    for seq in reads:
+        (sub_list,), data = search(bundle, [seq], "Scan", SlidingWindow.DonorScanner(hr_donors))
+        copies = sum(sum(donor_counts) for donor_counts in data[11])
+        donor_reads += copies > 0
+        donor_copies += copies
+
+    assert 0 < scanner_data[10][0] == donor_reads
+    assert scanner_data[10][1] == donor_copies - donor_reads
+    assert all(sub_list[9] == "HR" for sub_list, seq in zip(scanner_sub_lists, reads)
+               if sub_list and any(hr_donor in seq[25:-26] for hr_donor in hr_donors))
+
+
+def test_single_donor_scanner_matches_donor_string():
+    rng = random.Random(20)
+    hr_donors = ("GATTACAGATTACA",)
+    target_region = random_target(rng)
+    bundle = target_bundle(target_region, hr_donors)
+    reads = random_reads(rng, target_region, 2000, hr_donors=hr_donors)
+
+    sub_lists, data = search(bundle, reads, "Scan", hr_donors[0])
+    scanner_sub_lists, scanner_data = search(bundle, reads, "Scan", SlidingWindow.DonorScanner(hr_donors))
+
+    assert scanner_sub_lists == sub_lists
+    assert scanner_data[:11] == data[:11]
+    assert scanner_data[11] == [data[10]]